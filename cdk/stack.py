@@ -65,7 +65,6 @@ class JobSchedulerStack(cdk.Stack):
             command=["just", "scheduler"],
             environment={
                 "APP_DATABASE_URL": f"redis://{redis.endpoint_address}",
-                "APP_CACHE_URL": f"redis://{redis.endpoint_address}",
                 "APP_BROKER_URL": f"{rabbitmq.endpoint_address}",
                 "APP_BROKER_USERNAME": rabbitmq.templated_secret.secret_value_from_json(
                     "username"
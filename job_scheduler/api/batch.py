@@ -0,0 +1,87 @@
+import json
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    List,
+    Sequence,
+    Tuple,
+    Type,
+    TypeVar,
+)
+
+from fastapi import HTTPException, Request
+from pydantic import BaseModel, ValidationError
+
+from job_scheduler.api.models import BatchItemResult
+
+NDJSON_MEDIA_TYPES = {"application/x-ndjson", "application/ndjson"}
+
+M = TypeVar("M", bound=BaseModel)
+Chunk = Sequence[Tuple[int, M]]
+
+
+async def iter_items(request: Request) -> AsyncIterator[Any]:
+    """
+    Yields the items of a batch body, which is either a JSON array or newline
+    delimited JSON. NDJSON bodies are read as they stream in and yield each
+    line undecoded so that a malformed line only fails its own item.
+    """
+    media_type = request.headers.get("content-type", "").split(";")[0].strip()
+    if media_type in NDJSON_MEDIA_TYPES:
+        buffer = b""
+        async for data in request.stream():
+            buffer += data
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                if line.strip():
+                    yield line
+        if buffer.strip():
+            yield buffer
+        return
+
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Body is not valid JSON")
+    if not isinstance(body, list):
+        raise HTTPException(status_code=422, detail="Body must be a JSON array")
+    for item in body:
+        yield item
+
+
+def parse_item(model: Type[M], item: Any) -> M:
+    if isinstance(item, bytes):
+        return model.parse_raw(item)
+    return model.parse_obj(item)
+
+
+async def run_batch(
+    items: AsyncIterator[Any],
+    model: Type[M],
+    write: Callable[[Chunk], Awaitable[Sequence[BatchItemResult]]],
+    chunk_size: int,
+) -> List[BatchItemResult]:
+    """
+    Validates each item against the model and hands the valid ones to write a
+    chunk at a time, returning a result for every item in the order received.
+    """
+    results: List[BatchItemResult] = []
+    chunk: List[Tuple[int, M]] = []
+    index = 0
+    async for item in items:
+        try:
+            chunk.append((index, parse_item(model, item)))
+        except ValidationError as e:
+            results.append(
+                BatchItemResult(index=index, status_code=422, detail=e.errors())
+            )
+        index += 1
+
+        if len(chunk) >= chunk_size:
+            results.extend(await write(chunk))
+            chunk = []
+    if len(chunk) > 0:
+        results.extend(await write(chunk))
+    return sorted(results, key=lambda r: r.index)
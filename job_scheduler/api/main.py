@@ -1,11 +1,20 @@
-from typing import Sequence
+from datetime import datetime
+from typing import List, Optional, Sequence
 from uuid import UUID
 
 import structlog
 import uvicorn
-from fastapi import Depends, FastAPI, HTTPException
-
-from job_scheduler.api.models import Job, Schedule, ScheduleRequest
+from fastapi import Depends, FastAPI, HTTPException, Query, Request
+
+from job_scheduler.api.batch import Chunk, iter_items, run_batch
+from job_scheduler.api.models import (
+    BatchItemResult,
+    Job,
+    Schedule,
+    ScheduleBatchDelete,
+    ScheduleBatchUpdate,
+    ScheduleRequest,
+)
 from job_scheduler.config import config
 from job_scheduler.db import (
     JobRepository,
@@ -13,6 +22,7 @@ from job_scheduler.db import (
     RedisScheduleRepository,
     ScheduleRepository,
 )
+from job_scheduler.db.redis import get_redis_connection
 from job_scheduler.logging import setup_logging
 from job_scheduler.services import (
     delete_schedule,
@@ -27,17 +37,27 @@ logger = structlog.get_logger("job_scheduler.api")
 app = FastAPI()
 
 
-async def get_schedule_repo() -> ScheduleRepository:
-    return await RedisScheduleRepository.get_repo()
+def get_schedule_repo(request: Request) -> ScheduleRepository:
+    return request.app.state.schedule_repo
 
 
-async def get_job_repo() -> JobRepository:
-    return await RedisJobRepository.get_repo()
+def get_job_repo(request: Request) -> JobRepository:
+    return request.app.state.job_repo
 
 
 @app.on_event("startup")
 async def startup_event():
     setup_logging()
+    # Repositories share a single connection pool for the life of the app
+    redis = await get_redis_connection()
+    app.state.schedule_repo = await RedisScheduleRepository.get_repo(redis)
+    app.state.job_repo = await RedisJobRepository.get_repo(redis)
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await app.state.schedule_repo.shutdown()
+    await app.state.job_repo.shutdown()
 
 
 @app.get("/health", status_code=200)
@@ -82,11 +102,98 @@ async def delete(s_id: UUID, repo: ScheduleRepository = Depends(get_schedule_rep
     return s[0]
 
 
+@app.post("/schedules:batch", response_model=List[BatchItemResult])
+async def create_batch(
+    request: Request,
+    repo: ScheduleRepository = Depends(get_schedule_repo),
+):
+    """
+    Creates each schedule in a JSON array or newline delimited JSON body. Every
+    item gets its own result, so invalid items do not fail the whole batch.
+    """
+
+    async def write(chunk: Chunk[ScheduleRequest]):
+        schedules = [Schedule.parse_obj(req.dict()) for _, req in chunk]
+        await store_schedule(repo, *schedules)
+        return [
+            BatchItemResult(index=i, status_code=201, id=s.id)
+            for (i, _), s in zip(chunk, schedules)
+        ]
+
+    return await run_batch(
+        iter_items(request), ScheduleRequest, write, config.api.batch_chunk_size
+    )
+
+
+@app.put("/schedules:batch", response_model=List[BatchItemResult])
+async def update_batch(
+    request: Request,
+    repo: ScheduleRepository = Depends(get_schedule_repo),
+):
+    """
+    Updates each schedule in a JSON array or newline delimited JSON body, which
+    are identified by their id.
+    """
+
+    async def write(chunk: Chunk[ScheduleBatchUpdate]):
+        updates = {
+            req.id: req.dict(exclude_unset=True, exclude={"id"}) for _, req in chunk
+        }
+        updated = {s.id for s in await update_schedule(repo, updates)}
+        return [
+            BatchItemResult(index=i, status_code=200, id=req.id)
+            if req.id in updated
+            else BatchItemResult(
+                index=i, status_code=404, id=req.id, detail="Schedule not found"
+            )
+            for i, req in chunk
+        ]
+
+    return await run_batch(
+        iter_items(request), ScheduleBatchUpdate, write, config.api.batch_chunk_size
+    )
+
+
+@app.delete("/schedules:batch", response_model=List[BatchItemResult])
+async def delete_batch(
+    request: Request,
+    repo: ScheduleRepository = Depends(get_schedule_repo),
+):
+    """
+    Deletes each schedule identified in a JSON array or newline delimited JSON
+    body.
+    """
+
+    async def write(chunk: Chunk[ScheduleBatchDelete]):
+        deleted = {s.id for s in await delete_schedule(repo, *[r.id for _, r in chunk])}
+        return [
+            BatchItemResult(index=i, status_code=200, id=req.id)
+            if req.id in deleted
+            else BatchItemResult(
+                index=i, status_code=404, id=req.id, detail="Schedule not found"
+            )
+            for i, req in chunk
+        ]
+
+    return await run_batch(
+        iter_items(request), ScheduleBatchDelete, write, config.api.batch_chunk_size
+    )
+
+
 @app.get("/schedule/{s_id}/jobs", response_model=Sequence[Job])
 async def get_jobs_by_schedule(
-    s_id: UUID, j_repo: JobRepository = Depends(get_job_repo)
+    s_id: UUID,
+    limit: int = Query(config.api.jobs_page_size, gt=0, le=1000),
+    before: Optional[datetime] = Query(
+        None, description="Only return jobs which ran before this time"
+    ),
+    j_repo: JobRepository = Depends(get_job_repo),
 ):
-    jobs = await get_schedule_jobs(j_repo, s_id)
+    """
+    Jobs are returned newest first. To retrieve the next page, pass the ran_at
+    of the last job returned as before.
+    """
+    jobs = await get_schedule_jobs(j_repo, s_id, before=before, limit=limit)
     if len(jobs) == 0:
         raise HTTPException(status_code=404, detail="Jobs not found")
     return jobs[s_id]
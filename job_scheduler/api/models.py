@@ -1,23 +1,64 @@
+import json
+import zlib
 from datetime import datetime, timedelta, timezone
 from enum import Enum
-from typing import Optional
+from typing import Any, NamedTuple, Optional
 from uuid import UUID, uuid4
 
 import pytz
 from croniter import croniter
-from pydantic import BaseModel, Field, validator
+from pydantic import BaseModel, Field, PrivateAttr, validator
 
+from job_scheduler.config import config
+from job_scheduler.cron import compile_expression, next_fire_times
 from job_scheduler.db.types import JsonMap
 
 
 class HttpMethod(str, Enum):
+    get = "get"
     post = "post"
+    put = "put"
+    patch = "patch"
+    delete = "delete"
+
+
+class StoredResponse(str, Enum):
+    body = "body"
+    headers = "headers"
+
+
+def stable_offset(s_id: UUID, window_s: float, salt: bytes = b"") -> float:
+    """
+    Returns an offset within window_s seconds derived from a schedule's id, so
+    that it is the same every time. Offsets drawn with different salts are
+    independent of each other.
+    """
+    return zlib.crc32(salt + s_id.bytes) / 2 ** 32 * window_s
+
+
+def encode_payload(payload: JsonMap) -> bytes:
+    return json.dumps(payload, separators=(",", ":")).encode()
 
 
 class JobDefinition(BaseModel):
     callback_url: str
     http_method: HttpMethod = HttpMethod.post
     payload: JsonMap
+    # The runner's timeout applies when it isn't set
+    timeout_s: Optional[float] = Field(None, gt=0)
+    # Failed attempts are retried after backoff_s, growing by the multiplier
+    # with each further attempt
+    max_attempts: int = Field(1, ge=1)
+    backoff_s: float = Field(1.0, ge=0)
+    backoff_multiplier: float = Field(2.0, ge=1)
+    # What to keep of the callback's response in the job's result
+    store_response: StoredResponse = StoredResponse.body
+
+    def backoff(self, attempt: int) -> float:
+        """
+        Returns how long to wait before retrying the given attempt
+        """
+        return self.backoff_s * self.backoff_multiplier ** (attempt - 1)
 
 
 class Job(BaseModel):
@@ -28,6 +69,7 @@ class Job(BaseModel):
     http_method: HttpMethod
     status_code: int
     result: JsonMap
+    attempt: int = 1
 
 
 class ScheduleRequest(BaseModel):
@@ -36,6 +78,9 @@ class ScheduleRequest(BaseModel):
     description: Optional[str] = None
     start_at: Optional[datetime] = None
     active: bool = True
+    # Spreads runs over this many seconds after each fire time. The default
+    # applies when it isn't set.
+    jitter_s: Optional[float] = Field(None, ge=0)
     job: JobDefinition
 
     @validator("schedule")
@@ -54,16 +99,36 @@ class ScheduleRequest(BaseModel):
         return v
 
 
+class ScheduleBatchUpdate(ScheduleRequest):
+    id: UUID
+
+
+class ScheduleBatchDelete(BaseModel):
+    id: UUID
+
+
+class BatchItemResult(BaseModel):
+    index: int
+    status_code: int
+    id: Optional[UUID] = None
+    detail: Optional[Any] = None
+
+
 class Schedule(BaseModel):
     name: str
     schedule: str
     description: Optional[str] = None
     start_at: Optional[datetime]
     active: bool
+    jitter_s: Optional[float] = Field(None, ge=0)
     job: JobDefinition
     id: UUID = Field(default_factory=uuid4)
     next_run: Optional[datetime] = None
     last_run: Optional[datetime] = None
+    # The bytes the schedule was read from or written as, which conditional
+    # writes compare against
+    _stored: Optional[bytes] = PrivateAttr(None)
+    _encoded_payload: Optional[bytes] = PrivateAttr(None)
 
     @validator("start_at", always=True)
     def validate_start_at(cls, v) -> datetime:
@@ -77,7 +142,7 @@ class Schedule(BaseModel):
             return next_run
 
         schedule, start_at = values["schedule"], values["start_at"]
-        return croniter(schedule, start_at).get_next(datetime)
+        return compile_expression(schedule).next_after(start_at)
 
     def calc_next_run(self, start: Optional[datetime] = None) -> datetime:
         if start is None:
@@ -88,34 +153,92 @@ class Schedule(BaseModel):
         except ValueError:
             utc_start = start
 
-        return croniter(self.schedule, utc_start).get_next(datetime)
+        return compile_expression(self.schedule).next_after(utc_start)
 
     def confirm_execution(self):
-        utc_now = datetime.now(timezone.utc)
-        self.last_run = utc_now
-        if self.next_run < utc_now:
-            # The job was supposed to run before now, to catch up we
-            # calc the next run relative to right now
-            self.next_run = self.calc_next_run(utc_now)
-        else:
-            # Calc next run relative to when the job is going to
-            # run next
-            self.next_run = self.calc_next_run(self.next_run)
+        confirm_executions(self)
 
     @property
-    def priority(self) -> float:
+    def jitter(self) -> timedelta:
+        """
+        The schedule's offset within its jitter window, which is derived from
+        its id so that it is the same for every run
+        """
+        window = self.jitter_s if self.jitter_s is not None else config.jobs.jitter_s
+        return timedelta(seconds=stable_offset(self.id, window))
+
+    @property
+    def due_at(self) -> datetime:
+        """
+        The time the next run is released, its fire time offset by the jitter
+        """
         assert self.next_run
-        return self.next_run.timestamp()
+        return self.next_run + self.jitter
+
+    @property
+    def priority(self) -> float:
+        return self.due_at.timestamp()
+
+    @property
+    def encoded_payload(self) -> bytes:
+        """
+        The job's payload as sent with each of its requests. It is stored along
+        with the schedule, so it is only serialized when the schedule is written.
+        """
+        if self._encoded_payload is None:
+            self._encoded_payload = encode_payload(self.job.payload)
+        return self._encoded_payload
 
     @property
     def current_delay(self) -> timedelta:
-        assert self.next_run
-        return datetime.now(timezone.utc) - self.next_run
+        return datetime.now(timezone.utc) - self.due_at
 
     def is_late(self, allowance=0) -> bool:
         assert allowance >= 0
-        assert self.next_run
 
         grace_period = timedelta(seconds=allowance)
         utc_now = datetime.now(timezone.utc)
-        return self.next_run < (utc_now - grace_period)
+        return self.due_at < (utc_now - grace_period)
+
+
+class DueSchedule(NamedTuple):
+    """
+    The fields of a schedule which the scheduler needs to queue it, read from
+    the schedule index without loading the schedule itself
+    """
+
+    id: UUID
+    next_run: datetime
+
+    @property
+    def priority(self) -> float:
+        return self.next_run.timestamp()
+
+    @property
+    def current_delay(self) -> timedelta:
+        return datetime.now(timezone.utc) - self.next_run
+
+
+def confirm_executions(*schedules: Schedule):
+    """
+    Records that each schedule has just executed and advances its next run,
+    computing the next runs of all the schedules together.
+    """
+    utc_now = datetime.now(timezone.utc)
+    starts = []
+    for s in schedules:
+        assert s.next_run
+        s.last_run = utc_now
+        if s.due_at < utc_now:
+            # The job was supposed to run before now, to catch up we
+            # calc the next run relative to right now, less the jitter
+            # its runs are released after
+            starts.append(utc_now - s.jitter)
+        else:
+            # Calc next run relative to when the job is going to
+            # run next
+            starts.append(s.next_run)
+
+    next_runs = next_fire_times([s.schedule for s in schedules], starts)
+    for s, next_run in zip(schedules, next_runs):
+        s.next_run = next_run
@@ -8,7 +8,19 @@ from .messages import DequeuedMessage, EnqueuedMessage
 
 class ScheduleBroker(ABC):
     @abstractmethod
-    async def publish(self, *messages: str) -> t.Sequence[EnqueuedMessage]:
+    async def publish(
+        self,
+        *messages: str,
+        headers: t.Optional[t.Mapping[str, t.Any]] = None,
+        delay_s: float = 0,
+        message_headers: t.Optional[t.Sequence[t.Mapping[str, t.Any]]] = None,
+    ) -> t.Sequence[EnqueuedMessage]:
+        """
+        This implementation should only mark a message as confirmed once the
+        broker has taken responsibility for it. The headers are set on every
+        message, along with each message's own message_headers if given, and a
+        delay holds the messages back from consumers for that many seconds.
+        """
         pass
 
     @abstractmethod
@@ -19,10 +31,20 @@ class ScheduleBroker(ABC):
         pass
 
     @abstractmethod
-    async def drain(self, limit: int = 100) -> t.Sequence[DequeuedMessage]:
+    async def drain(
+        self, limit: int = 100, max_wait_ms: int = 0
+    ) -> t.Sequence[DequeuedMessage]:
         """
         This implementation should block until at least one message is ready for
-        processing
+        processing, then keep collecting messages until either limit messages
+        have been collected or max_wait_ms milliseconds have passed
+        """
+        pass
+
+    @abstractmethod
+    def consume(self) -> t.AsyncIterator[DequeuedMessage]:
+        """
+        This implementation should yield messages as the broker pushes them
         """
         pass
 
@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import asyncio
 import typing as t
 from queue import Empty, LifoQueue
 
@@ -12,25 +13,42 @@ class FakeBroker(ScheduleBroker):
     def __init__(self):
         self.job_queue = LifoQueue()
 
-    async def publish(self, *messages: str) -> t.Sequence[EnqueuedMessage]:
+    async def publish(
+        self,
+        *messages: str,
+        headers: t.Optional[t.Mapping[str, t.Any]] = None,
+        delay_s: float = 0,
+        message_headers: t.Optional[t.Sequence[t.Mapping[str, t.Any]]] = None,
+    ) -> t.Sequence[EnqueuedMessage]:
         published: t.List[EnqueuedMessage] = []
-        for m in messages:
-            em = EnqueuedMessage.from_string(m)
-            self.job_queue.put(em)
+        loop = asyncio.get_running_loop()
+        for n, m in enumerate(messages):
+            own_headers = message_headers[n] if message_headers else {}
+            em = EnqueuedMessage.from_string(m, {**(headers or {}), **own_headers})
+            if delay_s > 0:
+                loop.call_later(delay_s, self.job_queue.put, em)
+            else:
+                self.job_queue.put(em)
+            em.confirmed = True
             published.append(em)
         return published
 
     async def get(self) -> DequeuedMessage:
         return self.job_queue.get(block=True)
 
-    async def drain(self, limit=100) -> t.Sequence[DequeuedMessage]:
+    async def drain(self, limit=100, max_wait_ms=0) -> t.Sequence[DequeuedMessage]:
         messages = [await self.get()]
-        while True:
+        while len(messages) < limit:
             try:
                 m = self.job_queue.get(block=False)
                 messages.append(m)
             except Empty:
-                return messages
+                break
+        return messages
+
+    async def consume(self) -> t.AsyncIterator[DequeuedMessage]:
+        while True:
+            yield await self.get()
 
     async def ack(self, *messages: DequeuedMessage):
         for m in messages:
@@ -1,30 +1,50 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
+import typing as t
+from dataclasses import dataclass, field
 
 from aio_pika import DeliveryMode, IncomingMessage, Message
 
+# Set on messages published by a scheduler leader to the term it published in
+FENCING_TOKEN_HEADER = "x-fencing-token"
+# Set on messages retrying a job to the attempt they are for
+ATTEMPT_HEADER = "x-attempt"
+# Set on messages for a schedule's scheduled run to the index score it was
+# claimed at
+RUN_SCORE_HEADER = "x-run-score"
+
 
 @dataclass
 class EnqueuedMessage:
     payload: str
     message: Message
+    confirmed: bool = False
+    headers: t.Dict[str, t.Any] = field(default_factory=dict)
 
     @classmethod
-    def from_string(cls, message: str) -> EnqueuedMessage:
+    def from_string(
+        cls, message: str, headers: t.Optional[t.Mapping[str, t.Any]] = None
+    ) -> EnqueuedMessage:
+        headers = dict(headers or {})
         m = Message(
             str.encode(message),
             message_id=message,
             delivery_mode=DeliveryMode.PERSISTENT,
+            headers=headers,
         )
-        return cls(message=m, payload=message)
+        return cls(message=m, payload=message, headers=headers)
 
 
 @dataclass
 class DequeuedMessage:
     payload: str
     message: IncomingMessage
+    headers: t.Dict[str, t.Any] = field(default_factory=dict)
 
     @classmethod
     def from_message(cls, message: IncomingMessage) -> DequeuedMessage:
-        return cls(message=message, payload=message.body.decode())
+        return cls(
+            message=message,
+            payload=message.body.decode(),
+            headers=dict(message.headers or {}),
+        )
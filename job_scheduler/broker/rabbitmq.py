@@ -7,6 +7,7 @@ import aio_pika
 import structlog
 from aio_pika.channel import Channel
 from aio_pika.pool import Pool
+from aiormq import spec
 
 from job_scheduler.config import config
 
@@ -15,6 +16,9 @@ from .messages import DequeuedMessage, EnqueuedMessage
 
 logger = structlog.get_logger(__name__)
 
+# How long a delay queue outlives the last message published to it
+DELAY_QUEUE_EXPIRY_MS = 60_000
+
 
 async def _get_connection() -> aio_pika.Connection:
     sleep_time = 3
@@ -52,6 +56,9 @@ class RabbitMQBroker(ScheduleBroker):
     def __init__(self, channel: aio_pika.Channel, queue: aio_pika.Queue):
         self.queue: aio_pika.Queue = queue
         self.channel: Channel = channel
+        # Messages pushed to us by the broker, bounded by the channel's prefetch
+        self.deliveries: asyncio.Queue[DequeuedMessage] = asyncio.Queue()
+        self.consumer_tag: t.Optional[str] = None
 
     @classmethod
     async def get_broker(cls) -> RabbitMQBroker:
@@ -60,52 +67,128 @@ class RabbitMQBroker(ScheduleBroker):
             queue = await channel.declare_queue(config.broker.queue_name, durable=True)
             return cls(channel, queue)
 
-    async def publish(self, *messages: str) -> t.Sequence[EnqueuedMessage]:
+    async def publish(
+        self,
+        *messages: str,
+        headers: t.Optional[t.Mapping[str, t.Any]] = None,
+        delay_s: float = 0,
+        message_headers: t.Optional[t.Sequence[t.Mapping[str, t.Any]]] = None,
+    ) -> t.Sequence[EnqueuedMessage]:
+        """
+        Publish messages in batches, waiting on the broker's confirms for a whole
+        batch at once rather than for each message in turn
+        """
+        routing_key = self.queue.name
+        if delay_s > 0:
+            routing_key = await self._declare_delay_queue(delay_s)
+
+        published: t.List[EnqueuedMessage] = []
+        batch_size = config.broker.publish_batch_size
+        for i in range(0, len(messages), batch_size):
+            batch = [
+                EnqueuedMessage.from_string(
+                    m,
+                    {
+                        **(headers or {}),
+                        **(message_headers[n] if message_headers else {}),
+                    },
+                )
+                for n, m in enumerate(messages[i : i + batch_size], start=i)
+            ]
+            await self._publish_batch(*batch, routing_key=routing_key)
+            published.extend(batch)
+        return published
+
+    async def _declare_delay_queue(self, delay_s: float) -> str:
+        """
+        Declares a queue without consumers whose messages expire after the delay
+        and are then dead lettered onto the job queue. There is a queue for each
+        delay so that messages are never held up behind longer delays.
+        """
+        delay_ms = max(1, round(delay_s * 1000))
+        name = f"{self.queue.name}.delay.{delay_ms}"
+        # Declaring the queue on every publish keeps it from expiring while
+        # it is in use
+        await self.channel.declare_queue(
+            name,
+            durable=True,
+            arguments={
+                "x-message-ttl": delay_ms,
+                "x-dead-letter-exchange": "",
+                "x-dead-letter-routing-key": self.queue.name,
+                "x-expires": delay_ms + DELAY_QUEUE_EXPIRY_MS,
+            },
+        )
+        return name
+
+    async def _publish_batch(self, *messages: EnqueuedMessage, routing_key: str):
         assert self.channel.default_exchange is not None
 
-        published = []
-        for m in messages:
-            enqueued_message = EnqueuedMessage.from_string(m)
-            await self.channel.default_exchange.publish(
-                enqueued_message.message,
-                self.queue.name,
-            )
-            published.append(enqueued_message)
-        return published
+        confirmations = await asyncio.gather(
+            *[
+                self.channel.default_exchange.publish(
+                    m.message,
+                    routing_key,
+                    timeout=config.broker.publish_timeout_s,
+                )
+                for m in messages
+            ],
+            return_exceptions=True,
+        )
+        for m, confirmation in zip(messages, confirmations):
+            # Nacks are raised as exceptions and unroutable messages are
+            # returned to us rather than acked
+            m.confirmed = isinstance(confirmation, spec.Basic.Ack)
+            if not m.confirmed:
+                logger.warning(
+                    "Message was not confirmed by the broker",
+                    payload=m.payload,
+                    confirmation=repr(confirmation),
+                )
+
+    async def _start_consuming(self):
+        if self.consumer_tag is None:
+            self.consumer_tag = await self.queue.consume(self._on_message)
+
+    async def _on_message(self, message: aio_pika.IncomingMessage):
+        await self.deliveries.put(DequeuedMessage.from_message(message))
+
+    async def consume(self) -> t.AsyncIterator[DequeuedMessage]:
+        await self._start_consuming()
+        while True:
+            yield await self.deliveries.get()
 
     async def get(self) -> DequeuedMessage:
         """
         Retrieve a message from the Queue, or block until one is available
         """
-        while True:
-            try:
-                message = await self.queue.get(timeout=1, fail=True)
-            except aio_pika.exceptions.QueueEmpty:
-                await asyncio.sleep(1)
-            else:
-                break
-
-        assert message is not None
-        return DequeuedMessage.from_message(message)
+        await self._start_consuming()
+        return await self.deliveries.get()
 
-    async def drain(self, limit: int = 100) -> t.Sequence[DequeuedMessage]:
+    async def drain(
+        self, limit: int = 100, max_wait_ms: int = 0
+    ) -> t.Sequence[DequeuedMessage]:
         messages = [await self.get()]
 
-        while True:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + max_wait_ms / 1000
+        while len(messages) < limit:
+            remaining = deadline - loop.time()
             try:
-                message = await self.queue.get(timeout=1, fail=True)
-            except aio_pika.exceptions.QueueEmpty:
-                return messages
-            else:
-                assert message is not None
-                dm = DequeuedMessage.from_message(message)
-                messages.append(dm)
-                if len(messages) == limit:
-                    return messages
+                if remaining > 0:
+                    m = await asyncio.wait_for(self.deliveries.get(), remaining)
+                else:
+                    m = self.deliveries.get_nowait()
+            except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                break
+            messages.append(m)
+        return messages
 
     async def ack(self, *messages: DequeuedMessage):
         for m in messages:
             m.message.ack()
 
     async def shutdown(self):
+        if self.consumer_tag is not None:
+            await self.queue.cancel(self.consumer_tag)
         await self.channel.close()
@@ -1,5 +0,0 @@
-from job_scheduler.cache.base import ScheduleCache
-from job_scheduler.cache.fake import FakeScheduleCache
-from job_scheduler.cache.redis import RedisScheduleCache
-
-all = ["ScheduleCache", "RedisScheduleCache", "FakeScheduleCache"]
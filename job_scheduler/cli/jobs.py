@@ -23,14 +23,25 @@ def view(
     job_id: t.Optional[uuid.UUID] = typer.Option(
         None, help="A specific job occurence to look up"
     ),
+    limit: t.Optional[int] = typer.Option(
+        None, help="The max number of jobs to display", min=1
+    ),
+    before: t.Optional[str] = typer.Option(
+        None,
+        help="Only display jobs which ran before this time. Use the ran_at of "
+        "the last job displayed to view the next page",
+    ),
     output_format: OutputFormatChoices = OutputFormatOption,
 ):
     """
-    View jobs associated with a Schedule
+    View jobs associated with a Schedule, newest first
     """
     endpoint = f"{get_service_addr()}/schedule/{schedule_id}/jobs"
+    params = {}
     if job_id is not None:
         endpoint += f"/{job_id}"
+    else:
+        params = {"limit": limit, "before": before}
 
-    output = resilient_request(requests.get, endpoint)
+    output = resilient_request(requests.get, endpoint, params=params)
     terminal_display(output, output_format)
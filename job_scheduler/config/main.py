@@ -5,12 +5,38 @@ import environ
 class API:
     host = environ.var(default="127.0.0.1")
     port = environ.var(default=8000, converter=int)
+    jobs_page_size = environ.var(default=100, converter=int)
+    # Batch requests are validated and written this many schedules at a time
+    batch_chunk_size = environ.var(default=500, converter=int)
 
 
 @environ.config
-class Cache:
-    url = environ.var(default="redis://localhost")
-    ttl_s = environ.var(default=10, converter=int)
+class Database:
+    # Clients wait for a free connection once this many are open
+    max_connections = environ.var(default=50, converter=int)
+    health_check_interval_s = environ.var(default=30, converter=int)
+    # Changing the number of shards requires re-indexing with `just migrate`
+    shards = environ.var(default=1, converter=int)
+    # The format new data is written in, data in either format can be read
+    codec = environ.var(default="msgpack")
+
+    @codec.validator
+    def _check_codec(self, attr, value):
+        valid_values = ["json", "msgpack"]
+        if value not in valid_values:
+            raise ValueError(
+                f"Invalid value for {attr}: {value}. Supported values are {valid_values}"
+            )
+
+
+@environ.config
+class Jobs:
+    # Either limit can be disabled by setting it to 0
+    history_max_count = environ.var(default=1000, converter=int)
+    history_max_age_s = environ.var(default=0, converter=int)
+    # The jitter window of schedules which don't set their own. It should be
+    # shorter than the time between a schedule's runs.
+    jitter_s = environ.var(default=0, converter=float)
 
 
 @environ.config
@@ -18,10 +44,80 @@ class Broker:
     url = environ.var(default="amqp://localhost")
     queue_name = environ.var(default="jobs")
     prefetch_count = environ.var(default=100, converter=int)
+    publish_batch_size = environ.var(default=1000, converter=int)
+    publish_timeout_s = environ.var(default=5, converter=float)
+    batch_max_size = environ.var(default=100, converter=int)
+    batch_max_wait_ms = environ.var(default=50, converter=int)
     username = environ.var(default="guest")
     password = environ.var(default="guest")
 
 
+@environ.config
+class Scheduler:
+    # Ticks fall on multiples of the interval, wall clock time
+    tick_interval_s = environ.var(default=1, converter=float)
+    # The longest an idle scheduler sleeps before checking the index again
+    max_idle_s = environ.var(default=60, converter=float)
+    claim_lease_s = environ.var(default=10, converter=int)
+    page_size = environ.var(default=500, converter=int)
+    # Schedules due this soon are claimed early and queued at the moment they
+    # are due from an in-memory timing wheel, or as soon as they are due when 0.
+    # Together with the spread it must stay within the claim lease.
+    lookahead_s = environ.var(default=2, converter=float)
+    wheel_resolution_ms = environ.var(default=10, converter=int)
+    # Schedules due at the same moment are queued across this many seconds. It
+    # adds to any jitter, with each schedule's two offsets drawn independently.
+    dispatch_spread_s = environ.var(default=0, converter=float)
+    # "sharded" spreads the index's shards across every running scheduler and
+    # "leader" has a single scheduler run while the others stand by
+    coordination = environ.var(default="none")
+    shard_lease_s = environ.var(default=5, converter=float)
+    # A standby takes over at most this long after a leader is lost
+    leader_lease_s = environ.var(default=0.75, converter=float)
+
+    @lookahead_s.validator
+    def _check_lookahead(self, attr, value):
+        # Schedules held in the wheel would be claimed again before their release
+        if value + self.dispatch_spread_s >= self.claim_lease_s:
+            raise ValueError(
+                f"Invalid value for {attr}: {value}. Together with the dispatch "
+                f"spread it must be shorter than the claim lease"
+            )
+
+    @coordination.validator
+    def _check_coordination(self, attr, value):
+        valid_values = ["none", "sharded", "leader"]
+        if value not in valid_values:
+            raise ValueError(
+                f"Invalid value for {attr}: {value}. Supported values are {valid_values}"
+            )
+
+
+@environ.config
+class Runner:
+    concurrency = environ.var(default=100, converter=int)
+    timeout_s = environ.var(default=1, converter=float)
+    # Longer response bodies are truncated before they are stored
+    max_response_bytes = environ.var(default=64 * 1024, converter=int)
+    # Setting either connection limit to 0 removes it
+    connection_limit = environ.var(default=200, converter=int)
+    connection_limit_per_host = environ.var(default=50, converter=int)
+    keepalive_timeout_s = environ.var(default=30, converter=float)
+    dns_cache_ttl_s = environ.var(default=300, converter=int)
+    # The most concurrent callbacks to any one host, or no limit if 0. Jobs for
+    # a host at its limit are queued again to be tried after the delay.
+    host_concurrency = environ.var(default=20, converter=int)
+    host_busy_delay_s = environ.var(default=1, converter=float)
+    # A host's calls fail fast for the cool down once the failure rate of its
+    # last breaker_window calls reaches the threshold
+    breaker_window = environ.var(default=20, converter=int)
+    breaker_min_calls = environ.var(default=10, converter=int)
+    breaker_failure_rate = environ.var(default=0.5, converter=float)
+    breaker_cooldown_s = environ.var(default=30, converter=float)
+    # How often the connection pool's usage per host is logged, or never if 0
+    pool_metrics_interval_s = environ.var(default=60, converter=float)
+
+
 @environ.config
 class DummyService:
     host = environ.var(default="127.0.0.1")
@@ -57,9 +153,12 @@ class AppConfig:
     dev_mode = environ.bool_var(default=False)
 
     api = environ.group(API)
+    db = environ.group(Database)
     dummy = environ.group(DummyService)
     broker = environ.group(Broker)
-    cache = environ.group(Cache)
+    jobs = environ.group(Jobs)
+    scheduler = environ.group(Scheduler)
+    runner = environ.group(Runner)
     logging = environ.group(Logging)
 
 
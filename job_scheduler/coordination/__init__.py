@@ -0,0 +1,12 @@
+from job_scheduler.coordination.base import LeaderElection, ShardCoordinator
+from job_scheduler.coordination.fake import FakeLeaderElection, FakeShardCoordinator
+from job_scheduler.coordination.redis import RedisLeaderElection, RedisShardCoordinator
+
+all = [
+    "ShardCoordinator",
+    "FakeShardCoordinator",
+    "RedisShardCoordinator",
+    "LeaderElection",
+    "FakeLeaderElection",
+    "RedisLeaderElection",
+]
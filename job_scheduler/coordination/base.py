@@ -0,0 +1,61 @@
+from __future__ import annotations
+
+import asyncio
+import typing as t
+from abc import ABC, abstractclassmethod, abstractmethod
+
+from job_scheduler.db.types import Fence
+
+
+class ShardCoordinator(ABC):
+    @abstractmethod
+    async def assigned_shards(self) -> t.Sequence[int]:
+        """
+        Renews this replica's membership and its leases on shards, returning the
+        shards it holds a lease on. It must be called more often than a lease
+        lasts for a replica to keep its shards.
+        """
+        pass
+
+    @abstractmethod
+    async def leave(self) -> None:
+        """
+        Gives up every shard held so that other replicas can take them over
+        without waiting for the leases to expire
+        """
+        pass
+
+    @abstractclassmethod
+    def get_coordinator(cls):
+        pass
+
+
+class LeaderElection(ABC):
+    # The fencing token of the current term while this replica leads
+    fence: t.Optional[Fence] = None
+
+    @abstractmethod
+    async def campaign(self) -> t.Optional[Fence]:
+        """
+        Takes or renews leadership if no other replica holds it, returning the
+        term's fencing token while this replica leads. It must be called more
+        often than the leadership lease lasts for a leader to keep leading.
+        """
+        pass
+
+    @abstractmethod
+    async def resign(self) -> None:
+        """
+        Gives up leadership so that a standby can take over without waiting for
+        the lease to expire
+        """
+        pass
+
+    async def keep_campaigning(self, interval_s: float) -> None:
+        while True:
+            await self.campaign()
+            await asyncio.sleep(interval_s)
+
+    @abstractclassmethod
+    def get_election(cls):
+        pass
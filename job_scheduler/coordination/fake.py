@@ -0,0 +1,47 @@
+from __future__ import annotations
+
+import typing as t
+
+from job_scheduler.config import config
+from job_scheduler.coordination.base import LeaderElection, ShardCoordinator
+from job_scheduler.db.types import Fence
+
+
+class FakeShardCoordinator(ShardCoordinator):
+    """
+    A lone replica which always holds every shard
+    """
+
+    def __init__(self, shards: int):
+        self.shards = shards
+
+    async def assigned_shards(self) -> t.Sequence[int]:
+        return list(range(self.shards))
+
+    async def leave(self) -> None:
+        pass
+
+    @classmethod
+    async def get_coordinator(cls) -> FakeShardCoordinator:
+        return cls(config.db.shards)
+
+
+class FakeLeaderElection(LeaderElection):
+    """
+    A lone replica which always leads the same term
+    """
+
+    def __init__(self):
+        self.leading = True
+
+    async def campaign(self) -> t.Optional[Fence]:
+        self.fence = Fence("leader", 1) if self.leading else None
+        return self.fence
+
+    async def resign(self) -> None:
+        self.leading = False
+        self.fence = None
+
+    @classmethod
+    async def get_election(cls) -> FakeLeaderElection:
+        return cls()
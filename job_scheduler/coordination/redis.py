@@ -0,0 +1,197 @@
+from __future__ import annotations
+
+import typing as t
+from uuid import uuid4
+
+import aioredis
+import structlog
+
+from job_scheduler.config import config
+from job_scheduler.coordination.base import LeaderElection, ShardCoordinator
+from job_scheduler.db.redis import get_redis_connection
+from job_scheduler.db.types import Fence
+
+logger = structlog.get_logger(__name__)
+
+# Renews a member's heartbeat and drops members whose heartbeat has expired,
+# returning the live members. Redis' clock is used so that replicas with skewed
+# clocks agree on who is live.
+#   KEYS[1]: the members
+#   ARGV[1]: the member, ARGV[2]: the heartbeat's lease in milliseconds
+_HEARTBEAT_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+redis.call('ZADD', KEYS[1], now + tonumber(ARGV[2]), ARGV[1])
+return redis.call('ZRANGE', KEYS[1], 0, -1)
+"""
+
+# Takes or renews a lease for its owner if nobody else holds it, or gives it up
+# if the owner holds it. Returns 1 if the owner holds the lease afterwards.
+#   KEYS[1]: the lease
+#   ARGV[1]: the owner, ARGV[2]: the lease in milliseconds
+#   ARGV[3]: '1' to hold the lease or '0' to give it up
+_LEASE_SCRIPT = """
+local owner = redis.call('GET', KEYS[1])
+if ARGV[3] == '1' then
+    if owner == ARGV[1] then
+        redis.call('PEXPIRE', KEYS[1], ARGV[2])
+        return 1
+    elseif not owner then
+        redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+        return 1
+    end
+elseif owner == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class RedisShardCoordinator(ShardCoordinator):
+    """
+    Spreads shards evenly across the live replicas. Each replica is assigned
+    the shards whose number matches its position among the sorted members, and
+    only works a shard while it holds the shard's lease. When replicas join or
+    leave, a replica gives up the shards no longer assigned to it and the new
+    owner takes them once they are free, so a shard is never held twice.
+    """
+
+    def __init__(self, redis: aioredis.Redis, shards: int, lease_s: float):
+        self.redis = redis
+        self.shards = shards
+        self.lease_ms = int(lease_s * 1000)
+        self.member = uuid4().hex
+        self.members_key = "scheduler_members"
+        self.lease_namespace = "shard_owner"
+        self._heartbeat_script = self.redis.register_script(_HEARTBEAT_SCRIPT)
+        self._lease_script = self.redis.register_script(_LEASE_SCRIPT)
+        self._held: t.Sequence[int] = []
+
+    def lease_key(self, shard: int) -> str:
+        # Shares the hash tag of the shard's index
+        return f"{self.lease_namespace}{{{shard}}}"
+
+    async def assigned_shards(self) -> t.Sequence[int]:
+        members = await self._heartbeat_script(
+            keys=[self.members_key], args=[self.member, self.lease_ms]
+        )
+        position = sorted(members).index(self.member.encode())
+        assigned = {s for s in range(self.shards) if s % len(members) == position}
+
+        held = await self._set_leases(assigned)
+        if held != self._held:
+            logger.info("Shard assignment changed", shards=held, n_members=len(members))
+        self._held = held
+        return held
+
+    async def _set_leases(self, assigned: t.Collection[int]) -> t.Sequence[int]:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for shard in range(self.shards):
+                await self._lease_script(
+                    keys=[self.lease_key(shard)],
+                    args=[
+                        self.member,
+                        self.lease_ms,
+                        "1" if shard in assigned else "0",
+                    ],
+                    client=pipe,
+                )
+            results = await pipe.execute()
+        return [shard for shard, held in enumerate(results) if held == 1]
+
+    async def leave(self) -> None:
+        await self._set_leases([])
+        await self.redis.zrem(self.members_key, self.member)
+        self._held = []
+
+    @classmethod
+    async def get_coordinator(
+        cls, redis: t.Optional[aioredis.Redis] = None
+    ) -> RedisShardCoordinator:
+        return cls(
+            redis or await get_redis_connection(),
+            config.db.shards,
+            config.scheduler.shard_lease_s,
+        )
+
+
+# Takes leadership if nobody holds it, starting a new term with the next
+# fencing token, or renews it if the candidate already leads. Returns the
+# term's token while the candidate leads.
+#   KEYS[1]: the leader, KEYS[2]: the last fencing token handed out
+#   ARGV[1]: the candidate, ARGV[2]: the lease in milliseconds
+_CAMPAIGN_SCRIPT = """
+local leader = redis.call('HGET', KEYS[1], 'member')
+if leader == ARGV[1] then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    return tonumber(redis.call('HGET', KEYS[1], 'token'))
+elseif not leader then
+    local token = redis.call('INCR', KEYS[2])
+    redis.call('HSET', KEYS[1], 'member', ARGV[1], 'token', token)
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    return token
+end
+return false
+"""
+
+# Gives up leadership if the member still leads
+#   KEYS[1]: the leader
+#   ARGV[1]: the member
+_RESIGN_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'member') == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+end
+"""
+
+
+class RedisLeaderElection(LeaderElection):
+    """
+    Elects a single leader with a lease in Redis. Each term is given a fencing
+    token greater than any before it. Claims made on behalf of a term are
+    rejected once the lease holds a different token, and runners drop the jobs
+    a term queued for runs which a newer term has claimed since, so a leader
+    which stalls past its lease cannot act alongside the replica which took
+    over.
+    """
+
+    def __init__(self, redis: aioredis.Redis, lease_s: float):
+        self.redis = redis
+        self.lease_ms = int(lease_s * 1000)
+        self.member = uuid4().hex
+        self.leader_key = "scheduler_leader"
+        self.token_key = "scheduler_leader_token"
+        self._campaign_script = self.redis.register_script(_CAMPAIGN_SCRIPT)
+        self._resign_script = self.redis.register_script(_RESIGN_SCRIPT)
+
+    async def campaign(self) -> t.Optional[Fence]:
+        try:
+            token = await self._campaign_script(
+                keys=[self.leader_key, self.token_key],
+                args=[self.member, self.lease_ms],
+            )
+        except aioredis.RedisError:
+            # Leadership can't be confirmed, so stop acting on it
+            logger.exception("Unable to renew leadership")
+            token = None
+
+        fence = None if token is None else Fence(self.leader_key, token)
+        if fence != self.fence:
+            if fence is None:
+                logger.info("Lost leadership")
+            else:
+                logger.info("Became leader", fencing_token=fence.token)
+        self.fence = fence
+        return fence
+
+    async def resign(self) -> None:
+        await self._resign_script(keys=[self.leader_key], args=[self.member])
+        self.fence = None
+
+    @classmethod
+    async def get_election(
+        cls, redis: t.Optional[aioredis.Redis] = None
+    ) -> RedisLeaderElection:
+        return cls(
+            redis or await get_redis_connection(), config.scheduler.leader_lease_s
+        )
@@ -0,0 +1,7 @@
+from job_scheduler.cron.expression import (
+    CronExpression,
+    compile_expression,
+    next_fire_times,
+)
+
+all = ["CronExpression", "compile_expression", "next_fire_times"]
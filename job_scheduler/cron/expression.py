@@ -0,0 +1,159 @@
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone, tzinfo
+from functools import lru_cache
+from typing import DefaultDict, List, Optional, Sequence, Tuple, Union
+
+import pytz
+from croniter import croniter
+
+CACHE_SIZE = 4096
+
+# Matches are searched for this many years ahead before deferring to croniter,
+# which is enough to find a leap day no matter which day of the week it is
+_MAX_YEARS_AHEAD = 8
+
+
+def _to_bits(values: Sequence[Union[int, str]], low: int, high: int) -> int:
+    if values == ["*"]:
+        values = list(range(low, high + 1))
+
+    bits = 0
+    for v in values:
+        bits |= 1 << int(v)
+    return bits
+
+
+def _next_bit(bits: int, start: int) -> Optional[int]:
+    """
+    Returns the lowest set bit at or above start
+    """
+    remaining = bits >> start
+    if remaining == 0:
+        return None
+    return start + (remaining & -remaining).bit_length() - 1
+
+
+def _is_fixed_offset(tz: Optional[tzinfo]) -> bool:
+    return tz is None or isinstance(tz, timezone) or tz is pytz.utc
+
+
+class CronExpression:
+    """
+    A cron expression parsed once into bitsets of the minutes, hours, days of
+    the month, months and days of the week it fires on.
+
+    Expressions using syntax the bitsets cannot express (seconds, last day of
+    the month or nth weekday of the month) and start times in time zones with
+    daylight saving transitions are evaluated by croniter instead.
+    """
+
+    def __init__(self, expression: str):
+        self.expression = expression
+
+        expanded, nth_weekday_of_month = croniter.expand(expression)
+        self.uses_croniter = (
+            len(expanded) != 5 or "l" in expanded[2] or len(nth_weekday_of_month) > 0
+        )
+        if self.uses_croniter:
+            return
+
+        minutes, hours, days, months, weekdays = expanded
+        self.minutes = _to_bits(minutes, 0, 59)
+        self.hours = _to_bits(hours, 0, 23)
+        self.days = _to_bits(days, 1, 31)
+        self.months = _to_bits(months, 1, 12)
+        self.weekdays = _to_bits(weekdays, 0, 6)
+        # As in cron, a day matches either field when both are restricted
+        self.any_day = days == ["*"]
+        self.any_weekday = weekdays == ["*"]
+
+    def next_after(self, start: datetime) -> datetime:
+        """
+        Returns the first time strictly after start that the expression fires
+        on. Naive start times are taken to be in UTC and give naive results.
+        """
+        if self.uses_croniter or not _is_fixed_offset(start.tzinfo):
+            return croniter(self.expression, start).get_next(datetime)
+
+        wall_time = start.replace(tzinfo=None, second=0, microsecond=0)
+        match = self._next_match(wall_time + timedelta(minutes=1))
+        if match is None:
+            return croniter(self.expression, start).get_next(datetime)
+        return match.replace(tzinfo=start.tzinfo)
+
+    def _matches_day(self, t: datetime) -> bool:
+        in_days = bool(self.days >> t.day & 1)
+        in_weekdays = bool(self.weekdays >> (t.isoweekday() % 7) & 1)
+        if self.any_day:
+            return in_weekdays
+        if self.any_weekday:
+            return in_days
+        return in_days or in_weekdays
+
+    def _next_match(self, t: datetime) -> Optional[datetime]:
+        last_year = t.year + _MAX_YEARS_AHEAD
+        while t.year <= last_year:
+            if not self.months >> t.month & 1:
+                month = _next_bit(self.months, t.month)
+                if month is None:
+                    t = datetime(t.year + 1, 1, 1)
+                else:
+                    t = datetime(t.year, month, 1)
+                continue
+
+            if not self._matches_day(t):
+                t = datetime(t.year, t.month, t.day) + timedelta(days=1)
+                continue
+
+            hour = _next_bit(self.hours, t.hour)
+            if hour is None:
+                t = datetime(t.year, t.month, t.day) + timedelta(days=1)
+                continue
+            if hour != t.hour:
+                t = t.replace(hour=hour, minute=0)
+
+            minute = _next_bit(self.minutes, t.minute)
+            if minute is None:
+                t = t.replace(minute=0) + timedelta(hours=1)
+                continue
+            return t.replace(minute=minute)
+        return None
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def compile_expression(expression: str) -> CronExpression:
+    """
+    Returns the compiled form of an expression, reusing it for every schedule
+    which shares the same expression.
+    """
+    return CronExpression(expression)
+
+
+def next_fire_times(
+    expressions: Sequence[str], starts: Sequence[datetime]
+) -> List[datetime]:
+    """
+    Returns the next fire time of each expression after its paired start time.
+
+    Pairs are grouped by expression and evaluated in order of start time, so
+    a start which falls before the previous pair's fire time reuses it rather
+    than searching again. After an outage most overdue schedules start from
+    the same moment, which leaves one search per distinct expression.
+    """
+    assert len(expressions) == len(starts)
+
+    groups: DefaultDict[Tuple[str, Optional[tzinfo]], List[int]] = defaultdict(list)
+    for i, (expression, start) in enumerate(zip(expressions, starts)):
+        groups[(expression, start.tzinfo)].append(i)
+
+    results: List[datetime] = list(starts)
+    for (expression, _), indices in groups.items():
+        cron = compile_expression(expression)
+        indices.sort(key=lambda i: starts[i])
+
+        fire_time: Optional[datetime] = None
+        for i in indices:
+            if fire_time is None or starts[i] >= fire_time:
+                fire_time = cron.next_after(starts[i])
+            results[i] = fire_time
+    return results
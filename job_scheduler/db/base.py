@@ -1,9 +1,22 @@
+import zlib
 from abc import ABC, abstractclassmethod, abstractmethod
+from typing import Optional
 
-from job_scheduler.db.types import JobRepoItem, ScheduleRepoItem
+from job_scheduler.db.types import ClaimedRun, Fence, JobRepoItem, ScheduleRepoItem
+
+
+def shard_of(key: str, shards: int) -> int:
+    """
+    Returns the shard of the schedule index which a key belongs to. The hash is
+    stable across processes so that every component agrees on it.
+    """
+    return zlib.crc32(key.encode()) % shards
 
 
 class ScheduleRepository(ABC):
+    # The number of shards the index of schedules to run is split across
+    shards: int = 1
+
     @abstractmethod
     def add(self, *items: ScheduleRepoItem):
         pass
@@ -21,7 +34,74 @@ class ScheduleRepository(ABC):
         pass
 
     @abstractmethod
-    def get_range(self, min: float, max: float):
+    def complete(self, *items: ScheduleRepoItem):
+        """
+        Atomically write each item which still exists and whose stored value
+        matches its expected value, returning the keys of the items written.
+        """
+        pass
+
+    @abstractmethod
+    def get_range(
+        self, min: float, max: float, offset: int = 0, limit: Optional[int] = None
+    ):
+        pass
+
+    @abstractmethod
+    def claim(
+        self,
+        max: float,
+        lease_s: int,
+        cursor: int = 0,
+        limit: Optional[int] = None,
+        shard: int = 0,
+        fence: Optional[Fence] = None,
+    ):
+        """
+        Atomically select the items in a shard scored at or below max which have
+        not already been claimed and hold a claim on them for lease_s seconds.
+        Only the key and score of each claimed item are returned. When given a
+        fence, nothing is claimed unless its token is still current.
+
+        Examines at most limit items starting from cursor and returns the cursor
+        to resume from alongside the claimed items. A returned cursor of 0 means
+        that there are no more items to examine.
+        """
+        pass
+
+    @abstractmethod
+    def release(self, *keys: str):
+        """
+        Drop any claims held on the given items so that they can be claimed again
+        """
+        pass
+
+    @abstractmethod
+    def hold(self, lease_s: float, *runs: ClaimedRun):
+        """
+        Extend the claims on the given runs to last lease_s seconds from now,
+        taking them again if they have lapsed, and return the keys of the runs
+        held. A run can only be held while its item is still scored at the
+        run's score, which it no longer is once the run has been completed or
+        the item changed, and while no newer term than the run's has claimed
+        it. Claims are never shortened.
+        """
+        pass
+
+    @abstractmethod
+    def next_due(self, *shards: int):
+        """
+        Look up the lowest score in the given shards, whether or not it has been
+        claimed, or None if they are empty
+        """
+        pass
+
+    @abstractmethod
+    def wait_for_due(self, timeout_s: float):
+        """
+        Block until an active item is added or updated, returning its score, or
+        return None once timeout_s seconds have passed
+        """
         pass
 
     @property
@@ -29,6 +109,10 @@ class ScheduleRepository(ABC):
     async def size(self):
         pass
 
+    @abstractmethod
+    def shutdown(self):
+        pass
+
     @abstractclassmethod
     def get_repo(cls):
         pass
@@ -44,7 +128,13 @@ class JobRepository(ABC):
         pass
 
     @abstractmethod
-    def get_by_parent(self, *keys: str):
+    def get_by_parent(
+        self, *keys: str, before: Optional[float] = None, limit: Optional[int] = None
+    ):
+        """
+        Look up the items belonging to each key, newest first, which were added
+        before the given time
+        """
         pass
 
     @property
@@ -52,6 +142,10 @@ class JobRepository(ABC):
     async def size(self) -> int:
         pass
 
+    @abstractmethod
+    def shutdown(self):
+        pass
+
     @abstractclassmethod
     def get_repo(cls):
         pass
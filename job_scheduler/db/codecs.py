@@ -0,0 +1,124 @@
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Any, Mapping, Optional, Tuple, Type, TypeVar
+from uuid import UUID
+
+import msgpack
+from pydantic import BaseModel
+
+from job_scheduler.config import config
+
+M = TypeVar("M", bound=BaseModel)
+
+
+class Codec(ABC):
+    """
+    Converts models to and from the bytes stored by the repositories. Every
+    encoding starts with the codec's marker byte so that data can be decoded
+    regardless of which codec wrote it.
+
+    Codecs which support it store extra values alongside a model's fields,
+    under names the model doesn't use, which decode_with_extra reads back.
+    """
+
+    marker: int
+
+    @abstractmethod
+    def encode(
+        self, model: BaseModel, extra: Optional[Mapping[str, Any]] = None
+    ) -> bytes:
+        pass
+
+    @abstractmethod
+    def decode_with_extra(
+        self, model_cls: Type[M], data: bytes
+    ) -> Tuple[M, Mapping[str, Any]]:
+        pass
+
+    def decode(self, model_cls: Type[M], data: bytes) -> M:
+        model, _ = self.decode_with_extra(model_cls, data)
+        return model
+
+
+class JsonCodec(Codec):
+    """
+    The original format, a model's JSON without a version byte. Extra values
+    are not stored.
+    """
+
+    marker = ord("{")
+
+    def encode(
+        self, model: BaseModel, extra: Optional[Mapping[str, Any]] = None
+    ) -> bytes:
+        return model.json().encode()
+
+    def decode_with_extra(
+        self, model_cls: Type[M], data: bytes
+    ) -> Tuple[M, Mapping[str, Any]]:
+        return model_cls.parse_raw(data), {}
+
+
+def _pack_default(obj: Any) -> Any:
+    if isinstance(obj, UUID):
+        return obj.bytes
+    if isinstance(obj, datetime):
+        if obj.tzinfo is None:
+            return obj.isoformat()
+        return msgpack.Timestamp.from_datetime(obj)
+    raise TypeError(f"Cannot serialize {obj!r}")
+
+
+class MsgpackCodec(Codec):
+    """
+    A version byte followed by the model's fields as msgpack. UUIDs are packed
+    as their raw bytes and UTC datetimes as msgpack timestamps.
+    """
+
+    marker = 1
+
+    def encode(
+        self, model: BaseModel, extra: Optional[Mapping[str, Any]] = None
+    ) -> bytes:
+        fields = model.dict()
+        if extra is not None:
+            fields.update(extra)
+        packed = msgpack.packb(fields, default=_pack_default)
+        return bytes([self.marker]) + packed
+
+    def decode_with_extra(
+        self, model_cls: Type[M], data: bytes
+    ) -> Tuple[M, Mapping[str, Any]]:
+        fields = msgpack.unpackb(data[1:], timestamp=3)
+        extra = {
+            k: fields.pop(k) for k in list(fields) if k not in model_cls.__fields__
+        }
+        return model_cls.parse_obj(fields), extra
+
+
+CODECS: Mapping[str, Codec] = {"json": JsonCodec(), "msgpack": MsgpackCodec()}
+_CODECS_BY_MARKER = {c.marker: c for c in CODECS.values()}
+
+
+def get_codec(name: Optional[str] = None) -> Codec:
+    """
+    Returns the named codec or, by default, the one configured for writes
+    """
+    return CODECS[name or config.db.codec]
+
+
+def encode(model: BaseModel, extra: Optional[Mapping[str, Any]] = None) -> bytes:
+    return get_codec().encode(model, extra)
+
+
+def decode(model_cls: Type[M], data: bytes) -> M:
+    model, _ = decode_with_extra(model_cls, data)
+    return model
+
+
+def decode_with_extra(model_cls: Type[M], data: bytes) -> Tuple[M, Mapping[str, Any]]:
+    try:
+        codec = _CODECS_BY_MARKER[data[0]]
+    except (IndexError, KeyError):
+        raise ValueError(f"Unable to decode {model_cls.__name__} in unknown format")
+    return codec.decode_with_extra(model_cls, data)
@@ -1,44 +1,164 @@
 from __future__ import annotations
 
+import asyncio
+import time
 from collections import defaultdict
-from typing import MutableMapping, Sequence
+from typing import MutableMapping, Optional, Sequence, Tuple
 
-from job_scheduler.db.base import JobRepository, ScheduleRepository
-from job_scheduler.db.types import JobRepoItem, JsonMap, ScheduleRepoItem
+from job_scheduler.config import config
+from job_scheduler.db.base import JobRepository, ScheduleRepository, shard_of
+from job_scheduler.db.types import (
+    ClaimedRun,
+    Fence,
+    JobRepoItem,
+    JsonMap,
+    ScheduleRepoItem,
+)
 
 
 class FakeScheduleRepository(ScheduleRepository):
     scored_data: JsonMap = {}
+    paused_data: JsonMap = {}
     data: JsonMap = {}
+    # The score, expiry and fencing token of each claim
+    claims: MutableMapping[str, Tuple[float, float, int]] = {}
+
+    def _index(self, item: ScheduleRepoItem):
+        if item.active:
+            self.paused_data.pop(item.id, None)
+            self.scored_data[item.id] = item.priority
+        else:
+            self.scored_data.pop(item.id, None)
+            self.paused_data[item.id] = item.priority
+
+    def __init__(self):
+        self.shards = config.db.shards
 
     async def add(self, *items: ScheduleRepoItem) -> None:
         for i in items:
             self.data[i.id] = i.schedule
-            self.scored_data[i.id] = i.priority
+            self._index(i)
 
-    async def get(self, *keys: str) -> Sequence[str]:
-        return [self.data.get(k, "") for k in keys if self.data.get(k)]
+    async def get(self, *keys: str) -> Sequence[bytes]:
+        return [self.data[k] for k in keys if self.data.get(k)]
 
-    async def update(self, *items: ScheduleRepoItem) -> Sequence[str]:
+    async def update(self, *items: ScheduleRepoItem) -> Sequence[bytes]:
         ret_val = []
         for i in items:
+            if i.id not in self.scored_data and i.id not in self.paused_data:
+                continue
             self.data[i.id] = i.schedule
-            self.scored_data[i.id] = i.priority
+            self._index(i)
             ret_val.append(i.schedule)
         return ret_val
 
     async def delete(self, *keys: str) -> None:
         for k in keys:
             self.data.pop(k, None)
+            self.scored_data.pop(k, None)
+            self.paused_data.pop(k, None)
 
-    async def get_range(self, min_val: float, max_val: float) -> Sequence[str]:
+    async def complete(self, *items: ScheduleRepoItem) -> Sequence[str]:
+        written = []
+        for i in items:
+            current = self.data.get(i.id)
+            if current is None:
+                continue
+            if i.expected is not None and current != i.expected:
+                continue
+            self.data[i.id] = i.schedule
+            if i.id in self.scored_data:
+                self.scored_data[i.id] = i.priority
+            written.append(i.id)
+        return written
+
+    async def get_range(
+        self,
+        min_val: float,
+        max_val: float,
+        offset: int = 0,
+        limit: Optional[int] = None,
+    ) -> Sequence[str]:
         sorted_data = sorted(self.scored_data.items(), key=lambda x: x[1])
 
         results = []
         for data in sorted_data:
             if min_val <= data[1] <= max_val:
                 results.append(data[0])
-        return results
+        if limit is None:
+            return results[offset:]
+        return results[offset : offset + limit]
+
+    async def claim(
+        self,
+        max_val: float,
+        lease_s: int,
+        cursor: int = 0,
+        limit: Optional[int] = None,
+        shard: int = 0,
+        fence: Optional[Fence] = None,
+    ) -> Tuple[int, Sequence[Tuple[str, float]]]:
+        # There is only ever one scheduler working against the fake
+        now = time.monotonic()
+        for c, (_, expires_at, _) in list(self.claims.items()):
+            if expires_at <= now:
+                self.claims.pop(c)
+
+        results = []
+        s_ids = [
+            s_id
+            for s_id in await self.get_range(float("-inf"), max_val)
+            if shard_of(s_id, self.shards) == shard
+        ]
+        if limit is None:
+            s_ids = s_ids[cursor:]
+        else:
+            s_ids = s_ids[cursor : cursor + limit]
+        for s_id in s_ids:
+            score = self.scored_data[s_id]
+            if s_id in self.claims and self.claims[s_id][0] == score:
+                continue
+            self.claims[s_id] = (score, now + lease_s, fence.token if fence else 0)
+            results.append((s_id, score))
+
+        if limit is not None and len(s_ids) == limit:
+            return cursor + limit, results
+        return 0, results
+
+    async def release(self, *keys: str) -> None:
+        for k in keys:
+            self.claims.pop(k, None)
+
+    async def hold(self, lease_s: float, *runs: ClaimedRun) -> Sequence[str]:
+        now = time.monotonic()
+        held = []
+        for r in runs:
+            score = self.scored_data.get(r.id)
+            if score is None or abs(score - r.score) >= 0.001:
+                continue
+            claim = self.claims.get(r.id)
+            if claim is not None and claim[1] <= now:
+                claim = None
+            if claim is not None and claim[0] == score and claim[2] > r.token:
+                # Left to the job queued by the newer term
+                continue
+            if claim is None or claim[0] != score or claim[1] < now + lease_s:
+                self.claims[r.id] = (score, now + lease_s, r.token)
+            held.append(r.id)
+        return held
+
+    async def next_due(self, *shards: int) -> Optional[float]:
+        scores = [
+            score
+            for s_id, score in self.scored_data.items()
+            if shard_of(s_id, self.shards) in shards
+        ]
+        return min(scores, default=None)
+
+    async def wait_for_due(self, timeout_s: float) -> Optional[float]:
+        # Nothing is written to the fake while a scheduler waits on it
+        await asyncio.sleep(timeout_s)
+        return None
 
     def __contains__(self, key: str):
         return key in self.data
@@ -47,6 +167,9 @@ class FakeScheduleRepository(ScheduleRepository):
     async def size(self):
         return len(self.data)
 
+    async def shutdown(self):
+        pass
+
     @classmethod
     def get_repo(cls) -> FakeScheduleRepository:
         return cls()
@@ -54,14 +177,26 @@ class FakeScheduleRepository(ScheduleRepository):
 
 class FakeJobRepository(JobRepository):
     def __init__(self):
-        self.by_parent: MutableMapping[str, set] = defaultdict(set)
-        self.jobs: MutableMapping[str, str] = dict()
+        self.by_parent: MutableMapping[str, MutableMapping[str, float]] = defaultdict(
+            dict
+        )
+        self.jobs: MutableMapping[str, bytes] = dict()
 
     async def add(self, *items: JobRepoItem):
         for i in items:
-            self.by_parent[i.schedule_id].add(i.job)
+            self.by_parent[i.schedule_id][i.id] = i.ran_at
             self.jobs[i.id] = i.job
 
+        max_age_s = config.jobs.history_max_age_s
+        oldest_kept = time.time() - max_age_s if max_age_s > 0 else float("-inf")
+        for parent in {i.schedule_id for i in items}:
+            history = sorted(self.by_parent[parent].items(), key=lambda x: -x[1])
+            max_count = config.jobs.history_max_count or len(history)
+            for n, (j_id, ran_at) in enumerate(history):
+                if n >= max_count or ran_at < oldest_kept:
+                    self.by_parent[parent].pop(j_id)
+                    self.jobs.pop(j_id)
+
     async def get(self, *keys: str):
         results = []
         for k in keys:
@@ -69,16 +204,30 @@ class FakeJobRepository(JobRepository):
             results.append(job)
         return results
 
-    async def get_by_parent(self, *keys: str):
+    async def get_by_parent(
+        self,
+        *keys: str,
+        before: Optional[float] = None,
+        limit: Optional[int] = None,
+    ):
         results = {}
         for k in keys:
-            results[k] = list(self.by_parent[k])
+            history = sorted(self.by_parent[k].items(), key=lambda x: -x[1])
+            jobs = [
+                self.jobs[j_id]
+                for j_id, ran_at in history
+                if before is None or ran_at < before
+            ]
+            results[k] = jobs[:limit]
         return results
 
     @property
     def size(self):
         pass
 
+    async def shutdown(self):
+        pass
+
     @classmethod
     def get_repo(cls) -> FakeJobRepository:
         return cls()
@@ -0,0 +1,178 @@
+"""
+Re-encodes stored schedules and jobs with the configured codec. Data written
+in any other format is rewritten in place, unless it changes in the meantime.
+
+Also moves schedules into the index shards they belong to for the configured
+number of shards, which should be done while no schedulers are running, and
+moves job histories kept in the original sets of job ids into sorted sets.
+"""
+import asyncio
+import time
+from typing import List, Optional, Type, Union
+
+import aioredis
+import structlog
+from pydantic import BaseModel
+
+from job_scheduler.api.models import Job, Schedule
+from job_scheduler.config import config
+from job_scheduler.db.base import shard_of
+from job_scheduler.db.codecs import Codec, decode, decode_with_extra, get_codec
+from job_scheduler.db.redis import (
+    RedisJobRepository,
+    RedisScheduleRepository,
+    get_redis_connection,
+)
+from job_scheduler.logging import setup_logging
+
+logger = structlog.get_logger(__name__)
+
+# Replaces each value which is unchanged from the one read, keeping its ttl.
+# Returns the number of values replaced.
+#   ARGV: a key, the expected value and its replacement for each value
+_REENCODE_SCRIPT = """
+local replaced = 0
+for i = 1, #ARGV, 3 do
+    local key, expected, value = ARGV[i], ARGV[i + 1], ARGV[i + 2]
+    if redis.call('GET', key) == expected then
+        local ttl = redis.call('PTTL', key)
+        if ttl > 0 then
+            redis.call('SET', key, value, 'PX', ttl)
+        else
+            redis.call('SET', key, value)
+        end
+        replaced = replaced + 1
+    end
+end
+return replaced
+"""
+
+MIGRATIONS = [("schedules", Schedule), ("jobs", Job)]
+
+
+async def migrate_namespace(
+    redis: aioredis.Redis,
+    namespace: str,
+    model_cls: Type[BaseModel],
+    codec: Codec,
+    batch_size: int = 500,
+) -> int:
+    script = redis.register_script(_REENCODE_SCRIPT)
+
+    async def reencode(keys: List[bytes]) -> int:
+        args: List[Union[bytes, str]] = []
+        for key, value in zip(keys, await redis.mget(*keys)):
+            if value is None or value[0] == codec.marker:
+                continue
+            args.extend(
+                [key, value, codec.encode(*decode_with_extra(model_cls, value))]
+            )
+        if len(args) == 0:
+            return 0
+        return await script(args=args)
+
+    migrated = 0
+    keys: List[bytes] = []
+    async for key in redis.scan_iter(match=f"{namespace}:*", count=batch_size):
+        keys.append(key)
+        if len(keys) == batch_size:
+            migrated += await reencode(keys)
+            keys = []
+    if len(keys) > 0:
+        migrated += await reencode(keys)
+    return migrated
+
+
+async def reshard_schedules(
+    repo: RedisScheduleRepository, batch_size: int = 500
+) -> int:
+    """
+    Moves every schedule found in an index shard other than the one it belongs
+    to, returning the number of schedules moved
+    """
+    moved = 0
+    for table, shard_key in [
+        (repo.table, repo.index_key),
+        (repo.paused_table, repo.paused_key),
+    ]:
+        keys = [k async for k in repo.redis.scan_iter(match=f"{table}{{*}}")]
+        if await repo.redis.exists(table):
+            keys.append(table.encode())
+
+        for key in keys:
+            pipe = repo.redis.pipeline(transaction=True)
+            async for member, score in repo.redis.zscan_iter(key, count=batch_size):
+                target = shard_key(shard_of(member.decode(), repo.shards))
+                if target.encode() == key:
+                    continue
+                pipe.zadd(target, {member: score}, nx=True)
+                pipe.zrem(key, member)
+                moved += 1
+                if len(pipe) >= 2 * batch_size:
+                    await pipe.execute()
+            await pipe.execute()
+    return moved
+
+
+async def migrate_job_histories(repo: RedisJobRepository) -> int:
+    """
+    Moves each schedule's set of job ids into its history, scored by when each
+    job ran, returning the number of histories moved. Jobs older than the
+    configured max age are deleted rather than moved.
+    """
+    max_age_s = config.jobs.history_max_age_s
+    moved = 0
+    async for key in repo.redis.scan_iter(match=f"{repo.namespace}:*", _type="set"):
+        schedule_id = key.decode()[len(f"{repo.namespace}:") :]
+        job_ids = [j.decode() for j in await repo.redis.smembers(key)]
+        bodies = await repo.get(*job_ids) if len(job_ids) > 0 else []
+
+        history = repo.history_key(schedule_id)
+        pipe = repo.redis.pipeline(transaction=True)
+        for job_id, body in zip(job_ids, bodies):
+            if body is None:
+                continue
+            ran_at = decode(Job, body).ran_at.timestamp()
+            if max_age_s > 0 and ran_at + max_age_s <= time.time():
+                pipe.delete(repo.namespaced_key(job_id))
+                continue
+            pipe.zadd(history, {job_id: ran_at}, nx=True)
+            if max_age_s > 0:
+                pipe.expireat(repo.namespaced_key(job_id), int(ran_at + max_age_s))
+        if max_age_s > 0:
+            pipe.expire(history, max_age_s)
+        pipe.delete(key)
+        await pipe.execute()
+        moved += 1
+    return moved
+
+
+async def migrate(codec_name: Optional[str] = None) -> None:
+    codec = get_codec(codec_name)
+    redis = await get_redis_connection()
+    try:
+        repo = await RedisScheduleRepository.get_repo(redis)
+        moved = await reshard_schedules(repo)
+        logger.info(f"Moved {moved} schedules across {repo.shards} shard(s).")
+
+        # Done before re-encoding, which skips the sets of job ids
+        job_repo = await RedisJobRepository.get_repo(redis)
+        histories = await migrate_job_histories(job_repo)
+        logger.info(f"Moved {histories} job histories.")
+
+        for namespace, model_cls in MIGRATIONS:
+            migrated = await migrate_namespace(redis, namespace, model_cls, codec)
+            logger.info(
+                f"Re-encoded {migrated} {namespace} with {type(codec).__name__}."
+            )
+    finally:
+        await redis.connection_pool.disconnect()
+
+
+def main():
+    setup_logging()
+    asyncio.run(migrate())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,223 @@
 from __future__ import annotations
 
 import asyncio
-from typing import MutableMapping, Sequence
+import heapq
+import itertools
+import time
+from collections import defaultdict
+from typing import List, MutableMapping, Optional, Sequence, Tuple, Union
 
 import aioredis
 import structlog
 
 from job_scheduler.config import config
-from job_scheduler.db.base import JobRepository, ScheduleRepository
-from job_scheduler.db.types import JobRepoItem, ScheduleRepoItem
+from job_scheduler.db.base import JobRepository, ScheduleRepository, shard_of
+from job_scheduler.db.types import ClaimedRun, Fence, JobRepoItem, ScheduleRepoItem
 
 logger = structlog.get_logger(__name__)
 
+# Claims the due members of an index shard which do not already hold a claim
+# for their current score, returning the cursor to resume from followed by the
+# id and score of each claimed member. Bodies are never read, so the cost of a
+# claim does not depend on the size of the schedules. A claim holds the score it
+# was taken for so that a schedule whose next run has been advanced can be
+# claimed again as soon as it becomes due. Claims share their shard's hash tag
+# so that the script only touches a single cluster slot. When fenced, nothing is
+# claimed unless the leader key still holds the caller's fencing token, and each
+# claim holds the token after its score as "<score>:<token>".
+#   KEYS[1]: the index shard, KEYS[2]: the leader key, if fenced
+#   ARGV[1]: the max score to claim, ARGV[2]: the lease in seconds
+#   ARGV[3]: the claims key prefix
+#   ARGV[4]: the offset to start from, ARGV[5]: the page size or 0 for no limit
+#   ARGV[6]: the fencing token, if fenced
+_CLAIM_SCRIPT = """
+if KEYS[2] and redis.call('HGET', KEYS[2], 'token') ~= ARGV[6] then
+    return {0}
+end
+
+local cursor, limit = tonumber(ARGV[4]), tonumber(ARGV[5])
+local due
+if limit > 0 then
+    due = redis.call(
+        'ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'WITHSCORES', 'LIMIT', cursor, limit
+    )
+else
+    due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'WITHSCORES')
+end
+
+local token = ''
+if KEYS[2] then
+    token = ':' .. ARGV[6]
+end
+
+local claimed = {0}
+if limit > 0 and #due / 2 == limit then
+    claimed[1] = cursor + limit
+end
+for i = 1, #due, 2 do
+    local id, score = due[i], due[i + 1]
+    local claim = ARGV[3] .. id
+    local held = redis.call('GET', claim)
+    if not held or string.match(held, '^[^:]+') ~= score then
+        redis.call('SET', claim, score .. token, 'EX', ARGV[2])
+        claimed[#claimed + 1] = id
+        claimed[#claimed + 1] = score
+    end
+end
+return claimed
+"""
+
+# Holds the claims on scheduled runs which have not been completed yet, taking
+# a claim again if it has lapsed but never shortening one. A run whose claim has
+# since been taken by a newer term is left to the job that term queued. Runs are
+# stamped with scores from datetimes, which only keep microseconds, so scores
+# are compared to the millisecond. Returns the ids of the runs held.
+#   KEYS[1]: the index shard
+#   ARGV[1]: the lease in milliseconds, ARGV[2]: the claims key prefix,
+#   followed by an id, score and fencing token or 0 for each run
+_HOLD_SCRIPT = """
+local held = {}
+for i = 3, #ARGV, 3 do
+    local id, score, token = ARGV[i], tonumber(ARGV[i + 1]), tonumber(ARGV[i + 2])
+    local current = redis.call('ZSCORE', KEYS[1], id)
+    if current and math.abs(tonumber(current) - score) < 0.001 then
+        local claim = ARGV[2] .. id
+        local value = redis.call('GET', claim) or current
+        local claimed_token = tonumber(string.match(value, ':(%d+)$') or '0')
+        if string.match(value, '^[^:]+') ~= current or claimed_token <= token then
+            if token > 0 then
+                current = current .. ':' .. token
+            end
+            if value ~= current or redis.call('PTTL', claim) < tonumber(ARGV[1]) then
+                redis.call('SET', claim, current, 'PX', ARGV[1])
+            end
+            held[#held + 1] = id
+        end
+    end
+end
+return held
+"""
+
+# Writes each schedule which still exists and is unchanged from the version the
+# caller expects, returning the ids of the schedules which were written. Paused
+# schedules are not added back to the index.
+#   ARGV[1]: the body key prefix, followed by an id, expected body, new body,
+#   score and index shard for each schedule. An empty expected body matches any
+#   stored body.
+_COMPLETE_SCRIPT = """
+local written = {}
+for i = 2, #ARGV, 5 do
+    local id, expected, body, score = ARGV[i], ARGV[i + 1], ARGV[i + 2], ARGV[i + 3]
+    local key = ARGV[1] .. id
+    local current = redis.call('GET', key)
+    if current and (expected == '' or current == expected) then
+        redis.call('SET', key, body)
+        redis.call('ZADD', ARGV[i + 4], 'XX', score, id)
+        written[#written + 1] = id
+    end
+end
+return written
+"""
+
+# Writes each schedule which is in either index, moving it to the index of
+# active or paused schedules as its state requires.
+#   ARGV[1]: the body key prefix, followed by an id, body, score, whether it is
+#   active ('1' or '0'), and its active and paused index shards for each schedule
+_UPDATE_SCRIPT = """
+for i = 2, #ARGV, 6 do
+    local id, body, score, active = ARGV[i], ARGV[i + 1], ARGV[i + 2], ARGV[i + 3]
+    local index, paused = ARGV[i + 4], ARGV[i + 5]
+    if redis.call('ZSCORE', index, id) or redis.call('ZSCORE', paused, id) then
+        redis.call('SET', ARGV[1] .. id, body)
+        if active == '1' then
+            redis.call('ZREM', paused, id)
+            redis.call('ZADD', index, score, id)
+        else
+            redis.call('ZREM', index, id)
+            redis.call('ZADD', paused, score, id)
+        end
+    end
+end
+"""
+
+# Stores jobs and indexes each under its schedule's history by the time it ran,
+# then trims the histories which were written to down to the retention limits.
+# Jobs which fall out of a history are deleted along with it.
+#   ARGV[1]: the job key prefix, ARGV[2]: the history key prefix
+#   ARGV[3]: the max jobs kept per history or 0 to keep any number
+#   ARGV[4]: the oldest run time kept, ARGV[5]: the jobs' ttl in seconds or 0
+#   followed by an id, schedule id, run time and body for each job
+_ADD_JOBS_SCRIPT = """
+local max_count, ttl = tonumber(ARGV[3]), tonumber(ARGV[5])
+local histories = {}
+for i = 6, #ARGV, 4 do
+    local id, parent, ran_at, job = ARGV[i], ARGV[i + 1], ARGV[i + 2], ARGV[i + 3]
+    if ttl > 0 then
+        redis.call('SET', ARGV[1] .. id, job, 'EX', ttl)
+    else
+        redis.call('SET', ARGV[1] .. id, job)
+    end
+    redis.call('ZADD', ARGV[2] .. parent, ran_at, id)
+    histories[ARGV[2] .. parent] = true
+end
+
+local function forget(history, ids)
+    for _, id in ipairs(ids) do
+        redis.call('DEL', ARGV[1] .. id)
+    end
+end
+for history, _ in pairs(histories) do
+    forget(history, redis.call('ZRANGEBYSCORE', history, '-inf', '(' .. ARGV[4]))
+    redis.call('ZREMRANGEBYSCORE', history, '-inf', '(' .. ARGV[4])
+    if max_count > 0 then
+        forget(history, redis.call('ZRANGE', history, 0, -max_count - 1))
+        redis.call('ZREMRANGEBYRANK', history, 0, -max_count - 1)
+    end
+    if ttl > 0 then
+        redis.call('EXPIRE', history, ttl)
+    end
+end
+"""
+
+# Returns the jobs in a history which ran before a given time, newest first.
+#   KEYS[1]: the history
+#   ARGV[1]: the job key prefix, ARGV[2]: the exclusive max run time
+#   ARGV[3]: the max number of jobs to return or 0 for no limit
+_JOB_HISTORY_SCRIPT = """
+local ids
+if tonumber(ARGV[3]) > 0 then
+    ids = redis.call('ZREVRANGEBYSCORE', KEYS[1], ARGV[2], '-inf', 'LIMIT', 0, ARGV[3])
+else
+    ids = redis.call('ZREVRANGEBYSCORE', KEYS[1], ARGV[2], '-inf')
+end
+
+local jobs = {}
+for _, id in ipairs(ids) do
+    local job = redis.call('GET', ARGV[1] .. id)
+    if job then
+        jobs[#jobs + 1] = job
+    end
+end
+return jobs
+"""
+
 
 async def get_redis_connection() -> aioredis.Redis:
+    """
+    Returns a client backed by a connection pool sized by the db config, which
+    is meant to be created once and shared by every repository in a process.
+    Responses are left as bytes since stored data is encoded by a codec.
+    """
     sleep_time = 3
     while True:
         try:
             logger.info(f"Instantiating redis pool at {config.database_url}.")
-            redis = aioredis.from_url(
-                config.database_url, encoding="utf-8", decode_responses=True
+            pool = aioredis.BlockingConnectionPool.from_url(
+                config.database_url,
+                max_connections=config.db.max_connections,
+                health_check_interval=config.db.health_check_interval_s,
             )
+            redis = aioredis.Redis(connection_pool=pool)
             await redis.ping()
         except aioredis.ConnectionError:
             logger.warning(
@@ -35,78 +232,276 @@ async def get_redis_connection() -> aioredis.Redis:
 
 
 class RedisScheduleRepository(ScheduleRepository):
-    redis: aioredis.Redis
-
-    def __init__(self):
+    def __init__(self, redis: aioredis.Redis):
+        self.redis = redis
+        self.shards = config.db.shards
         self.table = "schedules"
+        self.paused_table = "paused_schedules"
         self.namespace = "schedules"
+        self.claims_namespace = "claims"
+        self.wakeup_channel = "schedule_wakeups"
+        self._pubsub: Optional[aioredis.client.PubSub] = None
+        self._claim_script = self.redis.register_script(_CLAIM_SCRIPT)
+        self._hold_script = self.redis.register_script(_HOLD_SCRIPT)
+        self._complete_script = self.redis.register_script(_COMPLETE_SCRIPT)
+        self._update_script = self.redis.register_script(_UPDATE_SCRIPT)
 
     def namespaced_key(self, key) -> str:
         if key.startswith(f"{self.namespace}:"):
             return key
         return f"{self.namespace}:{key}"
 
+    def _sharded(self, name: str, shard: int) -> str:
+        # A single shard keeps the original key names
+        if self.shards == 1:
+            return name
+        return f"{name}{{{shard}}}"
+
+    def index_key(self, shard: int) -> str:
+        return self._sharded(self.table, shard)
+
+    def paused_key(self, shard: int) -> str:
+        return self._sharded(self.paused_table, shard)
+
+    def claims_prefix(self, shard: int) -> str:
+        return f"{self._sharded(self.claims_namespace, shard)}:"
+
+    @staticmethod
+    def _earliest_due(items: Sequence[ScheduleRepoItem]) -> Optional[float]:
+        return min((i.priority for i in items if i.active), default=None)
+
     async def add(self, *items: ScheduleRepoItem) -> None:
+        if len(items) == 0:
+            return
+
         keys_and_vals = {self.namespaced_key(i.id): i.schedule for i in items}
-        keys_to_scores = {i.id: i.priority for i in items}
+        indexes: MutableMapping[str, MutableMapping[str, float]] = defaultdict(dict)
+        for i in items:
+            shard = shard_of(i.id, self.shards)
+            key = self.index_key(shard) if i.active else self.paused_key(shard)
+            indexes[key][i.id] = i.priority
 
-        await self.redis.mset(keys_and_vals)
-        await self.redis.zadd(self.table, mapping=keys_to_scores, nx=True)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.mset(keys_and_vals)
+            for key, keys_to_scores in indexes.items():
+                pipe.zadd(key, mapping=keys_to_scores, nx=True)
+            earliest = self._earliest_due(items)
+            if earliest is not None:
+                pipe.publish(self.wakeup_channel, earliest)
+            await pipe.execute()
 
-    async def get(self, *keys: str) -> Sequence[str]:
+    async def get(self, *keys: str) -> Sequence[bytes]:
         if len(keys) == 0:
             return []
 
         namespaced = [self.namespaced_key(k) for k in keys]
         result = await self.redis.mget(*namespaced)
-        if len(result) == 1 and result[0] == None:
-            return []
-        return result
+        # Schedules which no longer exist are left out, as in the other repos
+        return [r for r in result if r is not None]
 
     async def update(self, *items: ScheduleRepoItem) -> None:
-        keys_and_vals = {self.namespaced_key(i.id): i.schedule for i in items}
-        keys_to_scores = {i.id: i.priority for i in items}
+        if len(items) == 0:
+            return
 
-        await self.redis.mset(keys_and_vals)
-        await self.redis.zadd(self.table, mapping=keys_to_scores, xx=True)
+        args: List[Union[str, bytes, float]] = [f"{self.namespace}:"]
+        for i in items:
+            shard = shard_of(i.id, self.shards)
+            args.extend(
+                [
+                    i.id,
+                    i.schedule,
+                    i.priority,
+                    "1" if i.active else "0",
+                    self.index_key(shard),
+                    self.paused_key(shard),
+                ]
+            )
+        await self._update_script(args=args)
+
+        earliest = self._earliest_due(items)
+        if earliest is not None:
+            await self.redis.publish(self.wakeup_channel, earliest)
 
     async def delete(self, *keys: str) -> None:
+        if len(keys) == 0:
+            return
+
+        by_shard: MutableMapping[int, List[str]] = defaultdict(list)
+        for k in keys:
+            by_shard[shard_of(k, self.shards)].append(k)
+
         namespaced = [self.namespaced_key(k) for k in keys]
-        delete = await self.redis.delete(*namespaced)
-        zrem = await self.redis.zrem(self.table, *keys)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.delete(*namespaced)
+            for shard, shard_keys in by_shard.items():
+                pipe.zrem(self.index_key(shard), *shard_keys)
+                pipe.zrem(self.paused_key(shard), *shard_keys)
+            await pipe.execute()
+
+    async def complete(self, *items: ScheduleRepoItem) -> Sequence[str]:
+        if len(items) == 0:
+            return []
+
+        args: List[Union[str, bytes, float]] = [f"{self.namespace}:"]
+        for i in items:
+            index = self.index_key(shard_of(i.id, self.shards))
+            args.extend([i.id, i.expected or b"", i.schedule, i.priority, index])
+        written = await self._complete_script(args=args)
+        return [w.decode() for w in written]
+
+    async def get_range(
+        self,
+        min_value: float,
+        max_value: float,
+        offset: int = 0,
+        limit: Optional[int] = None,
+    ) -> Sequence[str]:
+        # Every shard could hold the whole page, which is then merged by score.
+        # A negative count returns every item.
+        num = offset + limit if limit is not None else -1
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for shard in range(self.shards):
+                pipe.zrangebyscore(
+                    self.index_key(shard),
+                    min=min_value,
+                    max=max_value,
+                    start=0,
+                    num=num,
+                    withscores=True,
+                )
+            pages = await pipe.execute()
+
+        merged = heapq.merge(*pages, key=lambda item: item[1])
+        stop = offset + limit if limit is not None else None
+        return [i.decode() for i, _ in itertools.islice(merged, offset, stop)]
+
+    async def claim(
+        self,
+        max_value: float,
+        lease_s: int,
+        cursor: int = 0,
+        limit: Optional[int] = None,
+        shard: int = 0,
+        fence: Optional[Fence] = None,
+    ) -> Tuple[int, Sequence[Tuple[str, float]]]:
+        keys = [self.index_key(shard)]
+        args: List[Union[str, float]] = [
+            max_value,
+            lease_s,
+            self.claims_prefix(shard),
+            cursor,
+            limit or 0,
+        ]
+        if fence is not None:
+            keys.append(fence.key)
+            args.append(fence.token)
+
+        next_cursor, *claimed = await self._claim_script(keys=keys, args=args)
+        ids, scores = claimed[::2], claimed[1::2]
+        return next_cursor, [(i.decode(), float(s)) for i, s in zip(ids, scores)]
+
+    async def release(self, *keys: str) -> None:
+        if len(keys) == 0:
+            return
+
+        claims = [f"{self.claims_prefix(shard_of(k, self.shards))}{k}" for k in keys]
+        await self.redis.delete(*claims)
+
+    async def hold(self, lease_s: float, *runs: ClaimedRun) -> Sequence[str]:
+        by_shard: MutableMapping[int, List[ClaimedRun]] = defaultdict(list)
+        for r in runs:
+            by_shard[shard_of(r.id, self.shards)].append(r)
 
-    async def get_range(self, min_value: float, max_value: float) -> Sequence[str]:
-        return await self.redis.zrangebyscore(self.table, min=min_value, max=max_value)
+        held: List[str] = []
+        for shard, shard_runs in by_shard.items():
+            args: List[Union[str, float]] = [
+                round(lease_s * 1000),
+                self.claims_prefix(shard),
+            ]
+            for r in shard_runs:
+                args.extend([r.id, r.score, r.token])
+            written = await self._hold_script(keys=[self.index_key(shard)], args=args)
+            held.extend(h.decode() for h in written)
+        return held
+
+    async def next_due(self, *shards: int) -> Optional[float]:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for shard in shards:
+                pipe.zrange(self.index_key(shard), 0, 0, withscores=True)
+            heads = await pipe.execute()
+        return min((score for head in heads for _, score in head), default=None)
+
+    async def wait_for_due(self, timeout_s: float) -> Optional[float]:
+        if self._pubsub is None:
+            self._pubsub = self.redis.pubsub()
+            await self._pubsub.subscribe(self.wakeup_channel)
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout_s
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return None
+            message = await self._pubsub.get_message(
+                ignore_subscribe_messages=True, timeout=remaining
+            )
+            if message is not None:
+                return float(message["data"])
 
     @property
     async def size(self) -> int:
-        return await self.redis.zcount(self.table, "-inf", "+inf")
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for shard in range(self.shards):
+                pipe.zcard(self.index_key(shard))
+                pipe.zcard(self.paused_key(shard))
+            return sum(await pipe.execute())
+
+    async def shutdown(self) -> None:
+        if self._pubsub is not None:
+            await self._pubsub.close()
+        await self.redis.connection_pool.disconnect()
 
     @classmethod
-    async def get_repo(cls) -> RedisScheduleRepository:
-        cls.redis = await get_redis_connection()
-        return cls()
+    async def get_repo(
+        cls, redis: Optional[aioredis.Redis] = None
+    ) -> RedisScheduleRepository:
+        return cls(redis or await get_redis_connection())
 
 
 class RedisJobRepository(JobRepository):
-    redis: aioredis.Redis
-
-    def __init__(self):
+    def __init__(self, redis: aioredis.Redis):
+        self.redis = redis
         self.namespace = "jobs"
+        self.history_namespace = "job_history"
+        self._add_script = self.redis.register_script(_ADD_JOBS_SCRIPT)
+        self._history_script = self.redis.register_script(_JOB_HISTORY_SCRIPT)
 
     def namespaced_key(self, key: str) -> str:
         if key.startswith(f"{self.namespace}:"):
             return key
         return f"{self.namespace}:{key}"
 
+    def history_key(self, key: str) -> str:
+        return f"{self.history_namespace}:{key}"
+
     async def add(self, *items: JobRepoItem):
-        keys_and_vals = {self.namespaced_key(i.id): i.job for i in items}
-        await self.redis.mset(keys_and_vals)
+        if len(items) == 0:
+            return
 
+        max_age_s = config.jobs.history_max_age_s
+        oldest_kept = time.time() - max_age_s if max_age_s > 0 else float("-inf")
+        args: List[Union[str, bytes, float]] = [
+            f"{self.namespace}:",
+            f"{self.history_namespace}:",
+            config.jobs.history_max_count,
+            oldest_kept,
+            max_age_s,
+        ]
         for i in items:
-            await self.redis.sadd(self.namespaced_key(i.schedule_id), i.id)
+            args.extend([i.id, i.schedule_id, i.ran_at, i.job])
+        await self._add_script(args=args)
 
-    async def get(self, *keys: str) -> Sequence[str]:
+    async def get(self, *keys: str) -> Sequence[bytes]:
         if len(keys) == 0:
             return []
 
@@ -116,21 +511,50 @@ class RedisJobRepository(JobRepository):
             return []
         return result
 
-    async def get_by_parent(self, *keys: str) -> MutableMapping[str, Sequence[str]]:
-        result = {}
-        for k in keys:
-            namespaced_k = self.namespaced_key(k)
-            job_ids = await self.redis.smembers(namespaced_k)
-            jobs = await self.get(*job_ids)
-            result[k] = jobs
-        return result
+    async def get_by_parent(
+        self,
+        *keys: str,
+        before: Optional[float] = None,
+        limit: Optional[int] = None,
+    ) -> MutableMapping[str, Sequence[bytes]]:
+        if len(keys) == 0:
+            return {}
+
+        max_score = f"({before}" if before is not None else "+inf"
+        try:
+            results = await self._get_histories(keys, max_score, limit or 0)
+        except aioredis.exceptions.NoScriptError:
+            # Scripts queued on a pipeline would be checked for before every
+            # call, so the script is only loaded once it turns out to be missing
+            await self.redis.script_load(_JOB_HISTORY_SCRIPT)
+            results = await self._get_histories(keys, max_score, limit or 0)
+        return dict(zip(keys, results))
+
+    async def _get_histories(
+        self, keys: Sequence[str], max_score: str, limit: int
+    ) -> Sequence[Sequence[bytes]]:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for k in keys:
+                pipe.evalsha(
+                    self._history_script.sha,
+                    1,
+                    self.history_key(k),
+                    f"{self.namespace}:",
+                    max_score,
+                    limit,
+                )
+            return await pipe.execute()
 
     @property
     async def size(self) -> int:
         return 0
         # return await self.redis.dbsize()
 
+    async def shutdown(self) -> None:
+        await self.redis.connection_pool.disconnect()
+
     @classmethod
-    async def get_repo(cls) -> RedisJobRepository:
-        cls.redis = await get_redis_connection()
-        return cls()
+    async def get_repo(
+        cls, redis: Optional[aioredis.Redis] = None
+    ) -> RedisJobRepository:
+        return cls(redis or await get_redis_connection())
@@ -1,5 +1,5 @@
 from dataclasses import dataclass
-from typing import Any, MutableMapping
+from typing import Any, MutableMapping, Optional
 
 JsonMap = MutableMapping[str, Any]
 
@@ -7,12 +7,39 @@ JsonMap = MutableMapping[str, Any]
 @dataclass
 class ScheduleRepoItem:
     id: str
-    schedule: str
+    schedule: bytes
     priority: float
+    # Inactive schedules are kept out of the index of schedules to run
+    active: bool = True
+    # The stored schedule this item is expected to replace, if it matters
+    expected: Optional[bytes] = None
 
 
 @dataclass
 class JobRepoItem:
     id: str
     schedule_id: str
-    job: str
+    job: bytes
+    ran_at: float
+
+
+@dataclass(frozen=True)
+class ClaimedRun:
+    """
+    A scheduled run of a schedule, identified by the index score it was
+    claimed at, along with the fencing token of the term which claimed it
+    """
+
+    id: str
+    score: float
+    token: int = 0
+
+
+@dataclass(frozen=True)
+class Fence:
+    """
+    A leader's fencing token, which is only valid while key still holds it
+    """
+
+    key: str
+    token: int
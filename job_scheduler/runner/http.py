@@ -0,0 +1,165 @@
+import asyncio
+import json
+import time
+from collections import defaultdict
+from dataclasses import asdict, dataclass
+from types import SimpleNamespace
+from typing import Any, DefaultDict, Mapping, Optional, Tuple
+
+import structlog
+from aiohttp import (
+    ClientResponse,
+    ClientSession,
+    ClientTimeout,
+    TCPConnector,
+    TraceConfig,
+)
+
+from job_scheduler.config import config
+from job_scheduler.db.types import JsonMap
+
+logger = structlog.get_logger(__name__)
+
+READ_CHUNK_BYTES = 16 * 1024
+
+
+@dataclass
+class HostStats:
+    requests: int = 0
+    errors: int = 0
+    in_flight: int = 0
+    connections_created: int = 0
+    connections_reused: int = 0
+    # Requests which had to wait for a connection to the host to free up
+    queued: int = 0
+    queued_s: float = 0.0
+    dns_cache_hits: int = 0
+    dns_cache_misses: int = 0
+
+
+class PoolMetrics:
+    """
+    Counts how each callback host's requests are served by the connection pool,
+    gathered from the session's trace events
+    """
+
+    def __init__(self):
+        self.hosts: DefaultDict[str, HostStats] = defaultdict(HostStats)
+
+    def snapshot(self) -> Mapping[str, Mapping[str, Any]]:
+        return {host: asdict(stats) for host, stats in self.hosts.items()}
+
+    def trace_config(self) -> TraceConfig:
+        trace_config = TraceConfig()
+        trace_config.on_request_start.append(self._on_request_start)
+        trace_config.on_request_end.append(self._on_request_end)
+        trace_config.on_request_exception.append(self._on_request_exception)
+        trace_config.on_connection_queued_start.append(self._on_queued_start)
+        trace_config.on_connection_queued_end.append(self._on_queued_end)
+        trace_config.on_connection_create_end.append(self._on_connection_create)
+        trace_config.on_connection_reuseconn.append(self._on_connection_reuse)
+        trace_config.on_dns_cache_hit.append(self._on_dns_cache_hit)
+        trace_config.on_dns_cache_miss.append(self._on_dns_cache_miss)
+        return trace_config
+
+    def _stats(self, ctx: SimpleNamespace) -> HostStats:
+        return self.hosts[ctx.host]
+
+    async def _on_request_start(self, session, ctx: SimpleNamespace, params):
+        ctx.host = params.url.host
+        stats = self._stats(ctx)
+        stats.requests += 1
+        stats.in_flight += 1
+
+    async def _on_request_end(self, session, ctx: SimpleNamespace, params):
+        self._stats(ctx).in_flight -= 1
+
+    async def _on_request_exception(self, session, ctx: SimpleNamespace, params):
+        stats = self._stats(ctx)
+        stats.in_flight -= 1
+        stats.errors += 1
+
+    async def _on_queued_start(self, session, ctx: SimpleNamespace, params):
+        ctx.queued_at = time.perf_counter()
+
+    async def _on_queued_end(self, session, ctx: SimpleNamespace, params):
+        stats = self._stats(ctx)
+        stats.queued += 1
+        stats.queued_s += time.perf_counter() - ctx.queued_at
+
+    async def _on_connection_create(self, session, ctx: SimpleNamespace, params):
+        self._stats(ctx).connections_created += 1
+
+    async def _on_connection_reuse(self, session, ctx: SimpleNamespace, params):
+        self._stats(ctx).connections_reused += 1
+
+    async def _on_dns_cache_hit(self, session, ctx: SimpleNamespace, params):
+        self._stats(ctx).dns_cache_hits += 1
+
+    async def _on_dns_cache_miss(self, session, ctx: SimpleNamespace, params):
+        self._stats(ctx).dns_cache_misses += 1
+
+
+def get_session(metrics: Optional[PoolMetrics] = None) -> ClientSession:
+    """
+    Creates the session callbacks are made with. Connections to each host are
+    capped so that a burst of callbacks to one host leaves connections free for
+    the others, and are kept alive between callbacks to save on handshakes.
+    """
+    connector = TCPConnector(
+        limit=config.runner.connection_limit,
+        limit_per_host=config.runner.connection_limit_per_host,
+        keepalive_timeout=config.runner.keepalive_timeout_s,
+        ttl_dns_cache=config.runner.dns_cache_ttl_s,
+    )
+    return ClientSession(
+        connector=connector,
+        timeout=ClientTimeout(total=config.runner.timeout_s),
+        trace_configs=[metrics.trace_config()] if metrics is not None else None,
+    )
+
+
+async def read_body(response: ClientResponse, max_bytes: int) -> Tuple[bytes, bool]:
+    """
+    Reads at most max_bytes of a response's body in chunks, returning what was
+    read and whether the body was cut short
+    """
+    body = bytearray()
+    async for chunk in response.content.iter_chunked(READ_CHUNK_BYTES):
+        body.extend(chunk)
+        if len(body) > max_bytes:
+            # The connection is closed rather than reused, as the rest of the
+            # body is left unread
+            return bytes(body[:max_bytes]), True
+    return bytes(body), False
+
+
+def body_to_result(body: bytes, truncated: bool, encoding: Optional[str]) -> JsonMap:
+    """
+    Returns a JSON object's body as is. Any other body is kept as text, along
+    with a marker if it was truncated.
+    """
+    try:
+        text = body.decode(encoding or "utf-8", errors="replace")
+    except LookupError:
+        # The response named a charset we don't know
+        text = body.decode("utf-8", errors="replace")
+    if truncated:
+        return {"body": text, "truncated": True}
+    if len(body) == 0:
+        return {}
+
+    try:
+        parsed = json.loads(text)
+    except ValueError:
+        return {"body": text}
+    if isinstance(parsed, dict):
+        return parsed
+    return {"body": parsed}
+
+
+async def log_pool_metrics(metrics: PoolMetrics, interval_s: float):
+    while True:
+        await asyncio.sleep(interval_s)
+        for host, stats in metrics.snapshot().items():
+            logger.info("HTTP connection pool usage", host=host, **stats)
@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import time
+from collections import defaultdict, deque
+from typing import Deque, MutableMapping, Optional
+from urllib.parse import urlsplit
+
+import structlog
+
+from job_scheduler.config import config
+
+logger = structlog.get_logger(__name__)
+
+
+class CircuitBreaker:
+    """
+    Stops calls to a destination once too many of its recent calls have failed.
+    After cooling down a single trial call is let through, which closes the
+    breaker again if it succeeds or keeps it open for another cool down if not.
+    """
+
+    def __init__(
+        self, window: int, min_calls: int, failure_rate: float, cooldown_s: float
+    ):
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.cooldown_s = cooldown_s
+        self.outcomes: Deque[bool] = deque(maxlen=window)
+        self.opened_at: Optional[float] = None
+        self.trial_started = False
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        """
+        Returns whether a call may be made, taking the trial call if the
+        breaker has cooled down
+        """
+        if self.opened_at is None:
+            return True
+        if self.trial_started or time.monotonic() - self.opened_at < self.cooldown_s:
+            return False
+        self.trial_started = True
+        return True
+
+    def record(self, succeeded: bool):
+        if self.opened_at is not None:
+            if self.trial_started:
+                self.trial_started = False
+                self.opened_at = None if succeeded else time.monotonic()
+                self.outcomes.clear()
+            return
+
+        self.outcomes.append(succeeded)
+        failures = self.outcomes.count(False)
+        if (
+            len(self.outcomes) >= self.min_calls
+            and failures / len(self.outcomes) >= self.failure_rate
+        ):
+            self.opened_at = time.monotonic()
+
+
+class DestinationLimits:
+    """
+    Caps the number of concurrent calls to each callback host and keeps a
+    circuit breaker for each of them. Calls over a host's cap are turned away
+    rather than waited on.
+    """
+
+    def __init__(
+        self,
+        concurrency: int,
+        window: int,
+        min_calls: int,
+        failure_rate: float,
+        cooldown_s: float,
+    ):
+        self.concurrency = concurrency
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.cooldown_s = cooldown_s
+        self.in_flight: MutableMapping[str, int] = defaultdict(int)
+        self.breakers: MutableMapping[str, CircuitBreaker] = {}
+
+    @staticmethod
+    def destination(url: str) -> str:
+        return urlsplit(url).netloc
+
+    def acquire(self, url: str) -> bool:
+        """
+        Takes one of the calls allowed to the url's host at a time, returning
+        whether one was free
+        """
+        if self.concurrency <= 0:
+            return True
+        host = self.destination(url)
+        if self.in_flight[host] >= self.concurrency:
+            return False
+        self.in_flight[host] += 1
+        return True
+
+    def release(self, url: str):
+        if self.concurrency <= 0:
+            return
+        host = self.destination(url)
+        self.in_flight[host] -= 1
+        if self.in_flight[host] == 0:
+            del self.in_flight[host]
+
+    def breaker(self, url: str) -> CircuitBreaker:
+        host = self.destination(url)
+        if host not in self.breakers:
+            self.breakers[host] = CircuitBreaker(
+                self.window, self.min_calls, self.failure_rate, self.cooldown_s
+            )
+        return self.breakers[host]
+
+    @classmethod
+    def from_config(cls) -> DestinationLimits:
+        return cls(
+            config.runner.host_concurrency,
+            config.runner.breaker_window,
+            config.runner.breaker_min_calls,
+            config.runner.breaker_failure_rate,
+            config.runner.breaker_cooldown_s,
+        )
@@ -1,12 +1,14 @@
 import asyncio
 import time
 from datetime import datetime, timezone
+from typing import Awaitable, Optional, Sequence, Set
+from uuid import UUID
 
 import structlog
-from aiohttp import ClientConnectorError, ClientSession, ClientTimeout, ContentTypeError
+from aiohttp import ClientError, ClientSession, ClientTimeout
 
-from job_scheduler.api.models import HttpMethod, Job, Schedule
-from job_scheduler.broker import RabbitMQBroker, ScheduleBroker
+from job_scheduler.api.models import HttpMethod, Job, Schedule, StoredResponse
+from job_scheduler.broker import DequeuedMessage, RabbitMQBroker, ScheduleBroker
 from job_scheduler.config import config
 from job_scheduler.db import (
     JobRepository,
@@ -14,18 +16,36 @@ from job_scheduler.db import (
     RedisScheduleRepository,
     ScheduleRepository,
 )
+from job_scheduler.db.redis import get_redis_connection
+from job_scheduler.db.types import JsonMap
 from job_scheduler.logging import setup_logging
+from job_scheduler.runner.http import (
+    PoolMetrics,
+    body_to_result,
+    get_session,
+    log_pool_metrics,
+    read_body,
+)
+from job_scheduler.runner.limits import DestinationLimits
 from job_scheduler.services import (
     ack_jobs,
     add_jobs,
+    attempt_of,
+    complete_executions,
+    defer_jobs,
     dequeue_jobs,
+    enqueue_retry,
+    fencing_token,
     get_schedule,
+    hold_runs,
     queue_jobs_to_schedule_ids,
-    update_schedule,
+    run_score,
 )
 
 logger = structlog.get_logger("job_scheduler.runner")
 
+JSON_HEADERS = {"Content-Type": "application/json"}
+
 
 async def run_jobs(
     s_repo: ScheduleRepository,
@@ -33,42 +53,260 @@ async def run_jobs(
     broker: ScheduleBroker,
     session: ClientSession,
 ):
+    """
+    Runs a single batch of jobs to completion
+    """
+    slots = asyncio.Semaphore(config.runner.concurrency)
+    limits = DestinationLimits.from_config()
+    await asyncio.gather(
+        *await dispatch_jobs(s_repo, j_repo, broker, session, slots, limits)
+    )
+
+
+async def dispatch_jobs(
+    s_repo: ScheduleRepository,
+    j_repo: JobRepository,
+    broker: ScheduleBroker,
+    session: ClientSession,
+    slots: asyncio.Semaphore,
+    limits: Optional[DestinationLimits] = None,
+) -> Sequence[asyncio.Task]:
+    """
+    Starts running a batch of jobs without waiting for them to finish. Each job
+    holds one of the slots until it has been recorded and acked. Jobs for a
+    host which already has as many calls as it is allowed are queued again to
+    be tried later, so that they don't keep the broker from delivering jobs for
+    other hosts. Their runs stay claimed in the meantime.
+    """
     queue_jobs = await dequeue_jobs(broker)
+    queue_jobs = await drop_superseded_jobs(s_repo, broker, queue_jobs)
     schedule_ids = queue_jobs_to_schedule_ids(*queue_jobs)
-    schedules = await get_schedule(s_repo, *schedule_ids)
+    schedules = {s.id: s for s in await get_schedule(s_repo, *schedule_ids)}
+
+    tasks, busy = [], []
+    for qj, s_id in zip(queue_jobs, schedule_ids):
+        schedule = schedules.get(s_id)
+        url = None
+        if limits is not None and schedule is not None:
+            url = schedule.job.callback_url
+            if not limits.acquire(url):
+                busy.append(qj)
+                continue
+        job = run_job(s_repo, j_repo, broker, session, qj, schedule, limits)
+        tasks.append(asyncio.create_task(run_limited(job, slots, limits, url)))
+
+    if len(busy) > 0:
+        delay_s = config.runner.host_busy_delay_s
+        not_deferred = await defer_jobs(broker, *busy, delay_s=delay_s)
+        logger.info(
+            "Deferred jobs for busy host(s)",
+            n_jobs=len(busy) - len(not_deferred),
+            delay_s=delay_s,
+        )
+        for qj in not_deferred:
+            # Run over the host's limit rather than leave the job unacked
+            logger.warning("Unable to defer a job", schedule_id=qj.payload)
+            schedule = schedules[UUID(qj.payload)]
+            job = run_job(s_repo, j_repo, broker, session, qj, schedule, limits)
+            tasks.append(asyncio.create_task(run_limited(job, slots)))
+
+    logger.info(f"Dispatched a batch of schedules", n_schedules=len(tasks))
+    return tasks
 
-    start = time.perf_counter()
-    results = await asyncio.gather(*[execute(session, s) for s in schedules])
-    elapsed = time.perf_counter() - start
 
-    executed_schedules = await get_schedule(s_repo, *[r.schedule_id for r in results])
-    for s in executed_schedules:
-        s.confirm_execution()
+async def drop_superseded_jobs(
+    s_repo: ScheduleRepository,
+    broker: ScheduleBroker,
+    queue_jobs: Sequence[DequeuedMessage],
+) -> Sequence[DequeuedMessage]:
+    """
+    Holds the claims on the scheduled runs the jobs are for, so that no
+    scheduler queues a run again while its job waits on a slot or its host.
+    Jobs for runs which have completed since, such as a run which was queued
+    again once its claim lapsed, and jobs queued by a leader whose run has
+    since been claimed by a newer term, are acked rather than run. The rest
+    are returned.
+    """
+    runs = []
+    for qj in queue_jobs:
+        score = run_score(qj)
+        if score is not None:
+            runs.append((UUID(qj.payload), score, fencing_token(qj) or 0))
+    lease_s = config.scheduler.claim_lease_s
+    held = set(await hold_runs(s_repo, *runs, lease_s=lease_s))
+
+    current, superseded = [], []
+    for qj in queue_jobs:
+        if run_score(qj) is None or UUID(qj.payload) in held:
+            current.append(qj)
+        else:
+            superseded.append(qj)
+
+    if len(superseded) > 0:
+        await ack_jobs(broker, *superseded)
+        logger.warning(
+            "Dropped job(s) for runs which have completed or been taken over",
+            n_jobs=len(superseded),
+        )
+    return current
+
+
+async def run_limited(
+    job: Awaitable,
+    slots: asyncio.Semaphore,
+    limits: Optional[DestinationLimits] = None,
+    url: Optional[str] = None,
+):
+    """
+    Runs a job in one of the slots, then gives back the call to its url's host
+    which was taken for it
+    """
+    try:
+        async with slots:
+            return await job
+    finally:
+        if limits is not None and url is not None:
+            limits.release(url)
+
 
-    await add_jobs(j_repo, *results)
-    await ack_jobs(broker, *queue_jobs)
-    await update_schedule(s_repo, {s.id: s.dict() for s in executed_schedules})
-    logger.info(
-        f"Ran a batch of schedules", n_schedules=len(schedules), total_time_s=elapsed
+async def run_job(
+    s_repo: ScheduleRepository,
+    j_repo: JobRepository,
+    broker: ScheduleBroker,
+    session: ClientSession,
+    queue_job: DequeuedMessage,
+    schedule: Optional[Schedule],
+    limits: Optional[DestinationLimits] = None,
+):
+    if schedule is None or not schedule.active:
+        # The schedule was deleted or paused after it was queued
+        await ack_jobs(broker, queue_job)
+        return
+
+    attempt = attempt_of(queue_job)
+    breaker = None
+    if limits is not None:
+        breaker = limits.breaker(schedule.job.callback_url)
+    try:
+        if not await hold_attempt(s_repo, queue_job, schedule):
+            await ack_jobs(broker, queue_job)
+            logger.warning(
+                "Dropped a job for a run which has completed or been taken over",
+                schedule_id=str(schedule.id),
+            )
+            return
+
+        start = time.perf_counter()
+        if breaker is None or breaker.allow():
+            result = await execute(session, schedule, attempt)
+            if breaker is not None:
+                breaker.record(not is_retryable(result))
+        else:
+            # Fail fast, leaving the retry policy to try again later
+            result = circuit_open(schedule, attempt)
+        elapsed = time.perf_counter() - start
+
+        await add_jobs(j_repo, result)
+        if attempt < schedule.job.max_attempts and is_retryable(result):
+            # The retry is queued before the attempt is acked so that it can't
+            # be lost in between
+            retry = await enqueue_retry(broker, schedule, attempt)
+            if not retry.confirmed:
+                logger.warning("Unable to queue a retry", schedule_id=str(schedule.id))
+        await ack_jobs(broker, queue_job)
+        if attempt == 1:
+            # Retries belong to the run which was scheduled, which already
+            # advanced the schedule
+            _, conflicts = await complete_executions(s_repo, schedule)
+            if len(conflicts) > 0:
+                logger.warning(
+                    "Unable to advance a schedule which kept changing",
+                    schedule_id=str(schedule.id),
+                )
+    except Exception:
+        logger.exception(f"Unable to complete job", schedule_id=str(schedule.id))
+    else:
+        logger.debug(
+            f"Ran schedule",
+            schedule_id=str(schedule.id),
+            total_time_s=elapsed,
+            attempt=attempt,
+            fencing_token=fencing_token(queue_job),
+        )
+
+
+async def hold_attempt(
+    s_repo: ScheduleRepository, queue_job: DequeuedMessage, schedule: Schedule
+) -> bool:
+    """
+    Holds the claim on the scheduled run a job is for until the attempt has
+    timed out and been recorded, so that the run can't be queued again while
+    its callback is being called. Returns whether the run is still the job's
+    to make.
+    """
+    score = run_score(queue_job)
+    if score is None:
+        return True
+
+    timeout_s = schedule.job.timeout_s or config.runner.timeout_s
+    held = await hold_runs(
+        s_repo,
+        (schedule.id, score, fencing_token(queue_job) or 0),
+        lease_s=config.scheduler.claim_lease_s + timeout_s,
     )
+    return len(held) > 0
 
 
-async def execute(session: ClientSession, s: Schedule) -> Job:
-    http_operations = {HttpMethod.post: session.post}
-    http_op = http_operations[s.job.http_method]
+def circuit_open(s: Schedule, attempt: int) -> Job:
+    return Job(
+        schedule_id=s.id,
+        callback_url=s.job.callback_url,
+        http_method=s.job.http_method,
+        status_code=503,
+        result={"error": "Calls to the callback's host are suspended"},
+        ran_at=datetime.now(timezone.utc),
+        attempt=attempt,
+    )
+
+
+def is_retryable(job: Job) -> bool:
+    return job.status_code == 429 or job.status_code >= 500
 
+
+async def execute(session: ClientSession, s: Schedule, attempt: int = 1) -> Job:
+    data, headers = None, None
+    if s.job.http_method != HttpMethod.get:
+        data, headers = s.encoded_payload, JSON_HEADERS
+
+    timeout = ClientTimeout(total=s.job.timeout_s or config.runner.timeout_s)
     try:
-        async with http_op(s.job.callback_url, json=s.job.payload) as response:
+        async with session.request(
+            s.job.http_method.value.upper(),
+            s.job.callback_url,
+            data=data,
+            headers=headers,
+            timeout=timeout,
+        ) as response:
             response_code = response.status
-            response_result = await response.json()
-    except (
-        ClientConnectorError,
-        asyncio.exceptions.TimeoutError,
-        ContentTypeError,
-        Exception,
-    ) as e:
+            if s.job.store_response == StoredResponse.headers:
+                response_result: JsonMap = {"headers": dict(response.headers)}
+            else:
+                body, truncated = await read_body(
+                    response, config.runner.max_response_bytes
+                )
+                response_result = body_to_result(body, truncated, response.charset)
+    except asyncio.TimeoutError:
+        logger.info(f"Ran schedule with error: timed out")
+        response_code = 504
+        response_result = {"error": f"Timed out after {timeout.total}s"}
+    except ClientError as e:
+        # The callback couldn't be reached
         logger.info(f"Ran schedule with error: {e}")
-        response_code = 400
+        response_code = 502
+        response_result = {"error": str(e)}
+    except Exception as e:
+        logger.info(f"Ran schedule with error: {e}")
+        response_code = 500
         response_result = {"error": str(e)}
 
     return Job(
@@ -78,20 +316,37 @@ async def execute(session: ClientSession, s: Schedule) -> Job:
         status_code=response_code,
         result=response_result,
         ran_at=datetime.now(timezone.utc),
+        attempt=attempt,
     )
 
 
 async def run():
     broker = await RabbitMQBroker.get_broker()
-    schedule_repo = await RedisScheduleRepository.get_repo()
-    job_repo = await RedisJobRepository.get_repo()
+    redis = await get_redis_connection()
+    schedule_repo = await RedisScheduleRepository.get_repo(redis)
+    job_repo = await RedisJobRepository.get_repo(redis)
+
+    metrics = PoolMetrics()
+    if config.runner.pool_metrics_interval_s > 0:
+        interval_s = config.runner.pool_metrics_interval_s
+        asyncio.create_task(log_pool_metrics(metrics, interval_s))
 
-    async with ClientSession(timeout=ClientTimeout(total=1)) as session:
+    slots = asyncio.Semaphore(config.runner.concurrency)
+    limits = DestinationLimits.from_config()
+    in_flight: Set[asyncio.Task] = set()
+    async with get_session(metrics) as session:
         while True:
             try:
-                await run_jobs(schedule_repo, job_repo, broker, session)
+                tasks = await dispatch_jobs(
+                    schedule_repo, job_repo, broker, session, slots, limits
+                )
             except KeyboardInterrupt:
                 await broker.shutdown()
+            else:
+                # Hold a reference to running jobs until they finish
+                in_flight.update(tasks)
+                for t in tasks:
+                    t.add_done_callback(in_flight.discard)
 
 
 def main():
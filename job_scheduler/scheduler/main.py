@@ -1,73 +1,329 @@
 import asyncio
+import math
+import time
 from datetime import datetime, timedelta, timezone
-from typing import Sequence
+from typing import AsyncIterator, Optional, Sequence, Tuple
 
 import structlog
 
-from job_scheduler.api.models import Schedule
+from job_scheduler.api.models import DueSchedule, stable_offset
 from job_scheduler.broker import RabbitMQBroker, ScheduleBroker
-from job_scheduler.cache import RedisScheduleCache, ScheduleCache
 from job_scheduler.config import config
+from job_scheduler.coordination import (
+    LeaderElection,
+    RedisLeaderElection,
+    RedisShardCoordinator,
+    ShardCoordinator,
+)
 from job_scheduler.db import RedisScheduleRepository, ScheduleRepository
+from job_scheduler.db.redis import get_redis_connection
+from job_scheduler.db.types import Fence
 from job_scheduler.logging import setup_logging
+from job_scheduler.scheduler.wheel import TimingWheel
 from job_scheduler.services import (
-    add_to_cache,
-    diff_from_cache,
+    claim_schedules,
     enqueue_jobs,
-    get_range,
+    next_due,
+    release_schedules,
+    wait_for_due,
 )
 
 logger = structlog.getLogger("job_scheduler.scheduler")
 
+DISPATCH_SPREAD_SALT = b"dispatch_spread"
+
 
 async def schedule_jobs(
-    repo: ScheduleRepository, broker: ScheduleBroker, cache: ScheduleCache, interval=1
+    repo: ScheduleRepository,
+    broker: ScheduleBroker,
+    shards: Optional[Sequence[int]] = None,
+    fence: Optional[Fence] = None,
+    wheel: Optional[TimingWheel[DueSchedule]] = None,
+):
+    """
+    Queues the due schedules in the given shards of the index, or in every
+    shard if none are given. A leader passes its fence so that nothing is
+    claimed once its term is over.
+
+    Given a timing wheel, the schedules due within the lookahead are claimed
+    as well. Those which are not due to be released yet are loaded into the
+    wheel instead, to be queued by release_due at the time they are due.
+    """
+    if shards is None:
+        shards = range(repo.shards)
+
+    until = get_now()
+    if wheel is not None:
+        until += timedelta(seconds=config.scheduler.lookahead_s)
+
+    n_schedules, n_loaded, total_delay = 0, 0, 0
+    runnable = get_runnable_schedules(repo, until, shards, fence)
+    async for runnable_schedules in runnable:
+        if wheel is not None:
+            due_now = load_wheel(wheel, runnable_schedules)
+            n_loaded += len(runnable_schedules) - len(due_now)
+            runnable_schedules = due_now
+        # Each page is queued before the next one is claimed so that catching up
+        # on a large backlog happens incrementally
+        confirmed, delay = await queue_schedules(
+            repo, broker, runnable_schedules, fence
+        )
+        n_schedules += confirmed
+        total_delay += delay
+    log_queued(n_schedules, total_delay)
+    if wheel is not None:
+        logger.debug("Loaded schedule(s) into the timing wheel", n_schedules=n_loaded)
+
+
+def load_wheel(
+    wheel: TimingWheel[DueSchedule], schedules: Sequence[DueSchedule]
+) -> Sequence[DueSchedule]:
+    """
+    Loads the schedules which are not due to be released yet into the wheel,
+    returning the rest to be queued straight away
+    """
+    now = time.time()
+    due_now = []
+    for s in schedules:
+        at = release_time(s, config.scheduler.dispatch_spread_s)
+        if at <= now:
+            due_now.append(s)
+        else:
+            wheel.add(s, at)
+    return due_now
+
+
+async def release_due(
+    repo: ScheduleRepository,
+    broker: ScheduleBroker,
+    wheel: TimingWheel[DueSchedule],
+    fence: Optional[Fence] = None,
+) -> int:
+    """
+    Queues the schedules in the wheel whose time has come, returning the number
+    queued
+    """
+    due = wheel.advance(time.time())
+    if len(due) == 0:
+        return 0
+
+    n_schedules, total_delay = await queue_schedules(repo, broker, due, fence)
+    log_queued(n_schedules, total_delay)
+    return n_schedules
+
+
+async def keep_releasing(
+    repo: ScheduleRepository,
+    broker: ScheduleBroker,
+    wheel: TimingWheel[DueSchedule],
+    loaded: asyncio.Event,
+    election: Optional[LeaderElection] = None,
+    max_sleep_s: float = 1,
 ):
-    now = get_now()
-    schedule_candidates = await get_runnable_schedules(repo, now)
-    runnable_schedules = await diff_from_cache(cache, *schedule_candidates)
-    if len(runnable_schedules) < len(schedule_candidates):
+    """
+    Releases the wheel's schedules as they come due, sleeping until the
+    earliest one is due, the wheel is loaded again, or max_sleep_s has passed
+    """
+    while True:
+        try:
+            fence = None
+            if election is not None:
+                fence = election.fence
+                if fence is None and len(wheel) > 0:
+                    # Hand the claims of a past term back so the new leader can
+                    # take them over straight away
+                    await release_schedules(repo, *wheel.clear())
+            await release_due(repo, broker, wheel, fence)
+        except Exception:
+            # Schedules which couldn't be queued are claimed again once their
+            # claims expire
+            logger.exception("Unable to release due schedule(s)")
+
+        sleep_s = max_sleep_s
+        due = wheel.next_due()
+        if due is not None:
+            sleep_s = min(max(due - time.time(), 0), sleep_s)
+        try:
+            await asyncio.wait_for(loaded.wait(), sleep_s)
+        except asyncio.TimeoutError:
+            pass
+        loaded.clear()
+
+
+async def queue_schedules(
+    repo: ScheduleRepository,
+    broker: ScheduleBroker,
+    schedules: Sequence[DueSchedule],
+    fence: Optional[Fence] = None,
+) -> Tuple[int, int]:
+    """
+    Queues the schedules, returning the number the broker confirmed and their
+    total delay in seconds
+    """
+    if len(schedules) == 0:
+        return 0, 0
+    published = await enqueue_jobs(broker, *schedules, fence=fence)
+    confirmed = {m.payload for m in published if m.confirmed}
+    unconfirmed = [s for s in schedules if str(s.id) not in confirmed]
+    if len(unconfirmed) > 0:
+        # Let the next tick claim these again rather than waiting on the lease
+        await release_schedules(repo, *unconfirmed)
         logger.warning(
-            "Ignoring item(s) from cache",
-            n_schedules_ignored=len(schedule_candidates) - len(runnable_schedules),
+            "Broker did not confirm schedule(s)", n_schedules=len(unconfirmed)
         )
+    return len(confirmed), sum(s.current_delay.seconds for s in schedules)
 
-    await enqueue_jobs(broker, *runnable_schedules)
-    await add_to_cache(cache, *runnable_schedules)
 
-    total_delay = sum(s.current_delay.seconds for s in schedule_candidates)
-    logger.info(
-        f"Queued schedule(s) for execution", n_schedules=len(runnable_schedules)
-    )
+def log_queued(n_schedules: int, total_delay: int):
+    logger.info(f"Queued schedule(s) for execution", n_schedules=n_schedules)
     if total_delay > 0:
         logger.warning(
             "Observed delay in schedule(s).",
             total_delay_s=total_delay,
-            n_schedules=len(schedule_candidates),
+            n_schedules=n_schedules,
         )
-    await asyncio.sleep(interval)
+
+
+def release_time(schedule: DueSchedule, spread_s: float) -> float:
+    """
+    Returns the time to queue a schedule at, spreading the schedules due at the
+    same moment evenly but consistently over the following spread_s seconds.
+    A schedule's next run already includes its jitter, and the spread is drawn
+    independently of it.
+    """
+    return schedule.next_run.timestamp() + stable_offset(
+        schedule.id, spread_s, DISPATCH_SPREAD_SALT
+    )
+
+
+async def wait_for_next_tick(
+    repo: ScheduleRepository,
+    shards: Sequence[int],
+    interval_s: float,
+    max_idle_s: float,
+    lead_s: float = 0,
+):
+    """
+    Sleeps until the next tick. Ticks fall on multiples of interval_s so that
+    the time spent working does not push later ticks back. When nothing is due
+    before then, ticks are skipped until lead_s seconds before the earliest
+    schedule in the index is due, for at most max_idle_s, or until a schedule
+    is written which is due sooner.
+    """
+    now = time.time()
+    next_tick = (math.floor(now / interval_s) + 1) * interval_s
+    wake_at = now + max_idle_s
+    earliest = await next_due(repo, *shards)
+    if earliest is not None:
+        # A due schedule which is still claimed is left for the next tick
+        wake_at = min(wake_at, max(earliest - lead_s, next_tick))
+
+    while True:
+        remaining = wake_at - time.time()
+        if remaining <= 0:
+            return
+        written = await wait_for_due(repo, remaining)
+        if written is not None and written - lead_s < wake_at:
+            wake_at = max(written - lead_s, next_tick)
 
 
 async def get_runnable_schedules(
-    repo: ScheduleRepository, now: datetime
-) -> Sequence[Schedule]:
-    return await get_range(repo, None, now.timestamp())
+    repo: ScheduleRepository,
+    now: datetime,
+    shards: Sequence[int],
+    fence: Optional[Fence] = None,
+) -> AsyncIterator[Sequence[DueSchedule]]:
+    """
+    Claims the schedules which are due to run, one page at a time, so that no
+    other scheduler will queue them while the claim's lease holds. Only the
+    schedules' ids and next runs are read, the runner loads the rest.
+    """
+    for shard in shards:
+        cursor = 0
+        while True:
+            cursor, schedules = await claim_schedules(
+                repo,
+                now.timestamp(),
+                config.scheduler.claim_lease_s,
+                cursor,
+                config.scheduler.page_size,
+                shard,
+                fence,
+            )
+            if len(schedules) > 0:
+                yield schedules
+            if cursor == 0:
+                break
 
 
 def get_now() -> datetime:
-    now = datetime.now(timezone.utc)
-    return now - timedelta(microseconds=now.microsecond)
+    return datetime.now(timezone.utc)
 
 
 async def schedule():
-    cache = await RedisScheduleCache.get_cache()
-    repo = await RedisScheduleRepository.get_repo()
+    redis = await get_redis_connection()
+    repo = await RedisScheduleRepository.get_repo(redis)
     broker = await RabbitMQBroker.get_broker()
+
+    max_idle_s = config.scheduler.max_idle_s
+    coordinator: Optional[ShardCoordinator] = None
+    if config.scheduler.coordination == "sharded":
+        coordinator = await RedisShardCoordinator.get_coordinator(redis)
+        # Wake in time to renew the leases on our shards
+        max_idle_s = min(max_idle_s, config.scheduler.shard_lease_s / 2)
+
+    election: Optional[LeaderElection] = None
+    if config.scheduler.coordination == "leader":
+        election = await RedisLeaderElection.get_election(redis)
+        # Leadership is renewed independently of ticks so that a slow tick does
+        # not cost the lease, and so that standbys notice a lost leader quickly
+        campaign_interval_s = config.scheduler.leader_lease_s / 4
+        campaigning = asyncio.create_task(
+            election.keep_campaigning(campaign_interval_s)
+        )
+
+    wheel: Optional[TimingWheel[DueSchedule]] = None
+    loaded = asyncio.Event()
+    lead_s = 0.0
+    if config.scheduler.lookahead_s > 0:
+        wheel = TimingWheel(config.scheduler.wheel_resolution_ms / 1000, time.time())
+        lead_s = config.scheduler.lookahead_s
+        # A lost leadership's claims are handed back within a campaign
+        max_sleep_s = config.scheduler.tick_interval_s
+        if election is not None:
+            max_sleep_s = min(max_sleep_s, campaign_interval_s)
+        releasing = asyncio.create_task(
+            keep_releasing(repo, broker, wheel, loaded, election, max_sleep_s)
+        )
+
     while True:
         try:
-            await schedule_jobs(repo, broker, cache)
+            shards: Sequence[int] = range(repo.shards)
+            if coordinator is not None:
+                shards = await coordinator.assigned_shards()
+            if election is None:
+                await schedule_jobs(repo, broker, shards=shards, wheel=wheel)
+            elif election.fence is not None:
+                await schedule_jobs(repo, broker, fence=election.fence, wheel=wheel)
+            else:
+                await asyncio.sleep(campaign_interval_s)
+                continue
+            # Newly loaded schedules may be due before the ones already held
+            loaded.set()
+            await wait_for_next_tick(
+                repo, shards, config.scheduler.tick_interval_s, max_idle_s, lead_s
+            )
         except KeyboardInterrupt:
+            if wheel is not None:
+                releasing.cancel()
+                await release_schedules(repo, *wheel.clear())
+            if coordinator is not None:
+                await coordinator.leave()
+            if election is not None:
+                campaigning.cancel()
+                await election.resign()
             await broker.shutdown()
+            await repo.shutdown()
 
 
 def main():
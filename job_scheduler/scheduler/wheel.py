@@ -0,0 +1,128 @@
+import math
+from typing import Generic, List, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+
+Entry = Tuple[int, T]
+
+
+class TimingWheel(Generic[T]):
+    """
+    A hierarchical timing wheel which releases items once their time has come,
+    to within resolution_s seconds. Each level has the given number of slots,
+    with a slot on one level spanning a whole turn of the level below it, and
+    items due beyond the outermost level wait in an overflow list. Adding an
+    item and releasing it both take constant time, however many items are held.
+    """
+
+    def __init__(
+        self, resolution_s: float, now: float, slots: int = 64, levels: int = 3
+    ):
+        self.resolution_s = resolution_s
+        self.slots = slots
+        self.levels = levels
+        self.tick = math.floor(now / resolution_s)
+        self.wheels: List[List[List[Entry[T]]]] = [
+            [[] for _ in range(slots)] for _ in range(levels)
+        ]
+        self.overflow: List[Entry[T]] = []
+        self.expired: List[T] = []
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _to_tick(self, at: float) -> int:
+        # Items are never released before their time
+        return math.ceil(at / self.resolution_s)
+
+    def add(self, item: T, at: float):
+        """
+        Holds an item until the given time, or until the next advance if the
+        time has already passed
+        """
+        self._size += 1
+        tick = self._to_tick(at)
+        if tick <= self.tick:
+            self.expired.append(item)
+        else:
+            self._place(tick, item)
+
+    def _place(self, tick: int, item: T):
+        delta = tick - self.tick
+        for level in range(self.levels):
+            if delta < self.slots ** (level + 1):
+                slot = (tick // self.slots ** level) % self.slots
+                self.wheels[level][slot].append((tick, item))
+                return
+        self.overflow.append((tick, item))
+
+    def advance(self, now: float) -> List[T]:
+        """
+        Moves the wheel on to the given time, returning the items whose time
+        has come in the order they were due
+        """
+        released, self.expired = self.expired, []
+        target = math.floor(now / self.resolution_s)
+        while self.tick < target and self._size > len(released):
+            self.tick += 1
+            self._cascade()
+            slot = self.wheels[0][self.tick % self.slots]
+            released.extend(item for _, item in slot)
+            slot.clear()
+        # Nothing else is due before the target, so the wheel can skip ahead
+        self.tick = max(self.tick, target)
+        self._size -= len(released)
+        return released
+
+    def _cascade(self):
+        # Outer levels are emptied into inner ones as the ticks they span begin
+        if self.tick % self.slots ** (self.levels - 1) == 0:
+            overflow, self.overflow = self.overflow, []
+            for tick, item in overflow:
+                self._place(tick, item)
+        for level in reversed(range(1, self.levels)):
+            span = self.slots ** level
+            if self.tick % span == 0:
+                slot = self.wheels[level][(self.tick // span) % self.slots]
+                entries = list(slot)
+                slot.clear()
+                for tick, item in entries:
+                    self._place(tick, item)
+
+    def next_due(self) -> Optional[float]:
+        """
+        Returns the time the earliest item held is due, to within the wheel's
+        resolution, or None if the wheel is empty
+        """
+        if self._size == 0:
+            return None
+        if len(self.expired) > 0:
+            return self.tick * self.resolution_s
+
+        ticks = [tick for tick, _ in self.overflow]
+        for level, wheel in enumerate(self.wheels):
+            # Slots are looked at in the order their spans begin, so the first
+            # occupied one holds the level's earliest items
+            span = self.slots ** level
+            current = self.tick // span
+            for n in range(current + 1, current + self.slots + 1):
+                slot = wheel[n % self.slots]
+                if len(slot) > 0:
+                    ticks.append(min(tick for tick, _ in slot))
+                    break
+        return min(ticks) * self.resolution_s
+
+    def clear(self) -> List[T]:
+        """
+        Removes and returns every item held
+        """
+        items = list(self.expired)
+        for wheel in self.wheels:
+            for slot in wheel:
+                items.extend(item for _, item in slot)
+                slot.clear()
+        items.extend(item for _, item in self.overflow)
+        self.expired, self.overflow = [], []
+        self._size = 0
+        return items
@@ -1,19 +1,29 @@
 from job_scheduler.services.broker import (
     ack_jobs,
+    attempt_of,
+    defer_jobs,
     dequeue_jobs,
     enqueue_jobs,
+    enqueue_retry,
+    fencing_token,
     queue_jobs_to_schedule_ids,
+    run_score,
 )
-from job_scheduler.services.cache import add_to_cache, diff_from_cache
 from job_scheduler.services.db import (
     add_jobs,
+    claim_schedules,
+    complete_executions,
     delete_schedule,
     get_jobs,
     get_range,
     get_schedule,
     get_schedule_jobs,
+    hold_runs,
+    next_due,
+    release_schedules,
     store_schedule,
     update_schedule,
+    wait_for_due,
 )
 
 all = [
@@ -21,7 +31,13 @@ all = [
     "get_schedule",
     "delete_schedule",
     "update_schedule",
+    "complete_executions",
     "get_range",
+    "claim_schedules",
+    "release_schedules",
+    "hold_runs",
+    "next_due",
+    "wait_for_due",
     "enqueue_jobs",
     "dequeue_jobs",
     "ack_jobs",
@@ -29,6 +45,9 @@ all = [
     "get_jobs",
     "get_schedule_jobs",
     "queue_jobs_to_schedule_ids",
-    "diff_from_cache",
-    "add_to_cache",
+    "fencing_token",
+    "enqueue_retry",
+    "attempt_of",
+    "defer_jobs",
+    "run_score",
 ]
@@ -1,15 +1,89 @@
-from typing import Sequence
+from typing import List, Optional, Sequence, Union
 from uuid import UUID
 
-from job_scheduler.api.models import Schedule
+from job_scheduler.api.models import DueSchedule, Schedule
 from job_scheduler.broker import ScheduleBroker
-from job_scheduler.broker.messages import DequeuedMessage, EnqueuedMessage
+from job_scheduler.broker.messages import (
+    ATTEMPT_HEADER,
+    FENCING_TOKEN_HEADER,
+    RUN_SCORE_HEADER,
+    DequeuedMessage,
+    EnqueuedMessage,
+)
+from job_scheduler.config import config
+from job_scheduler.db.types import Fence
+
+JOB_HEADERS = (ATTEMPT_HEADER, FENCING_TOKEN_HEADER, RUN_SCORE_HEADER)
 
 
 async def enqueue_jobs(
-    broker: ScheduleBroker, *schedules: Schedule
+    broker: ScheduleBroker,
+    *schedules: Union[Schedule, DueSchedule],
+    fence: Optional[Fence] = None,
 ) -> Sequence[EnqueuedMessage]:
-    return await broker.publish(*[str(s.id) for s in schedules])
+    headers = {} if fence is None else {FENCING_TOKEN_HEADER: fence.token}
+    return await broker.publish(
+        *[str(s.id) for s in schedules],
+        headers=headers,
+        message_headers=[{RUN_SCORE_HEADER: s.priority} for s in schedules],
+    )
+
+
+def fencing_token(queue_job: DequeuedMessage) -> Optional[int]:
+    return queue_job.headers.get(FENCING_TOKEN_HEADER)
+
+
+def run_score(queue_job: DequeuedMessage) -> Optional[float]:
+    """
+    Returns the index score of the scheduled run a job is for, which retries
+    and jobs queued by hand don't have
+    """
+    return queue_job.headers.get(RUN_SCORE_HEADER)
+
+
+async def enqueue_retry(
+    broker: ScheduleBroker, schedule: Schedule, attempt: int
+) -> EnqueuedMessage:
+    """
+    Queues the attempt after the given one once the job's backoff has passed
+    """
+    retry, *_ = await broker.publish(
+        str(schedule.id),
+        headers={ATTEMPT_HEADER: attempt + 1},
+        delay_s=schedule.job.backoff(attempt),
+    )
+    return retry
+
+
+async def defer_jobs(
+    broker: ScheduleBroker, *queue_jobs: DequeuedMessage, delay_s: float
+) -> Sequence[DequeuedMessage]:
+    """
+    Queues the jobs again as the same attempt of the same term once delay_s
+    has passed, then acks the jobs which were queued again and returns the rest
+    """
+    published = await broker.publish(
+        *[qj.payload for qj in queue_jobs],
+        delay_s=delay_s,
+        # Only our own headers are carried over, not those the broker adds
+        message_headers=[
+            {h: qj.headers[h] for h in JOB_HEADERS if h in qj.headers}
+            for qj in queue_jobs
+        ],
+    )
+
+    deferred: List[DequeuedMessage] = []
+    not_deferred: List[DequeuedMessage] = []
+    for qj, m in zip(queue_jobs, published):
+        (deferred if m.confirmed else not_deferred).append(qj)
+
+    if len(deferred) > 0:
+        await broker.ack(*deferred)
+    return not_deferred
+
+
+def attempt_of(queue_job: DequeuedMessage) -> int:
+    return queue_job.headers.get(ATTEMPT_HEADER, 1)
 
 
 def queue_jobs_to_schedule_ids(*queue_jobs: DequeuedMessage) -> Sequence[UUID]:
@@ -17,7 +91,10 @@ def queue_jobs_to_schedule_ids(*queue_jobs: DequeuedMessage) -> Sequence[UUID]:
 
 
 async def dequeue_jobs(broker: ScheduleBroker) -> Sequence[DequeuedMessage]:
-    queue_messages = await broker.drain(limit=100)
+    queue_messages = await broker.drain(
+        limit=config.broker.batch_max_size,
+        max_wait_ms=config.broker.batch_max_wait_ms,
+    )
     return queue_messages
 
 
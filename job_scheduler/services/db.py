@@ -1,9 +1,33 @@
-from typing import Mapping, Optional, Sequence, Union
+from datetime import datetime, timezone
+from typing import List, Mapping, Optional, Sequence, Tuple, Union
 from uuid import UUID
 
-from job_scheduler.api.models import Job, Schedule
+from job_scheduler.api.models import DueSchedule, Job, Schedule, confirm_executions
 from job_scheduler.db import JobRepository, ScheduleRepository
-from job_scheduler.db.types import JobRepoItem, JsonMap, ScheduleRepoItem
+from job_scheduler.db.codecs import decode, decode_with_extra, encode
+from job_scheduler.db.types import (
+    ClaimedRun,
+    Fence,
+    JobRepoItem,
+    JsonMap,
+    ScheduleRepoItem,
+)
+
+
+def _encoding(s: Schedule) -> bytes:
+    return encode(s, extra={"encoded_payload": s.encoded_payload})
+
+
+def _encode_schedule(s: Schedule) -> bytes:
+    s._stored = _encoding(s)
+    return s._stored
+
+
+def _decode_schedule(data: bytes) -> Schedule:
+    s, extra = decode_with_extra(Schedule, data)
+    s._stored = data
+    s._encoded_payload = extra.get("encoded_payload")
+    return s
 
 
 async def store_schedule(
@@ -11,7 +35,12 @@ async def store_schedule(
 ) -> Sequence[Schedule]:
 
     data = [
-        ScheduleRepoItem(id=str(s.id), schedule=s.json(), priority=s.priority)
+        ScheduleRepoItem(
+            id=str(s.id),
+            schedule=_encode_schedule(s),
+            priority=s.priority,
+            active=s.active,
+        )
         for s in schedules
     ]
     await repo.add(*data)
@@ -23,7 +52,7 @@ async def get_schedule(
 ) -> Sequence[Schedule]:
     ids = [str(s_id) for s_id in schedule_ids]
     data = await repo.get(*ids)
-    return [Schedule.parse_raw(d) for d in data]
+    return [_decode_schedule(d) for d in data]
 
 
 async def update_schedule(
@@ -35,18 +64,66 @@ async def update_schedule(
 
     new_schedules = []
     for s in schedules:
-        s_update = updates[s.id]
-        updated_schedule = s.copy(update=s_update)
+        # Validated so that nested updates, such as the job, become models with
+        # their defaults filled in
+        updated_schedule = Schedule.parse_obj({**s.dict(), **updates[s.id]})
+        if updated_schedule.active and not s.active:
+            # Runs missed while paused are skipped rather than caught up on
+            updated_schedule.next_run = updated_schedule.calc_next_run()
         new_schedules.append(updated_schedule)
 
     all_updates = [
-        ScheduleRepoItem(id=str(ns.id), schedule=ns.json(), priority=ns.priority)
+        ScheduleRepoItem(
+            id=str(ns.id),
+            schedule=_encode_schedule(ns),
+            priority=ns.priority,
+            active=ns.active,
+        )
         for ns in new_schedules
     ]
     await repo.update(*all_updates)
     return new_schedules
 
 
+async def complete_executions(
+    repo: ScheduleRepository, *schedules: Schedule, attempts: int = 3
+) -> Tuple[Sequence[Schedule], Sequence[Schedule]]:
+    """
+    Records that schedules have just been executed and advances their next run.
+    A schedule is only written if the stored bytes are the ones it was read
+    from, otherwise its latest version is read and the execution applied to
+    that instead. Returns the completed schedules, followed by the latest
+    versions of those which were still changing after the last attempt and
+    were left as they are.
+    """
+    completed: List[Schedule] = []
+    pending = list(schedules)
+    for _ in range(attempts):
+        executed = [s.copy() for s in pending]
+        confirm_executions(*executed)
+        items = [
+            ScheduleRepoItem(
+                id=str(s.id),
+                schedule=_encode_schedule(executed_s),
+                priority=executed_s.priority,
+                active=executed_s.active,
+                # Schedules which weren't read from the repo fall back on their
+                # own encoding
+                expected=s._stored or _encoding(s),
+            )
+            for s, executed_s in zip(pending, executed)
+        ]
+
+        written = set(await repo.complete(*items))
+        completed.extend(s for s in executed if str(s.id) in written)
+        changed = [s.id for s in pending if str(s.id) not in written]
+        if len(changed) == 0:
+            return completed, []
+        # Schedules which were deleted in the meantime are not found again
+        pending = list(await get_schedule(repo, *changed))
+    return completed, pending
+
+
 async def delete_schedule(
     repo: ScheduleRepository, *schedule_ids: UUID
 ) -> Sequence[Schedule]:
@@ -54,28 +131,81 @@ async def delete_schedule(
     data = await repo.get(*ids)
 
     await repo.delete(*ids)
-    return [Schedule.parse_raw(d) for d in data]
+    return [_decode_schedule(d) for d in data]
 
 
 async def get_range(
     repo: ScheduleRepository,
     min_value: Optional[float] = None,
     max_value: Optional[float] = None,
+    offset: int = 0,
+    limit: Optional[int] = None,
 ) -> Sequence[Schedule]:
     if min_value is None:
         min_value = float("-inf")
     if max_value is None:
         max_value = float("inf")
 
-    schedule_ids = await repo.get_range(min_value, max_value)
+    schedule_ids = await repo.get_range(min_value, max_value, offset, limit)
     data = await repo.get(*schedule_ids)
-    return [Schedule.parse_raw(d) for d in data]
+    return [_decode_schedule(d) for d in data]
+
+
+async def claim_schedules(
+    repo: ScheduleRepository,
+    max_value: float,
+    lease_s: int,
+    cursor: int = 0,
+    limit: Optional[int] = None,
+    shard: int = 0,
+    fence: Optional[Fence] = None,
+) -> Tuple[int, Sequence[DueSchedule]]:
+    next_cursor, claimed = await repo.claim(
+        max_value, lease_s, cursor, limit, shard, fence
+    )
+    return next_cursor, [
+        DueSchedule(UUID(s_id), datetime.fromtimestamp(score, timezone.utc))
+        for s_id, score in claimed
+    ]
+
+
+async def hold_runs(
+    repo: ScheduleRepository, *runs: Tuple[UUID, float, int], lease_s: float
+) -> Sequence[UUID]:
+    """
+    Keeps the scheduled runs, given by schedule id, score and fencing token,
+    claimed for another lease_s seconds. Returns the ids of the schedules whose
+    runs are still due and haven't been claimed by a newer term.
+    """
+    held = await repo.hold(
+        lease_s, *[ClaimedRun(str(s_id), score, token) for s_id, score, token in runs]
+    )
+    return [UUID(s_id) for s_id in held]
+
+
+async def next_due(repo: ScheduleRepository, *shards: int) -> Optional[float]:
+    return await repo.next_due(*shards)
+
+
+async def wait_for_due(repo: ScheduleRepository, timeout_s: float) -> Optional[float]:
+    return await repo.wait_for_due(timeout_s)
+
+
+async def release_schedules(
+    repo: ScheduleRepository, *schedules: Union[Schedule, DueSchedule]
+) -> None:
+    await repo.release(*[str(s.id) for s in schedules])
 
 
 async def add_jobs(repo: JobRepository, *jobs: Job):
     items = []
     for j in jobs:
-        item = JobRepoItem(id=str(j.id), schedule_id=str(j.schedule_id), job=j.json())
+        item = JobRepoItem(
+            id=str(j.id),
+            schedule_id=str(j.schedule_id),
+            job=encode(j),
+            ran_at=j.ran_at.timestamp(),
+        )
         items.append(item)
     await repo.add(*items)
     return jobs
@@ -84,18 +214,28 @@ async def add_jobs(repo: JobRepository, *jobs: Job):
 async def get_jobs(repo: JobRepository, *job_ids: UUID):
     ids = [str(j) for j in job_ids]
     jobs = await repo.get(*ids)
-    return [Job.parse_raw(j) for j in jobs]
-
-
-async def get_schedule_jobs(repo: JobRepository, *schedule_ids: UUID):
+    return [decode(Job, j) for j in jobs]
+
+
+async def get_schedule_jobs(
+    repo: JobRepository,
+    *schedule_ids: UUID,
+    before: Optional[datetime] = None,
+    limit: Optional[int] = None,
+):
+    """
+    Looks up the jobs run by each schedule, newest first. Passing the run time of
+    the last job in one page as before retrieves the next page.
+    """
     ids = [str(s_id) for s_id in schedule_ids]
-    schedules_to_jobs = await repo.get_by_parent(*ids)
+    before_ts = before.timestamp() if before is not None else None
+    schedules_to_jobs = await repo.get_by_parent(*ids, before=before_ts, limit=limit)
 
     result = {}
     for s_id, jobs in schedules_to_jobs.items():
         parsed_jobs = []
         for j in jobs:
-            j = Job.parse_raw(j)
+            j = decode(Job, j)
             parsed_jobs.append(j)
         result[UUID(s_id)] = parsed_jobs
     return result
@@ -0,0 +1,99 @@
+import uuid
+
+import pytest
+
+from job_scheduler.api.models import Schedule, ScheduleRequest
+from job_scheduler.config import config
+from job_scheduler.db.codecs import decode
+
+
+@pytest.mark.asyncio
+async def test_create_batch(async_client, repo, schedule_request: ScheduleRequest):
+    bad_request = {**schedule_request.dict(), "schedule": "Not_A_SCHEDULE"}
+    body = [schedule_request.dict(), bad_request, schedule_request.dict()]
+
+    size_before = await repo.size
+    async with async_client:
+        resp = await async_client.post("/schedules:batch", json=body)
+    size_after = await repo.size
+    results = resp.json()
+
+    assert resp.status_code == 200
+    assert [r["index"] for r in results] == [0, 1, 2]
+    assert [r["status_code"] for r in results] == [201, 422, 201]
+    assert results[0]["id"] in repo and results[2]["id"] in repo
+    assert size_after == size_before + 2
+
+
+@pytest.mark.asyncio
+async def test_create_batch_ndjson(
+    async_client, repo, schedule_request: ScheduleRequest, monkeypatch
+):
+    monkeypatch.setattr(config.api, "batch_chunk_size", 2)
+    lines = [schedule_request.json() for _ in range(5)] + ["{not json"]
+    body = "\n".join(lines) + "\n"
+
+    size_before = await repo.size
+    async with async_client:
+        resp = await async_client.post(
+            "/schedules:batch",
+            data=body,
+            headers={"content-type": "application/x-ndjson"},
+        )
+    size_after = await repo.size
+
+    assert resp.status_code == 200
+    assert [r["status_code"] for r in resp.json()] == [201] * 5 + [422]
+    assert size_after == size_before + 5
+
+
+@pytest.mark.asyncio
+async def test_create_batch_not_an_array(
+    async_client, schedule_request: ScheduleRequest
+):
+    async with async_client:
+        resp = await async_client.post("/schedules:batch", json=schedule_request.dict())
+
+    assert resp.status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_update_batch(async_client, repo, schedule_request: ScheduleRequest):
+    async with async_client:
+        resp = await async_client.post(
+            "/schedules:batch", json=[schedule_request.dict()] * 2
+        )
+    ids = [r["id"] for r in resp.json()]
+
+    schedule_request.description = "Updated in a batch"
+    missing = str(uuid.uuid4())
+    body = [{**schedule_request.dict(), "id": s_id} for s_id in ids + [missing]]
+    async with async_client:
+        resp = await async_client.put("/schedules:batch", json=body)
+    results = resp.json()
+
+    assert resp.status_code == 200
+    assert [r["status_code"] for r in results] == [200, 200, 404]
+    for s_id in ids:
+        stored = decode(Schedule, (await repo.get(s_id))[0])
+        assert stored.description == "Updated in a batch"
+
+
+@pytest.mark.asyncio
+async def test_delete_batch(async_client, repo, schedule_request: ScheduleRequest):
+    async with async_client:
+        resp = await async_client.post(
+            "/schedules:batch", json=[schedule_request.dict()] * 2
+        )
+    ids = [r["id"] for r in resp.json()]
+
+    size_before = await repo.size
+    body = [{"id": s_id} for s_id in ids] + [{"id": str(uuid.uuid4())}, {}]
+    async with async_client:
+        resp = await async_client.request("DELETE", "/schedules:batch", json=body)
+    size_after = await repo.size
+
+    assert resp.status_code == 200
+    assert [r["status_code"] for r in resp.json()] == [200, 200, 404, 422]
+    assert all(s_id not in repo for s_id in ids)
+    assert size_after == size_before - 2
@@ -1,9 +1,14 @@
 import uuid
+from datetime import timedelta
 from typing import Sequence
 
 import pytest
+from aioredis.connection import Connection
 
 from job_scheduler.api.models import Job
+from job_scheduler.config import config
+from job_scheduler.db.codecs import decode, encode
+from job_scheduler.db.migrate import migrate_job_histories
 from job_scheduler.db.redis import JobRepoItem, JobRepository, RedisJobRepository
 
 
@@ -13,10 +18,33 @@ async def repo():
     return await RedisJobRepository.get_repo()
 
 
+@pytest.fixture
+def round_trips(monkeypatch):
+    """
+    Counts the round trips made to Redis, each of which sends one command or a
+    whole pipeline. Health checks are left out.
+    """
+    counter = {"n": 0}
+    send_packed_command = Connection.send_packed_command
+
+    async def counting_send(self, command, check_health=True):
+        if check_health:
+            counter["n"] += 1
+        return await send_packed_command(self, command, check_health)
+
+    monkeypatch.setattr(Connection, "send_packed_command", counting_send)
+    return counter
+
+
 def job_to_jobrepoitem(*jobs: Job) -> Sequence[JobRepoItem]:
     items = []
     for j in jobs:
-        jri = JobRepoItem(id=str(j.id), schedule_id=str(j.schedule_id), job=j.json())
+        jri = JobRepoItem(
+            id=str(j.id),
+            schedule_id=str(j.schedule_id),
+            job=encode(j),
+            ran_at=j.ran_at.timestamp(),
+        )
         items.append(jri)
     return items
 
@@ -39,7 +67,7 @@ async def test_get(repo: RedisJobRepository, n_jobs):
     await repo.add(*jris)
 
     data, *_ = await repo.get(str(job.id))
-    assert job == Job.parse_raw(data)
+    assert job == decode(Job, data)
 
 
 @pytest.mark.asyncio
@@ -65,6 +93,97 @@ async def test_get_by_parent(n_jobs, repo: RedisJobRepository):
     assert len(results[s_id]) == len(jobs)
 
 
+@pytest.mark.asyncio
+async def test_add_round_trips_are_constant(
+    n_jobs, repo: RedisJobRepository, round_trips
+):
+    for n in (1, 10, 100):
+        before = round_trips["n"]
+        await repo.add(*job_to_jobrepoitem(*n_jobs(n)))
+        assert round_trips["n"] - before == 1
+
+
+@pytest.mark.asyncio
+async def test_get_by_parent_round_trips_are_constant(
+    n_jobs, repo: RedisJobRepository, round_trips
+):
+    jobs = n_jobs(100)
+    await repo.add(*job_to_jobrepoitem(*jobs))
+
+    s_id = str(jobs[0].schedule_id)
+    for parents in ([s_id], [s_id, str(uuid.uuid4())]):
+        before = round_trips["n"]
+        results = await repo.get_by_parent(*parents)
+        assert round_trips["n"] - before == 1
+        assert len(results[s_id]) == len(jobs)
+
+
+@pytest.mark.asyncio
+async def test_get_by_parent_loads_script(n_jobs, repo: RedisJobRepository):
+    jobs = n_jobs(2)
+    await repo.add(*job_to_jobrepoitem(*jobs))
+    await repo.redis.script_flush()
+
+    s_id = str(jobs[0].schedule_id)
+    results = await repo.get_by_parent(s_id)
+
+    assert len(results[s_id]) == len(jobs)
+
+
+@pytest.mark.asyncio
+async def test_get_by_parent_paged(n_jobs, repo: RedisJobRepository):
+    jobs = n_jobs(5)
+    for n, j in enumerate(jobs):
+        j.ran_at = j.ran_at + timedelta(seconds=n)
+    await repo.add(*job_to_jobrepoitem(*jobs))
+
+    s_id = str(jobs[0].schedule_id)
+    first_page = (await repo.get_by_parent(s_id, limit=2))[s_id]
+    last_seen = decode(Job, first_page[-1]).ran_at.timestamp()
+    second_page = (await repo.get_by_parent(s_id, before=last_seen, limit=2))[s_id]
+
+    newest_first = [encode(j) for j in reversed(jobs)]
+    assert first_page == newest_first[:2]
+    assert second_page == newest_first[2:4]
+
+
+@pytest.mark.asyncio
+async def test_add_trims_history(n_jobs, repo: RedisJobRepository, monkeypatch):
+    monkeypatch.setattr(config.jobs, "history_max_count", 3)
+    jobs = n_jobs(5)
+    for n, j in enumerate(jobs):
+        j.ran_at = j.ran_at + timedelta(seconds=n)
+    await repo.add(*job_to_jobrepoitem(*jobs))
+
+    s_id = str(jobs[0].schedule_id)
+    results = await repo.get_by_parent(s_id)
+
+    assert results[s_id] == [encode(j) for j in reversed(jobs[2:])]
+    assert await repo.get(str(jobs[0].id)) == []
+
+
+@pytest.mark.asyncio
+async def test_migrate_job_histories(n_jobs, repo: RedisJobRepository, monkeypatch):
+    monkeypatch.setattr(config.jobs, "history_max_age_s", 3600)
+    jobs = n_jobs(3)
+    jobs[0].ran_at = jobs[0].ran_at - timedelta(hours=2)
+    for n, j in enumerate(jobs[1:]):
+        j.ran_at = j.ran_at + timedelta(seconds=n)
+    s_id = str(jobs[0].schedule_id)
+    legacy_key = repo.namespaced_key(s_id)
+    for j in jobs:
+        await repo.redis.set(repo.namespaced_key(str(j.id)), encode(j))
+    await repo.redis.sadd(legacy_key, *[str(j.id) for j in jobs])
+
+    assert await migrate_job_histories(repo) >= 1
+    results = await repo.get_by_parent(s_id)
+
+    assert results[s_id] == [encode(j) for j in reversed(jobs[1:])]
+    assert await repo.get(str(jobs[0].id)) == []
+    assert await repo.redis.exists(legacy_key) == 0
+    assert await repo.redis.ttl(repo.namespaced_key(str(jobs[1].id))) > 0
+
+
 # @pytest.mark.asyncio
 # async def test_redis_shutdown(repo: RedisJobRepository):
 #    await repo.shutdown()
@@ -2,11 +2,16 @@ import uuid
 from datetime import datetime, timedelta, timezone
 from typing import Sequence
 
+import aioredis
 import pytest
 
 from job_scheduler.api.models import Schedule
-from job_scheduler.db import RedisScheduleRepository
-from job_scheduler.db.types import ScheduleRepoItem
+from job_scheduler.config import config
+from job_scheduler.db import RedisJobRepository, RedisScheduleRepository
+from job_scheduler.db.codecs import decode, encode, get_codec
+from job_scheduler.db.migrate import migrate_namespace, reshard_schedules
+from job_scheduler.db.redis import get_redis_connection
+from job_scheduler.db.types import ClaimedRun, Fence, ScheduleRepoItem
 
 
 @pytest.fixture(scope="session")
@@ -20,7 +25,7 @@ def schedule_to_schedulerepoitem(*schedules: Schedule) -> Sequence[ScheduleRepoI
     for s in schedules:
         sri = ScheduleRepoItem(
             id=str(s.id),
-            schedule=s.json(),
+            schedule=encode(s),
             priority=s.priority,
         )
         items.append(sri)
@@ -49,7 +54,7 @@ async def test_get(repo: RedisScheduleRepository, n_schedules):
     await repo.add(*sris)
 
     data, *_ = await repo.get(str(schedule.id))
-    assert schedule == Schedule.parse_raw(data)
+    assert schedule == decode(Schedule, data)
 
 
 @pytest.mark.asyncio
@@ -75,12 +80,33 @@ async def test_update(repo: RedisScheduleRepository, schedule: Schedule):
     assert await repo.size == size_before
 
     data, *_ = await repo.get(str(schedule.id))
-    updated_schedule = Schedule.parse_raw(data)
+    updated_schedule = decode(Schedule, data)
     assert updated_schedule.schedule == schedule.schedule
     assert updated_schedule.description == schedule.description
     assert updated_schedule.active == schedule.active
 
 
+@pytest.mark.asyncio
+async def test_pause_and_resume(repo: RedisScheduleRepository, schedule: Schedule):
+    schedule.next_run = datetime.now(timezone.utc) - timedelta(minutes=1)
+    await repo.add(*schedule_to_schedulerepoitem(schedule))
+    size_before = await repo.size
+    now = datetime.now(timezone.utc).timestamp()
+
+    (paused,) = schedule_to_schedulerepoitem(schedule)
+    paused.active = False
+    await repo.update(paused)
+    _, claimed_paused = await repo.claim(now, 10)
+
+    (resumed,) = schedule_to_schedulerepoitem(schedule)
+    await repo.update(resumed)
+    _, claimed_resumed = await repo.claim(now, 10)
+
+    assert await repo.size == size_before
+    assert str(schedule.id) not in [c[0] for c in claimed_paused]
+    assert str(schedule.id) in [c[0] for c in claimed_resumed]
+
+
 @pytest.mark.asyncio
 async def test_update_nonexistant(repo: RedisScheduleRepository, schedule: Schedule):
     size_before = await repo.size
@@ -106,6 +132,27 @@ async def test_delete_nonexistant(repo: RedisScheduleRepository, schedule: Sched
     assert await repo.size == size_before
 
 
+@pytest.mark.asyncio
+async def test_complete(repo: RedisScheduleRepository, n_schedules):
+    unchanged, changed = n_schedules(2)
+    await repo.add(*schedule_to_schedulerepoitem(unchanged, changed))
+
+    items = []
+    for s in (unchanged, changed):
+        expected = encode(s)
+        s.confirm_execution()
+        (item,) = schedule_to_schedulerepoitem(s)
+        item.expected = expected
+        items.append(item)
+    items[1].expected = b"Not the stored schedule"
+
+    written = await repo.complete(*items)
+
+    assert written == [str(unchanged.id)]
+    assert (await repo.get(str(unchanged.id)))[0] == encode(unchanged)
+    assert (await repo.get(str(changed.id)))[0] != encode(changed)
+
+
 @pytest.mark.asyncio
 async def test_get_range(repo: RedisScheduleRepository, n_schedules):
     schedules = n_schedules(3)
@@ -127,6 +174,251 @@ async def test_get_range(repo: RedisScheduleRepository, n_schedules):
             assert str(s.id) not in results
 
 
+@pytest.mark.asyncio
+async def test_claim(repo: RedisScheduleRepository, n_schedules):
+    schedules = n_schedules(2)
+    schedules[0].next_run = datetime.now(timezone.utc) - timedelta(minutes=1)
+    await repo.add(*schedule_to_schedulerepoitem(*schedules))
+
+    now = datetime.now(timezone.utc)
+    _, claimed = await repo.claim(now.timestamp(), 10)
+    _, claimed_again = await repo.claim(now.timestamp(), 10)
+
+    assert (str(schedules[0].id), schedules[0].priority) in claimed
+    assert (str(schedules[1].id), schedules[1].priority) not in claimed
+    assert (str(schedules[0].id), schedules[0].priority) not in claimed_again
+
+
+@pytest.mark.asyncio
+async def test_fenced_claim(repo: RedisScheduleRepository, schedule: Schedule):
+    schedule.next_run = datetime.now(timezone.utc) - timedelta(minutes=1)
+    await repo.add(*schedule_to_schedulerepoitem(schedule))
+    leader_key = f"scheduler_leader_{uuid.uuid4().hex}"
+    await repo.redis.hset(leader_key, "token", 2)
+
+    now = datetime.now(timezone.utc).timestamp()
+    _, stale = await repo.claim(now, 10, fence=Fence(leader_key, 1))
+    _, current = await repo.claim(now, 10, fence=Fence(leader_key, 2))
+
+    assert (str(schedule.id), schedule.priority) not in stale
+    assert (str(schedule.id), schedule.priority) in current
+
+
+@pytest.mark.asyncio
+async def test_release(repo: RedisScheduleRepository, schedule: Schedule):
+    schedule.next_run = datetime.now(timezone.utc) - timedelta(minutes=1)
+    await repo.add(*schedule_to_schedulerepoitem(schedule))
+
+    now = datetime.now(timezone.utc).timestamp()
+    _, claimed = await repo.claim(now, 10)
+    await repo.release(str(schedule.id))
+    _, claimed_again = await repo.claim(now, 10)
+
+    assert (str(schedule.id), schedule.priority) in claimed
+    assert (str(schedule.id), schedule.priority) in claimed_again
+
+
+@pytest.mark.asyncio
+async def test_hold(repo: RedisScheduleRepository, schedule: Schedule):
+    schedule.next_run = datetime.now(timezone.utc) - timedelta(minutes=1)
+    await repo.add(*schedule_to_schedulerepoitem(schedule))
+    s_id = str(schedule.id)
+    claim = f"{repo.claims_prefix(0)}{s_id}"
+
+    now = datetime.now(timezone.utc).timestamp()
+    await repo.claim(now, 1)
+    held = await repo.hold(10, ClaimedRun(s_id, schedule.priority))
+    assert held == [s_id]
+    assert await repo.redis.pttl(claim) > 5000
+
+    # Claims are not shortened
+    await repo.hold(2, ClaimedRun(s_id, schedule.priority))
+    assert await repo.redis.pttl(claim) > 5000
+
+    # A lapsed claim is taken again
+    await repo.redis.delete(claim)
+    assert await repo.hold(10, ClaimedRun(s_id, schedule.priority)) == [s_id]
+    _, claimed = await repo.claim(now, 10)
+    assert s_id not in [c[0] for c in claimed]
+
+    # Runs which have been completed are not held
+    schedule.next_run += timedelta(minutes=5)
+    await repo.complete(*schedule_to_schedulerepoitem(schedule))
+    assert await repo.hold(10, ClaimedRun(s_id, schedule.priority - 300)) == []
+
+
+@pytest.mark.asyncio
+async def test_hold_taken_over(repo: RedisScheduleRepository, schedule: Schedule):
+    schedule.next_run = datetime.now(timezone.utc) - timedelta(minutes=1)
+    await repo.add(*schedule_to_schedulerepoitem(schedule))
+    s_id = str(schedule.id)
+    leader_key = f"scheduler_leader_{uuid.uuid4().hex}"
+    now = datetime.now(timezone.utc).timestamp()
+
+    await repo.redis.hset(leader_key, "token", 1)
+    await repo.claim(now, 10, fence=Fence(leader_key, 1))
+    # The past term's run is held until a newer term claims it
+    assert await repo.hold(10, ClaimedRun(s_id, schedule.priority, 1)) == [s_id]
+
+    await repo.release(s_id)
+    await repo.redis.hset(leader_key, "token", 2)
+    await repo.claim(now, 10, fence=Fence(leader_key, 2))
+    assert await repo.hold(10, ClaimedRun(s_id, schedule.priority, 1)) == []
+    assert await repo.hold(10, ClaimedRun(s_id, schedule.priority, 2)) == [s_id]
+
+
+@pytest.mark.asyncio
+async def test_get_range_paged(repo: RedisScheduleRepository, n_schedules):
+    schedules = n_schedules(3)
+    await repo.add(*schedule_to_schedulerepoitem(*schedules))
+
+    everything = await repo.get_range(float("-inf"), float("inf"))
+    first_page = await repo.get_range(float("-inf"), float("inf"), 0, 2)
+    second_page = await repo.get_range(float("-inf"), float("inf"), 2, 2)
+
+    assert first_page == everything[:2]
+    assert second_page == everything[2:4]
+
+
+@pytest.mark.asyncio
+async def test_claim_paged(repo: RedisScheduleRepository, n_schedules):
+    schedules = n_schedules(3)
+    for s in schedules:
+        s.next_run = datetime.now(timezone.utc) - timedelta(minutes=1)
+    await repo.add(*schedule_to_schedulerepoitem(*schedules))
+
+    now = datetime.now(timezone.utc).timestamp()
+    cursor, claimed = await repo.claim(now, 10, 0, 2)
+    pages = 1
+    while cursor != 0:
+        cursor, page = await repo.claim(now, 10, cursor, 2)
+        assert len(page) <= 2
+        claimed = [*claimed, *page]
+        pages += 1
+
+    assert pages > 1
+    for s in schedules:
+        assert (str(s.id), s.priority) in claimed
+
+
+@pytest.mark.asyncio
+async def test_migrate(repo: RedisScheduleRepository, schedule: Schedule):
+    legacy = get_codec("json").encode(schedule)
+    await repo.add(ScheduleRepoItem(str(schedule.id), legacy, schedule.priority))
+
+    codec = get_codec("msgpack")
+    migrated = await migrate_namespace(repo.redis, repo.namespace, Schedule, codec)
+    data, *_ = await repo.get(str(schedule.id))
+
+    assert migrated >= 1
+    assert data == codec.encode(schedule)
+    assert await migrate_namespace(repo.redis, repo.namespace, Schedule, codec) == 0
+
+
+@pytest.fixture
+def sharded_repo(repo: RedisScheduleRepository, monkeypatch):
+    """
+    A repo with its index split across 4 shards, kept apart from the other tests
+    """
+    monkeypatch.setattr(config.db, "shards", 4)
+    sharded = RedisScheduleRepository(repo.redis)
+    suffix = uuid.uuid4().hex
+    sharded.table = f"schedules_{suffix}"
+    sharded.paused_table = f"paused_schedules_{suffix}"
+    sharded.claims_namespace = f"claims_{suffix}"
+    return sharded
+
+
+@pytest.mark.asyncio
+async def test_sharded_claim(sharded_repo: RedisScheduleRepository, n_schedules):
+    schedules = n_schedules(20)
+    await sharded_repo.add(*schedule_to_schedulerepoitem(*schedules))
+    now = datetime.now(timezone.utc).timestamp() + 3600
+
+    claimed_by_shard = []
+    for shard in range(sharded_repo.shards):
+        _, claimed = await sharded_repo.claim(now, 10, shard=shard)
+        claimed_by_shard.append({s_id for s_id, _ in claimed})
+
+    assert await sharded_repo.size == 20
+    assert set.union(*claimed_by_shard) == {str(s.id) for s in schedules}
+    assert sum(len(c) for c in claimed_by_shard) == 20
+    assert sum(len(c) > 0 for c in claimed_by_shard) > 1
+
+
+@pytest.mark.asyncio
+async def test_sharded_get_range(sharded_repo: RedisScheduleRepository, n_schedules):
+    schedules = n_schedules(10)
+    for n, s in enumerate(schedules):
+        s.next_run = datetime.now(timezone.utc) + timedelta(minutes=n)
+    await sharded_repo.add(*schedule_to_schedulerepoitem(*schedules))
+
+    everything = await sharded_repo.get_range(float("-inf"), float("inf"))
+    page = await sharded_repo.get_range(float("-inf"), float("inf"), 3, 4)
+
+    assert everything == [str(s.id) for s in schedules]
+    assert page == everything[3:7]
+
+
+@pytest.mark.asyncio
+async def test_reshard(sharded_repo: RedisScheduleRepository, n_schedules):
+    schedules = n_schedules(10)
+    single = RedisScheduleRepository(sharded_repo.redis)
+    single.shards = 1
+    single.table, single.paused_table = sharded_repo.table, sharded_repo.paused_table
+    await single.add(*schedule_to_schedulerepoitem(*schedules))
+
+    moved = await reshard_schedules(sharded_repo)
+    ids = await sharded_repo.get_range(float("-inf"), float("inf"))
+
+    assert moved == 10
+    assert set(ids) == {str(s.id) for s in schedules}
+    assert await single.size == 0
+    assert await reshard_schedules(sharded_repo) == 0
+
+
+@pytest.mark.asyncio
+async def test_next_due(sharded_repo: RedisScheduleRepository, n_schedules):
+    schedules = n_schedules(10)
+    for n, s in enumerate(schedules):
+        s.next_run = datetime.now(timezone.utc) + timedelta(minutes=n + 1)
+    await sharded_repo.add(*schedule_to_schedulerepoitem(*schedules))
+
+    assert await sharded_repo.next_due(*range(4)) == schedules[0].priority
+    assert await sharded_repo.next_due() is None
+
+
+@pytest.mark.asyncio
+async def test_writes_wake_waiters(repo: RedisScheduleRepository, schedule: Schedule):
+    writer, waiter = RedisScheduleRepository(repo.redis), RedisScheduleRepository(
+        repo.redis
+    )
+    writer.wakeup_channel = waiter.wakeup_channel = f"wakeups_{uuid.uuid4().hex}"
+    assert await waiter.wait_for_due(0.01) is None
+
+    await writer.add(*schedule_to_schedulerepoitem(schedule))
+
+    assert await waiter.wait_for_due(1) == schedule.priority
+    assert await waiter.wait_for_due(0.01) is None
+
+
+@pytest.mark.asyncio
+async def test_repos_share_pool(schedule: Schedule):
+    redis = await get_redis_connection()
+    s_repo = await RedisScheduleRepository.get_repo(redis)
+    j_repo = await RedisJobRepository.get_repo(redis)
+    await s_repo.get(str(schedule.id))
+    await j_repo.get(str(schedule.id))
+
+    pool = redis.connection_pool
+    assert isinstance(pool, aioredis.BlockingConnectionPool)
+    assert s_repo.redis.connection_pool is j_repo.redis.connection_pool
+    assert pool.max_connections == config.db.max_connections
+
+    await s_repo.shutdown()
+    assert not any(c.is_connected for c in pool._connections)
+
+
 # @pytest.mark.asyncio
 # async def test_redis_shutdown(repo: RedisScheduleRepository):
 #    await repo.shutdown()
@@ -1,9 +1,18 @@
+import asyncio
 import random
+from uuid import UUID
 
 import pytest
 
 from job_scheduler.broker import FakeBroker, ScheduleBroker
-from job_scheduler.services import ack_jobs, dequeue_jobs, enqueue_jobs
+from job_scheduler.broker.messages import ATTEMPT_HEADER, RUN_SCORE_HEADER
+from job_scheduler.services import (
+    ack_jobs,
+    defer_jobs,
+    dequeue_jobs,
+    enqueue_jobs,
+    run_score,
+)
 
 
 @pytest.fixture(scope="session")
@@ -25,6 +34,16 @@ async def test_schedules_enqueued(n_schedules, broker: ScheduleBroker):
         assert str(s.id) in enqueued_ids
 
 
+async def test_schedules_enqueued_are_confirmed(n_schedules, broker: ScheduleBroker):
+    schedules = n_schedules(3)
+
+    published = await enqueue_jobs(broker, *schedules)
+    await broker.drain()
+
+    assert len(published) == len(schedules)
+    assert all(p.confirmed for p in published)
+
+
 async def test_schedules_dequeued(n_schedules, broker: ScheduleBroker):
     QUEUE_SIZE = random.randint(1, 100)
     schedules = n_schedules(QUEUE_SIZE)
@@ -51,3 +70,59 @@ async def test_schedules_acked(n_schedules, broker: ScheduleBroker):
     dequeued = await broker.drain()
 
     assert len(dequeued) == 1
+
+
+async def test_schedules_consumed(n_schedules, broker: ScheduleBroker):
+    schedules = n_schedules(3)
+    await enqueue_jobs(broker, *schedules)
+
+    consumed = []
+    async for m in broker.consume():
+        consumed.append(m.payload)
+        if len(consumed) == len(schedules):
+            break
+
+    for s in schedules:
+        assert str(s.id) in consumed
+
+
+async def test_drain_respects_limit(n_schedules, broker: ScheduleBroker):
+    schedules = n_schedules(3)
+    await enqueue_jobs(broker, *schedules)
+
+    first = await broker.drain(limit=2)
+    rest = await broker.drain(limit=2)
+
+    assert len(first) == 2
+    assert len(rest) == 1
+
+
+async def test_jobs_deferred(n_schedules):
+    broker = FakeBroker()
+    schedules = n_schedules(2)
+    await broker.publish(str(schedules[0].id), headers={ATTEMPT_HEADER: 2})
+    await broker.publish(
+        str(schedules[1].id), headers={RUN_SCORE_HEADER: 1.5, "x-death": [{}]}
+    )
+    queue_jobs = await broker.drain()
+
+    not_deferred = await defer_jobs(broker, *queue_jobs, delay_s=0.05)
+    assert not_deferred == []
+    assert broker.job_queue.empty()
+
+    await asyncio.sleep(0.1)
+    deferred = {m.payload: m.headers for m in await broker.drain()}
+    # Only the headers the runner sets are carried over
+    assert deferred == {
+        str(schedules[0].id): {ATTEMPT_HEADER: 2},
+        str(schedules[1].id): {RUN_SCORE_HEADER: 1.5},
+    }
+
+
+async def test_jobs_enqueued_with_run_score(n_schedules, broker: ScheduleBroker):
+    schedules = n_schedules(2)
+
+    await enqueue_jobs(broker, *schedules)
+    enqueued = {UUID(qj.payload): run_score(qj) for qj in await broker.drain()}
+
+    assert enqueued == {s.id: s.priority for s in schedules}
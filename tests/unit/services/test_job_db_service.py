@@ -1,3 +1,5 @@
+from datetime import timedelta
+
 import pytest
 
 from job_scheduler.db import FakeJobRepository, JobRepository
@@ -28,3 +30,21 @@ async def test_get_by_parent(repo: JobRepository, n_jobs):
     schedule_jobs = await get_schedule_jobs(repo, jobs[0].schedule_id)
     for j in jobs:
         assert j in schedule_jobs[jobs[0].schedule_id]
+
+
+@pytest.mark.asyncio
+async def test_get_by_parent_paged(repo: JobRepository, n_jobs):
+    jobs = n_jobs(5)
+    for n, j in enumerate(jobs):
+        j.ran_at = j.ran_at + timedelta(seconds=n)
+    await add_jobs(repo, *jobs)
+
+    s_id = jobs[0].schedule_id
+    first_page = (await get_schedule_jobs(repo, s_id, limit=2))[s_id]
+    second_page = (
+        await get_schedule_jobs(repo, s_id, before=first_page[-1].ran_at, limit=2)
+    )[s_id]
+
+    newest_first = list(reversed(jobs))
+    assert first_page == newest_first[:2]
+    assert second_page == newest_first[2:4]
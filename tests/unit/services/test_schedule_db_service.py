@@ -1,14 +1,20 @@
 import uuid
 from datetime import datetime, timedelta, timezone
+from typing import List
 
 import pytest
 
+from job_scheduler.api import models
 from job_scheduler.api.models import Schedule, ScheduleRequest
 from job_scheduler.db import ScheduleRepository
+from job_scheduler.db.types import ScheduleRepoItem
 from job_scheduler.services import (
+    claim_schedules,
+    complete_executions,
     delete_schedule,
     get_range,
     get_schedule,
+    release_schedules,
     store_schedule,
     update_schedule,
 )
@@ -150,3 +156,230 @@ async def test_get_range_no_max(repo: ScheduleRepository, n_schedules):
             assert s in results
         else:
             assert s not in results
+
+
+@pytest.mark.asyncio
+async def test_claim_schedules(repo: ScheduleRepository, n_schedules):
+    schedules = n_schedules(2)
+    schedules[0].next_run = datetime.now(timezone.utc) - timedelta(minutes=1)
+    await store_schedule(repo, *schedules)
+
+    now = datetime.now(timezone.utc).timestamp()
+    _, claimed = await claim_schedules(repo, now, 10)
+    _, claimed_again = await claim_schedules(repo, now, 10)
+
+    assert schedules[0].id in [c.id for c in claimed]
+    assert schedules[1].id not in [c.id for c in claimed]
+    assert schedules[0].id not in [c.id for c in claimed_again]
+
+
+@pytest.mark.asyncio
+async def test_get_range_paged(repo: ScheduleRepository, n_schedules):
+    schedules = n_schedules(3)
+    await store_schedule(repo, *schedules)
+
+    everything = await get_range(repo)
+    first_page = await get_range(repo, offset=0, limit=2)
+    second_page = await get_range(repo, offset=2, limit=2)
+
+    assert first_page == everything[:2]
+    assert second_page == everything[2:4]
+
+
+@pytest.mark.asyncio
+async def test_release_schedules(repo: ScheduleRepository, schedule: Schedule):
+    schedule.next_run = datetime.now(timezone.utc) - timedelta(minutes=1)
+    await store_schedule(repo, schedule)
+
+    now = datetime.now(timezone.utc).timestamp()
+    _, claimed = await claim_schedules(repo, now, 10)
+    await release_schedules(repo, schedule)
+    _, claimed_again = await claim_schedules(repo, now, 10)
+
+    assert schedule.id in [c.id for c in claimed]
+    assert schedule.id in [c.id for c in claimed_again]
+
+
+@pytest.mark.asyncio
+async def test_complete_executions(repo: ScheduleRepository, schedule: Schedule):
+    await store_schedule(repo, schedule)
+
+    completed, _ = await complete_executions(repo, schedule)
+    retrieved, *_ = await get_schedule(repo, schedule.id)
+
+    assert len(completed) == 1
+    assert retrieved.last_run is not None
+    assert retrieved.next_run > schedule.next_run
+
+
+def count_completes(repo: ScheduleRepository, monkeypatch) -> List[int]:
+    calls = []
+    complete = repo.complete
+
+    async def counted(*items):
+        calls.append(len(items))
+        return await complete(*items)
+
+    monkeypatch.setattr(repo, "complete", counted)
+    return calls
+
+
+@pytest.mark.asyncio
+async def test_complete_executions_keeps_concurrent_updates(
+    repo: ScheduleRepository, schedule: Schedule, monkeypatch
+):
+    await store_schedule(repo, schedule)
+    await update_schedule(repo, {schedule.id: {"name": "Updated while running"}})
+    calls = count_completes(repo, monkeypatch)
+
+    await complete_executions(repo, schedule, attempts=2)
+    retrieved, *_ = await get_schedule(repo, schedule.id)
+
+    # The update is only kept if the second, conditional, write succeeds
+    assert len(calls) == 2
+    assert retrieved.name == "Updated while running"
+    assert retrieved.last_run is not None
+
+
+@pytest.mark.asyncio
+async def test_complete_executions_never_overwrites_updates(
+    repo: ScheduleRepository, schedule: Schedule, monkeypatch
+):
+    await store_schedule(repo, schedule)
+    complete = repo.complete
+
+    async def edited_first(*items):
+        # An edit lands before every write
+        await update_schedule(repo, {schedule.id: {"name": f"Edited {uuid.uuid4()}"}})
+        return await complete(*items)
+
+    monkeypatch.setattr(repo, "complete", edited_first)
+    completed, conflicts = await complete_executions(repo, schedule, attempts=2)
+    monkeypatch.undo()
+    retrieved, *_ = await get_schedule(repo, schedule.id)
+
+    assert completed == []
+    assert [c.id for c in conflicts] == [schedule.id]
+    assert retrieved.name.startswith("Edited")
+    assert retrieved.last_run is None
+
+
+@pytest.mark.asyncio
+async def test_updated_schedules_complete_in_one_write(
+    repo: ScheduleRepository, schedule: Schedule, monkeypatch
+):
+    await store_schedule(repo, schedule)
+    await update_schedule(repo, {schedule.id: {"name": "Updated"}})
+    updated, *_ = await get_schedule(repo, schedule.id)
+    calls = count_completes(repo, monkeypatch)
+
+    completed, _ = await complete_executions(repo, updated)
+
+    assert len(completed) == 1
+    assert calls == [1]
+
+
+@pytest.mark.asyncio
+async def test_complete_executions_deleted_schedule(
+    repo: ScheduleRepository, schedule: Schedule
+):
+    await store_schedule(repo, schedule)
+    await delete_schedule(repo, schedule.id)
+
+    completed, _ = await complete_executions(repo, schedule)
+
+    assert len(completed) == 0
+    assert await get_schedule(repo, schedule.id) == []
+
+
+@pytest.mark.asyncio
+async def test_claim_schedules_reads_no_bodies(
+    repo: ScheduleRepository, schedule: Schedule, monkeypatch
+):
+    schedule.next_run = datetime.now(timezone.utc) - timedelta(minutes=1)
+    await store_schedule(repo, schedule)
+
+    async def no_get(*keys):
+        raise AssertionError("Claiming should not read schedule bodies")
+
+    monkeypatch.setattr(repo, "get", no_get)
+    now = datetime.now(timezone.utc).timestamp()
+    _, claimed = await claim_schedules(repo, now, 10)
+    (due,) = [c for c in claimed if c.id == schedule.id]
+
+    assert due.next_run.timestamp() == pytest.approx(schedule.priority)
+
+
+@pytest.mark.asyncio
+async def test_paused_schedules_are_not_claimed(
+    repo: ScheduleRepository, schedule: Schedule
+):
+    schedule.next_run = datetime.now(timezone.utc) - timedelta(minutes=1)
+    schedule.active = False
+    await store_schedule(repo, schedule)
+
+    now = datetime.now(timezone.utc).timestamp()
+    _, claimed = await claim_schedules(repo, now, 10)
+
+    assert schedule.id not in [c.id for c in claimed]
+
+
+@pytest.mark.asyncio
+async def test_resuming_recomputes_next_run(
+    repo: ScheduleRepository, schedule: Schedule
+):
+    schedule.next_run = datetime.now(timezone.utc) - timedelta(days=1)
+    schedule.active = False
+    await store_schedule(repo, schedule)
+
+    resumed, *_ = await update_schedule(repo, {schedule.id: {"active": True}})
+
+    assert resumed.active
+    assert resumed.next_run > datetime.now(timezone.utc)
+
+
+@pytest.mark.asyncio
+async def test_legacy_schedules_complete_in_one_write(
+    repo: ScheduleRepository, schedule: Schedule, monkeypatch
+):
+    # Bodies written in another format never re-encode to the bytes stored
+    item = ScheduleRepoItem(
+        id=str(schedule.id),
+        schedule=schedule.json().encode(),
+        priority=schedule.priority,
+        active=schedule.active,
+    )
+    await repo.add(item)
+    legacy, *_ = await get_schedule(repo, schedule.id)
+    calls = count_completes(repo, monkeypatch)
+
+    completed, _ = await complete_executions(repo, legacy)
+
+    assert len(completed) == 1
+    assert calls == [1]
+
+
+@pytest.mark.asyncio
+async def test_stored_schedules_keep_their_encoded_payload(
+    repo: ScheduleRepository, schedule: Schedule, monkeypatch
+):
+    schedule.job.payload = {"key": "value"}
+    await store_schedule(repo, schedule)
+
+    def no_encode(payload):
+        raise AssertionError("Stored payloads should not be serialized again")
+
+    monkeypatch.setattr(models, "encode_payload", no_encode)
+    stored, *_ = await get_schedule(repo, schedule.id)
+    await complete_executions(repo, stored)
+    ran, *_ = await get_schedule(repo, schedule.id)
+
+    assert stored.encoded_payload == b'{"key":"value"}'
+    assert ran.encoded_payload == b'{"key":"value"}'
+    assert "encoded_payload" not in stored.dict()
+
+    monkeypatch.undo()
+    job = {**schedule.job.dict(), "payload": {"key": "changed"}}
+    await update_schedule(repo, {schedule.id: {"job": job}})
+    updated, *_ = await get_schedule(repo, schedule.id)
+    assert updated.encoded_payload == b'{"key":"changed"}'
@@ -4,7 +4,8 @@ import pydantic
 import pytest
 from croniter import croniter
 
-from job_scheduler.api.models import Schedule, ScheduleRequest
+from job_scheduler.api.models import Schedule, ScheduleRequest, confirm_executions
+from job_scheduler.config import config
 
 
 def test_schedule_req_to_schedule(schedule_request: ScheduleRequest):
@@ -147,3 +148,58 @@ def test_schedule_confirm_execution():
     s.confirm_execution()
     assert s.last_run is not None
     assert second_run == s.next_run
+
+
+def test_confirm_executions(n_schedules):
+    overdue, upcoming = n_schedules(2)
+    overdue.schedule, upcoming.schedule = "*/5 * * * *", "0 0 * * *"
+    overdue.next_run = datetime.now(timezone.utc) - timedelta(days=1)
+    upcoming_next_run = upcoming.next_run = croniter(
+        upcoming.schedule, datetime.now(timezone.utc)
+    ).get_next(datetime)
+
+    confirm_executions(overdue, upcoming)
+
+    assert overdue.last_run is not None and overdue.last_run == upcoming.last_run
+    assert overdue.next_run == croniter(overdue.schedule, overdue.last_run).get_next(
+        datetime
+    )
+    assert upcoming.next_run == croniter(upcoming.schedule, upcoming_next_run).get_next(
+        datetime
+    )
+
+
+def test_jitter_is_deterministic(n_schedules):
+    schedules = n_schedules(50)
+    for s in schedules:
+        s.jitter_s = 30
+
+    offsets = [s.priority - s.next_run.timestamp() for s in schedules]
+    reparsed = [Schedule.parse_raw(s.json()).priority for s in schedules]
+
+    assert all(0 <= o < 30 for o in offsets)
+    assert len(set(offsets)) > 1
+    assert reparsed == [s.priority for s in schedules]
+
+
+def test_jitter_defaults_to_config(schedule: Schedule, monkeypatch):
+    assert schedule.jitter == timedelta(0)
+
+    monkeypatch.setattr(config.jobs, "jitter_s", 30)
+
+    assert timedelta(0) < schedule.jitter < timedelta(seconds=30)
+    assert schedule.jitter_s is None
+
+
+def test_confirm_jittered_execution(schedule: Schedule):
+    schedule.schedule, schedule.jitter_s = "* * * * *", 50
+    now = datetime.now(timezone.utc)
+    # The run is released a little late, well after its fire time
+    fire_time = (now - schedule.jitter - timedelta(milliseconds=1)).replace(
+        second=0, microsecond=0
+    )
+    schedule.next_run = fire_time
+
+    confirm_executions(schedule)
+
+    assert schedule.next_run == fire_time + timedelta(minutes=1)
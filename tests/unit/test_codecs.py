@@ -0,0 +1,63 @@
+import pytest
+
+from job_scheduler.api.models import Job, JobDefinition, Schedule
+from job_scheduler.db.codecs import CODECS, decode, decode_with_extra, get_codec
+
+
+@pytest.mark.parametrize("name", CODECS.keys())
+def test_schedule_round_trip(name: str, schedule: Schedule):
+    schedule.confirm_execution()
+    codec = get_codec(name)
+
+    data = codec.encode(schedule)
+    decoded = decode(Schedule, data)
+
+    assert data[0] == codec.marker
+    assert decoded == schedule
+    # Unchanged schedules must encode identically for conditional writes
+    assert codec.encode(decoded) == data
+
+
+@pytest.mark.parametrize("name", CODECS.keys())
+def test_defaults_round_trip(name: str):
+    # Defaults are not validated, so they must already be of their field's type
+    job = JobDefinition(callback_url="http://127.0.0.1:8080", payload={})
+    schedule = Schedule(name="Defaults", schedule="* * * * *", active=True, job=job)
+    codec = get_codec(name)
+
+    data = codec.encode(schedule)
+
+    assert codec.encode(decode(Schedule, data)) == data
+
+
+@pytest.mark.parametrize("name", CODECS.keys())
+def test_job_round_trip(name: str, n_jobs):
+    job, *_ = n_jobs(1)
+    codec = get_codec(name)
+
+    assert decode(Job, codec.encode(job)) == job
+
+
+def test_legacy_json_is_decoded(schedule: Schedule):
+    assert decode(Schedule, schedule.json().encode()) == schedule
+
+
+def test_msgpack_is_smaller(schedule: Schedule):
+    assert len(get_codec("msgpack").encode(schedule)) < len(schedule.json())
+
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        decode(Schedule, b"\xff")
+
+
+def test_extra_values_round_trip(schedule: Schedule):
+    data = get_codec("msgpack").encode(schedule, extra={"extra": b"value"})
+    decoded, extra = decode_with_extra(Schedule, data)
+
+    assert decoded == schedule
+    assert extra == {"extra": b"value"}
+    # JSON is left as it was
+    assert get_codec("json").encode(schedule, extra={"extra": b"value"}) == (
+        schedule.json().encode()
+    )
@@ -0,0 +1,105 @@
+import asyncio
+import uuid
+
+import pytest
+
+from job_scheduler.coordination import RedisLeaderElection, RedisShardCoordinator
+from job_scheduler.db.redis import get_redis_connection
+
+
+@pytest.fixture
+@pytest.mark.asyncio
+async def make_coordinator():
+    redis = await get_redis_connection()
+    suffix = uuid.uuid4().hex
+
+    def _make_coordinator():
+        coordinator = RedisShardCoordinator(redis, shards=4, lease_s=5)
+        coordinator.members_key = f"scheduler_members_{suffix}"
+        coordinator.lease_namespace = f"shard_owner_{suffix}"
+        return coordinator
+
+    return _make_coordinator
+
+
+@pytest.mark.asyncio
+async def test_lone_replica_holds_every_shard(make_coordinator):
+    coordinator = make_coordinator()
+
+    assert await coordinator.assigned_shards() == [0, 1, 2, 3]
+
+
+@pytest.mark.asyncio
+async def test_shards_rebalance_when_replicas_join(make_coordinator):
+    first, second = make_coordinator(), make_coordinator()
+    await first.assigned_shards()
+
+    # The shards assigned to the newcomer are still held by the first replica
+    assert await second.assigned_shards() == []
+    first_shards = await first.assigned_shards()
+    second_shards = await second.assigned_shards()
+
+    assert len(first_shards) == len(second_shards) == 2
+    assert sorted(first_shards + second_shards) == [0, 1, 2, 3]
+
+
+@pytest.mark.asyncio
+async def test_shards_rebalance_when_replicas_leave(make_coordinator):
+    first, second = make_coordinator(), make_coordinator()
+    await first.assigned_shards()
+    await second.assigned_shards()
+    await first.assigned_shards()
+
+    await first.leave()
+
+    assert await second.assigned_shards() == [0, 1, 2, 3]
+
+
+@pytest.fixture
+@pytest.mark.asyncio
+async def make_election():
+    redis = await get_redis_connection()
+    suffix = uuid.uuid4().hex
+
+    def _make_election(lease_s: float = 5):
+        election = RedisLeaderElection(redis, lease_s=lease_s)
+        election.leader_key = f"scheduler_leader_{suffix}"
+        election.token_key = f"scheduler_leader_token_{suffix}"
+        return election
+
+    return _make_election
+
+
+@pytest.mark.asyncio
+async def test_single_leader_is_elected(make_election):
+    leader, standby = make_election(), make_election()
+
+    fence = await leader.campaign()
+    assert fence is not None
+    assert await standby.campaign() is None
+    # Renewing leadership keeps the same term
+    assert await leader.campaign() == fence
+
+
+@pytest.mark.asyncio
+async def test_standby_takes_over_with_a_newer_token(make_election):
+    leader, standby = make_election(), make_election()
+    old_fence = await leader.campaign()
+
+    await leader.resign()
+    new_fence = await standby.campaign()
+
+    assert old_fence is not None and new_fence is not None
+    assert new_fence.token > old_fence.token
+    assert await leader.campaign() is None
+
+
+@pytest.mark.asyncio
+async def test_standby_takes_over_when_the_lease_expires(make_election):
+    leader, standby = make_election(lease_s=0.1), make_election(lease_s=0.1)
+    await leader.campaign()
+
+    await asyncio.sleep(0.2)
+
+    assert await standby.campaign() is not None
+    assert await leader.campaign() is None
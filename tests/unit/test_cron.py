@@ -0,0 +1,90 @@
+import random
+from datetime import datetime, timedelta, timezone
+
+import pytest
+import pytz
+from croniter import croniter
+
+from job_scheduler.cron import CronExpression, compile_expression, next_fire_times
+
+EXPRESSIONS = [
+    "* * * * *",
+    "*/5 * * * *",
+    "7,19 3-5 * * *",
+    "0 0 * * *",
+    "30 12 1 * *",
+    "0 9 * * mon-fri",
+    "0 0 13 * fri",
+    "15 4 31 * *",
+    "0 0 29 2 *",
+    "0 0 * jan,jul sun",
+    "59 23 * * 7",
+    "10-50/20 */7 1-15/3 */2 *",
+]
+
+
+@pytest.mark.parametrize("expression", EXPRESSIONS)
+def test_next_after_matches_croniter(expression: str):
+    rand = random.Random(expression)
+    base = datetime(2021, 1, 1, tzinfo=timezone.utc)
+    cron = CronExpression(expression)
+    assert not cron.uses_croniter
+
+    for _ in range(200):
+        start = base + timedelta(seconds=rand.randrange(4 * 365 * 24 * 60 * 60))
+        expected = croniter(expression, start).get_next(datetime)
+        assert cron.next_after(start) == expected
+
+
+def test_next_after_is_strictly_after():
+    cron = CronExpression("0 * * * *")
+    start = datetime(2021, 6, 1, 12, 0, tzinfo=timezone.utc)
+
+    assert cron.next_after(start) == datetime(2021, 6, 1, 13, 0, tzinfo=timezone.utc)
+
+
+def test_next_after_keeps_timezone():
+    cron = CronExpression("0 * * * *")
+    naive = datetime(2021, 6, 1, 12, 30)
+    localized = pytz.utc.localize(naive)
+
+    assert cron.next_after(naive).tzinfo is None
+    assert cron.next_after(localized).tzinfo is pytz.utc
+
+
+@pytest.mark.parametrize("expression", ["0 0 L * *", "0 0 * * fri#2"])
+def test_unsupported_syntax_uses_croniter(expression: str):
+    cron = CronExpression(expression)
+    start = datetime(2021, 6, 1, tzinfo=timezone.utc)
+
+    assert cron.uses_croniter
+    assert cron.next_after(start) == croniter(expression, start).get_next(datetime)
+
+
+def test_daylight_saving_zones_use_croniter():
+    cron = CronExpression("30 2 * * *")
+    start = pytz.timezone("US/Eastern").localize(datetime(2021, 3, 13, 12))
+
+    assert cron.next_after(start) == croniter(cron.expression, start).get_next(datetime)
+
+
+def test_compile_expression_is_cached():
+    assert compile_expression("*/3 * * * *") is compile_expression("*/3 * * * *")
+
+
+def test_next_fire_times_matches_next_after():
+    rand = random.Random(0)
+    base = datetime(2021, 1, 1, tzinfo=timezone.utc)
+    expressions = [rand.choice(EXPRESSIONS) for _ in range(500)]
+    # Most starts are shared, as they are when catching up after an outage
+    starts = [
+        base + timedelta(minutes=rand.choice([0, 0, 0, rand.randrange(100_000)]))
+        for _ in expressions
+    ]
+    naive_start = datetime(2021, 1, 1, 12)
+
+    result = next_fire_times([*expressions, "0 * * * *"], [*starts, naive_start])
+    expected = [
+        compile_expression(e).next_after(s) for e, s in zip(expressions, starts)
+    ]
+    assert result == [*expected, datetime(2021, 1, 1, 13)]
@@ -0,0 +1,62 @@
+import time
+
+from job_scheduler.runner.limits import CircuitBreaker, DestinationLimits
+
+
+def test_breaker_opens_when_calls_fail():
+    breaker = CircuitBreaker(window=4, min_calls=4, failure_rate=0.5, cooldown_s=60)
+    for succeeded in [True, False, True]:
+        breaker.record(succeeded)
+    assert breaker.allow()
+
+    breaker.record(False)
+
+    assert breaker.is_open
+    assert not breaker.allow()
+
+
+def test_breaker_closes_after_a_successful_trial():
+    breaker = CircuitBreaker(window=2, min_calls=2, failure_rate=1, cooldown_s=0.05)
+    breaker.record(False)
+    breaker.record(False)
+
+    time.sleep(0.05)
+    # Only a single trial call is let through
+    assert breaker.allow()
+    assert not breaker.allow()
+
+    breaker.record(True)
+    assert not breaker.is_open
+    assert breaker.allow()
+
+
+def test_breaker_reopens_after_a_failed_trial():
+    breaker = CircuitBreaker(window=2, min_calls=2, failure_rate=1, cooldown_s=0.05)
+    breaker.record(False)
+    breaker.record(False)
+
+    time.sleep(0.05)
+    assert breaker.allow()
+    breaker.record(False)
+
+    assert breaker.is_open
+    assert not breaker.allow()
+
+
+def test_limits_are_kept_per_host():
+    limits = DestinationLimits(2, window=2, min_calls=2, failure_rate=1, cooldown_s=1)
+
+    assert limits.acquire("http://a:8080/one")
+    assert limits.acquire("http://a:8080/two")
+    assert not limits.acquire("http://a:8080/")
+    assert limits.acquire("http://b/")
+
+    limits.release("http://a:8080/one")
+    assert limits.acquire("http://a:8080/")
+    assert limits.breaker("http://a:8080/one") is limits.breaker("http://a:8080/")
+
+
+def test_host_concurrency_can_be_unlimited():
+    limits = DestinationLimits(0, window=2, min_calls=2, failure_rate=1, cooldown_s=1)
+
+    assert all(limits.acquire("http://a/") for _ in range(100))
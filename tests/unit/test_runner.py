@@ -1,16 +1,32 @@
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+
 import pytest
 from aiohttp import web
 
-from job_scheduler.api.models import Schedule
+from job_scheduler.api.models import DueSchedule, HttpMethod, Schedule
 from job_scheduler.broker import FakeBroker, ScheduleBroker
+from job_scheduler.config import config
 from job_scheduler.db import (
     FakeJobRepository,
     FakeScheduleRepository,
     JobRepository,
     ScheduleRepository,
 )
-from job_scheduler.runner.main import run_jobs
-from job_scheduler.services import get_schedule, get_schedule_jobs, store_schedule
+from job_scheduler.db.types import Fence
+from job_scheduler.runner.http import PoolMetrics, get_session
+from job_scheduler.runner.limits import DestinationLimits
+from job_scheduler.runner.main import dispatch_jobs, execute, run_jobs
+from job_scheduler.services import (
+    claim_schedules,
+    complete_executions,
+    enqueue_jobs,
+    get_schedule,
+    get_schedule_jobs,
+    release_schedules,
+    store_schedule,
+)
 
 
 @pytest.fixture(scope="session")
@@ -48,3 +64,371 @@ async def test_jobs_get_run(
     # assert job was created
     jobs = await get_schedule_jobs(j_repo, schedule.id)
     assert len(jobs[schedule.id]) == 1
+
+
+async def test_jobs_complete_independently(
+    n_schedules,
+    s_repo: ScheduleRepository,
+    j_repo: JobRepository,
+    broker: ScheduleBroker,
+    aiohttp_client,
+):
+    async def fast(request):
+        return web.json_response({})
+
+    async def slow(request):
+        await asyncio.sleep(0.5)
+        return web.json_response({})
+
+    app = web.Application()
+    app.router.add_post("/fast", fast)
+    app.router.add_post("/slow", slow)
+    tc = await aiohttp_client(app)
+
+    fast_s, slow_s = n_schedules(2)
+    fast_s.job.callback_url = str(tc.make_url("/fast"))
+    slow_s.job.callback_url = str(tc.make_url("/slow"))
+    await store_schedule(s_repo, fast_s, slow_s)
+    await broker.publish(str(fast_s.id), str(slow_s.id))
+
+    tasks = await dispatch_jobs(
+        s_repo, j_repo, broker, tc.session, asyncio.Semaphore(2)
+    )
+    _, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+
+    # The fast job is recorded while the slow one is still running
+    jobs = await get_schedule_jobs(j_repo, fast_s.id, slow_s.id)
+    assert len(pending) == 1
+    assert len(jobs[fast_s.id]) == 1
+    assert len(jobs[slow_s.id]) == 0
+
+    await asyncio.gather(*pending)
+
+
+async def test_jobs_for_busy_hosts_are_deferred(
+    n_schedules,
+    s_repo: ScheduleRepository,
+    j_repo: JobRepository,
+    aiohttp_client,
+    monkeypatch,
+):
+    async def callback(request):
+        return web.json_response({})
+
+    app = web.Application()
+    app.router.add_post("/", callback)
+    tc = await aiohttp_client(app)
+    monkeypatch.setattr(config.runner, "host_busy_delay_s", 0.05)
+
+    busy = n_schedules(3)
+    other, *_ = n_schedules(1)
+    for s in busy:
+        s.job.callback_url = str(tc.make_url("/"))
+    other.job.callback_url = "http://127.0.0.1:1/"
+    await store_schedule(s_repo, *busy, other)
+    broker = FakeBroker()
+    await broker.publish(*[str(s.id) for s in [*busy, other]])
+
+    limits = DestinationLimits(1, window=20, min_calls=10, failure_rate=1, cooldown_s=1)
+    slots = asyncio.Semaphore(config.runner.concurrency)
+    tasks = await dispatch_jobs(s_repo, j_repo, broker, tc.session, slots, limits)
+
+    # One job per host runs, the others are queued again for later
+    assert len(tasks) == 2
+    assert broker.job_queue.empty()
+    await asyncio.gather(*tasks)
+    await asyncio.sleep(0.1)
+    assert broker.job_queue.qsize() == 2
+    assert limits.in_flight == {}
+
+
+async def test_deferred_runs_stay_claimed(
+    schedule: Schedule,
+    s_repo: FakeScheduleRepository,
+    j_repo: JobRepository,
+    aiohttp_client,
+):
+    tc = await aiohttp_client(web.Application())
+    schedule.next_run = datetime.now(timezone.utc) - timedelta(minutes=1)
+    await store_schedule(s_repo, schedule)
+    broker = FakeBroker()
+    await enqueue_jobs(broker, DueSchedule(schedule.id, schedule.due_at))
+
+    limits = DestinationLimits(1, window=20, min_calls=10, failure_rate=1, cooldown_s=1)
+    limits.acquire(schedule.job.callback_url)
+    slots = asyncio.Semaphore(config.runner.concurrency)
+    tasks = await dispatch_jobs(s_repo, j_repo, broker, tc.session, slots, limits)
+
+    assert tasks == []
+    # A scheduler can't claim the run again while the job waits on its host
+    _, claimed = await claim_schedules(s_repo, schedule.priority, 10)
+    assert schedule.id not in [c.id for c in claimed]
+
+
+async def test_jobs_for_completed_runs_are_dropped(
+    schedule: Schedule,
+    s_repo: ScheduleRepository,
+    j_repo: JobRepository,
+    aiohttp_client,
+):
+    tc = await aiohttp_client(web.Application())
+    schedule.next_run = datetime.now(timezone.utc) - timedelta(minutes=1)
+    await store_schedule(s_repo, schedule)
+    broker = FakeBroker()
+    # The run was queued twice, and one of its jobs has already run
+    run = DueSchedule(schedule.id, schedule.due_at)
+    await enqueue_jobs(broker, run)
+    await complete_executions(s_repo, schedule)
+
+    slots = asyncio.Semaphore(config.runner.concurrency)
+    tasks = await dispatch_jobs(s_repo, j_repo, broker, tc.session, slots)
+
+    assert tasks == []
+    assert broker.job_queue.empty()
+    jobs = await get_schedule_jobs(j_repo, schedule.id)
+    assert len(jobs[schedule.id]) == 0
+
+
+async def test_runs_stay_claimed_while_attempts_run(
+    schedule: Schedule,
+    s_repo: FakeScheduleRepository,
+    j_repo: JobRepository,
+    aiohttp_client,
+):
+    claims = []
+
+    async def callback(request):
+        claims.append(s_repo.claims[str(schedule.id)][1] - time.monotonic())
+        return web.json_response({})
+
+    app = web.Application()
+    app.router.add_post("/", callback)
+    tc = await aiohttp_client(app)
+    schedule.job.callback_url = str(tc.make_url("/"))
+    schedule.job.timeout_s = 60
+    schedule.next_run = datetime.now(timezone.utc) - timedelta(minutes=1)
+    await store_schedule(s_repo, schedule)
+    broker = FakeBroker()
+    await enqueue_jobs(broker, DueSchedule(schedule.id, schedule.due_at))
+
+    slots = asyncio.Semaphore(config.runner.concurrency)
+    await asyncio.gather(
+        *await dispatch_jobs(s_repo, j_repo, broker, tc.session, slots)
+    )
+
+    # The claim outlasts the attempt's timeout
+    assert claims[0] > schedule.job.timeout_s
+
+
+async def test_pool_metrics(aiohttp_server):
+    async def callback(request):
+        return web.json_response({})
+
+    app = web.Application()
+    app.router.add_post("/", callback)
+    server = await aiohttp_server(app)
+
+    metrics = PoolMetrics()
+    async with get_session(metrics) as session:
+        for _ in range(3):
+            async with session.post(server.make_url("/"), json={}) as response:
+                await response.read()
+
+    stats = metrics.hosts[server.host]
+    assert stats.requests == 3
+    assert stats.in_flight == stats.errors == 0
+    # The connection is kept alive between requests
+    assert stats.connections_created == 1
+    assert stats.connections_reused == 2
+
+
+async def test_jobs_of_past_terms_are_dropped_once_taken_over(
+    n_schedules,
+    s_repo: ScheduleRepository,
+    j_repo: JobRepository,
+    aiohttp_client,
+):
+    tc = await aiohttp_client(web.Application())
+    broker = FakeBroker()
+    taken_over, kept = n_schedules(2)
+    for s in (taken_over, kept):
+        s.next_run = datetime.now(timezone.utc) - timedelta(minutes=1)
+    await store_schedule(s_repo, taken_over, kept)
+    now = datetime.now(timezone.utc).timestamp()
+    _, claimed = await claim_schedules(s_repo, now, 10, fence=Fence("leader", 1))
+    await enqueue_jobs(broker, *claimed, fence=Fence("leader", 1))
+    # The next term claims one of the runs again once its claim is given up
+    await release_schedules(s_repo, taken_over)
+    await claim_schedules(s_repo, now, 10, fence=Fence("leader", 2))
+
+    slots = asyncio.Semaphore(config.runner.concurrency)
+    tasks = await dispatch_jobs(s_repo, j_repo, broker, tc.session, slots)
+    await asyncio.gather(*tasks)
+    jobs = await get_schedule_jobs(j_repo, taken_over.id, kept.id)
+
+    assert len(jobs[taken_over.id]) == 0
+    assert len(jobs[kept.id]) == 1
+    assert broker.job_queue.empty()
+
+
+async def test_failed_jobs_are_retried(
+    schedule: Schedule,
+    s_repo: ScheduleRepository,
+    j_repo: JobRepository,
+    aiohttp_client,
+):
+    async def unavailable(request):
+        return web.json_response({}, status=503)
+
+    app = web.Application()
+    app.router.add_post("/", unavailable)
+    tc = await aiohttp_client(app)
+
+    broker = FakeBroker()
+    schedule.job.callback_url = str(tc.make_url("/"))
+    schedule.job.max_attempts, schedule.job.backoff_s = 2, 0
+    await store_schedule(s_repo, schedule)
+    await broker.publish(str(schedule.id))
+
+    await run_jobs(s_repo, j_repo, broker, tc.session)
+    s, *_ = await get_schedule(s_repo, schedule.id)
+    # The retry is queued, and the scheduled run is done with
+    assert broker.job_queue.qsize() == 1
+    assert s.next_run != schedule.next_run
+
+    await run_jobs(s_repo, j_repo, broker, tc.session)
+    jobs = (await get_schedule_jobs(j_repo, schedule.id))[schedule.id]
+    assert sorted((j.attempt, j.status_code) for j in jobs) == [(1, 503), (2, 503)]
+    assert broker.job_queue.empty()
+    assert (await get_schedule(s_repo, schedule.id))[0].next_run == s.next_run
+
+
+async def test_jobs_time_out(
+    schedule: Schedule,
+    s_repo: ScheduleRepository,
+    j_repo: JobRepository,
+    aiohttp_client,
+):
+    async def slow(request):
+        await asyncio.sleep(0.5)
+        return web.json_response({})
+
+    app = web.Application()
+    app.router.add_post("/", slow)
+    tc = await aiohttp_client(app)
+
+    broker = FakeBroker()
+    schedule.job.callback_url = str(tc.make_url("/"))
+    schedule.job.timeout_s = 0.1
+    await store_schedule(s_repo, schedule)
+    await broker.publish(str(schedule.id))
+
+    await run_jobs(s_repo, j_repo, broker, tc.session)
+
+    job, *_ = (await get_schedule_jobs(j_repo, schedule.id))[schedule.id]
+    assert job.status_code == 504
+
+
+async def test_open_circuits_fail_fast(
+    schedule: Schedule,
+    s_repo: ScheduleRepository,
+    j_repo: JobRepository,
+    aiohttp_client,
+):
+    calls = []
+
+    async def callback(request):
+        calls.append(request)
+        return web.json_response({})
+
+    app = web.Application()
+    app.router.add_post("/", callback)
+    tc = await aiohttp_client(app)
+
+    broker = FakeBroker()
+    schedule.job.callback_url = str(tc.make_url("/"))
+    await store_schedule(s_repo, schedule)
+    await broker.publish(str(schedule.id))
+
+    limits = DestinationLimits(1, window=1, min_calls=1, failure_rate=1, cooldown_s=60)
+    limits.breaker(schedule.job.callback_url).record(False)
+    tasks = await dispatch_jobs(
+        s_repo, j_repo, broker, tc.session, asyncio.Semaphore(1), limits
+    )
+    await asyncio.gather(*tasks)
+
+    job, *_ = (await get_schedule_jobs(j_repo, schedule.id))[schedule.id]
+    assert len(calls) == 0
+    assert job.status_code == 503
+
+
+@pytest.mark.parametrize(
+    "response, store_response, result",
+    [
+        (web.json_response({"ok": True}), "body", {"ok": True}),
+        (web.json_response([1, 2]), "body", {"body": [1, 2]}),
+        (web.Response(text="plain"), "body", {"body": "plain"}),
+        (web.Response(), "body", {}),
+        (
+            web.Response(text="x" * 100),
+            "body",
+            {"body": "x" * 64, "truncated": True},
+        ),
+        (
+            web.Response(text="ignored", headers={"X-Test": "yes"}),
+            "headers",
+            {"headers": {"X-Test": "yes"}},
+        ),
+    ],
+)
+async def test_responses_are_stored(
+    schedule: Schedule,
+    aiohttp_client,
+    monkeypatch,
+    response: web.Response,
+    store_response: str,
+    result: dict,
+):
+    async def callback(request):
+        return response
+
+    app = web.Application()
+    app.router.add_post("/", callback)
+    tc = await aiohttp_client(app)
+    monkeypatch.setattr(config.runner, "max_response_bytes", 64)
+    schedule.job.callback_url = str(tc.make_url("/"))
+    schedule.job.store_response = store_response
+
+    job = await execute(tc.session, schedule)
+
+    assert job.status_code == 200
+    if store_response == "headers":
+        assert job.result["headers"]["X-Test"] == "yes"
+    else:
+        assert job.result == result
+
+
+@pytest.mark.parametrize(
+    "method, body", [("get", b""), ("put", b'{"a":1}'), ("delete", b'{"a":1}')]
+)
+async def test_http_methods(schedule: Schedule, aiohttp_client, method, body):
+    received = []
+
+    async def callback(request):
+        received.append((request.method, request.content_type, await request.read()))
+        return web.json_response({})
+
+    app = web.Application()
+    app.router.add_route("*", "/", callback)
+    tc = await aiohttp_client(app)
+    schedule.job.callback_url = str(tc.make_url("/"))
+    schedule.job.http_method = HttpMethod(method)
+    schedule.job.payload = {"a": 1}
+
+    job = await execute(tc.session, schedule)
+
+    assert job.status_code == 200
+    assert received[0][0] == method.upper()
+    assert received[0][2] == body
+    if body:
+        assert received[0][1] == "application/json"
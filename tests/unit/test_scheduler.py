@@ -1,14 +1,54 @@
+import asyncio
 import time
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 
 import pytest
 
-from job_scheduler.api.models import Schedule
+from job_scheduler.api.models import DueSchedule, Schedule
 from job_scheduler.broker import FakeBroker, ScheduleBroker
-from job_scheduler.cache import FakeScheduleCache, ScheduleCache
+from job_scheduler.config import config
+from job_scheduler.config.main import Scheduler
+from job_scheduler.coordination import FakeLeaderElection
 from job_scheduler.db import FakeScheduleRepository, ScheduleRepository
-from job_scheduler.scheduler.main import schedule_jobs
-from job_scheduler.services import store_schedule
+from job_scheduler.scheduler.main import (
+    keep_releasing,
+    release_due,
+    release_time,
+    schedule_jobs,
+    wait_for_next_tick,
+)
+from job_scheduler.scheduler.wheel import TimingWheel
+from job_scheduler.services import claim_schedules, fencing_token, store_schedule
+
+
+class UnconfirmedBroker(FakeBroker):
+    async def publish(self, *messages: str, **kwargs):
+        published = await super().publish(*messages, **kwargs)
+        for m in published:
+            m.confirmed = False
+        return published
+
+
+class FailingOnceBroker(FakeBroker):
+    def __init__(self):
+        super().__init__()
+        self.failed = False
+
+    async def publish(self, *messages: str, **kwargs):
+        if not self.failed:
+            self.failed = True
+            raise ConnectionError("Broker unavailable")
+        return await super().publish(*messages, **kwargs)
+
+
+class RecordingBroker(FakeBroker):
+    def __init__(self):
+        super().__init__()
+        self.batches = []
+
+    async def publish(self, *messages: str, **kwargs):
+        self.batches.append(len(messages))
+        return await super().publish(*messages, **kwargs)
 
 
 @pytest.fixture(scope="session")
@@ -16,14 +56,20 @@ def repo():
     return FakeScheduleRepository.get_repo()
 
 
-@pytest.fixture(scope="session")
-async def broker():
-    return await FakeBroker.get_broker()
+@pytest.fixture
+def empty_repo():
+    class EmptyRepository(FakeScheduleRepository):
+        scored_data: dict = {}
+        paused_data: dict = {}
+        data: dict = {}
+        claims: dict = {}
+
+    return EmptyRepository.get_repo()
 
 
 @pytest.fixture(scope="session")
-async def cache():
-    return await FakeScheduleCache.get_cache()
+async def broker():
+    return await FakeBroker.get_broker()
 
 
 @pytest.mark.asyncio
@@ -31,7 +77,6 @@ async def test_jobs_get_scheduled(
     schedule: Schedule,
     repo: ScheduleRepository,
     broker: ScheduleBroker,
-    cache: ScheduleCache,
 ):
     # Add schedule to repo
     schedule.next_run = datetime.now(timezone.utc)
@@ -39,8 +84,155 @@ async def test_jobs_get_scheduled(
 
     # Run schedule_jobs to queue the job
     time.sleep(1)
-    await schedule_jobs(repo, broker, cache)
+    await schedule_jobs(repo, broker)
 
     # Assert schedule is added to broker
     s = await broker.get()
     assert s.payload == str(schedule.id)
+
+
+@pytest.mark.asyncio
+async def test_unconfirmed_jobs_get_released(
+    schedule: Schedule, repo: ScheduleRepository
+):
+    schedule.next_run = datetime.now(timezone.utc)
+    await store_schedule(repo, schedule)
+
+    time.sleep(1)
+    await schedule_jobs(repo, UnconfirmedBroker())
+
+    # The schedule can be claimed again on the next tick
+    _, claimed = await claim_schedules(repo, datetime.now(timezone.utc).timestamp(), 10)
+    assert schedule.id in [c.id for c in claimed]
+
+
+@pytest.mark.asyncio
+async def test_leader_fences_its_jobs(schedule: Schedule, repo: ScheduleRepository):
+    broker = FakeBroker()
+    election = FakeLeaderElection()
+    schedule.next_run = datetime.now(timezone.utc)
+    await store_schedule(repo, schedule)
+
+    time.sleep(1)
+    fence = await election.campaign()
+    await schedule_jobs(repo, broker, fence=fence)
+
+    message = await broker.get()
+    assert fence is not None
+    assert fencing_token(message) == fence.token
+
+
+@pytest.mark.asyncio
+async def test_idle_ticks_are_skipped(empty_repo: ScheduleRepository):
+    start = time.time()
+    await wait_for_next_tick(empty_repo, [0], interval_s=0.05, max_idle_s=0.3)
+
+    assert time.time() - start >= 0.3
+
+
+@pytest.mark.asyncio
+async def test_ticks_wake_for_the_earliest_schedule(
+    schedule: Schedule, empty_repo: ScheduleRepository
+):
+    schedule.next_run = datetime.fromtimestamp(time.time() + 0.2, timezone.utc)
+    await store_schedule(empty_repo, schedule)
+
+    await wait_for_next_tick(empty_repo, [0], interval_s=0.05, max_idle_s=5)
+
+    assert 0 <= time.time() - schedule.next_run.timestamp() < 0.1
+
+
+@pytest.mark.asyncio
+async def test_ticks_align_to_the_interval(
+    schedule: Schedule, empty_repo: ScheduleRepository
+):
+    # A due schedule which is still claimed waits for the next tick
+    schedule.next_run = datetime.now(timezone.utc)
+    await store_schedule(empty_repo, schedule)
+
+    await wait_for_next_tick(empty_repo, [0], interval_s=0.25, max_idle_s=5)
+
+    phase = time.time() % 0.25
+    assert min(phase, 0.25 - phase) < 0.05
+
+
+@pytest.mark.asyncio
+async def test_jobs_are_released_from_the_wheel_when_due(
+    schedule: Schedule, empty_repo: ScheduleRepository
+):
+    broker = FakeBroker()
+    wheel: TimingWheel = TimingWheel(resolution_s=0.01, now=time.time())
+    schedule.next_run = datetime.fromtimestamp(time.time() + 0.2, timezone.utc)
+    await store_schedule(empty_repo, schedule)
+
+    await schedule_jobs(empty_repo, broker, wheel=wheel)
+    assert len(wheel) == 1
+    assert await release_due(empty_repo, broker, wheel) == 0
+
+    await asyncio.sleep(schedule.next_run.timestamp() - time.time() + 0.01)
+    assert await release_due(empty_repo, broker, wheel) == 1
+    assert (await broker.get()).payload == str(schedule.id)
+
+
+@pytest.mark.asyncio
+async def test_overdue_jobs_bypass_the_wheel(
+    n_schedules, empty_repo: ScheduleRepository, monkeypatch
+):
+    monkeypatch.setattr(config.scheduler, "page_size", 2)
+    broker = RecordingBroker()
+    wheel: TimingWheel = TimingWheel(resolution_s=0.01, now=time.time())
+    *overdue, upcoming = n_schedules(5)
+    for s in overdue:
+        s.next_run = datetime.now(timezone.utc) - timedelta(minutes=1)
+    upcoming.next_run = datetime.fromtimestamp(time.time() + 0.5, timezone.utc)
+    await store_schedule(empty_repo, *overdue, upcoming)
+
+    await schedule_jobs(empty_repo, broker, wheel=wheel)
+
+    # The backlog is queued a page at a time, only the upcoming job waits
+    assert broker.batches == [2, 2]
+    assert len(wheel) == 1
+
+
+@pytest.mark.asyncio
+async def test_releasing_survives_errors(n_schedules, empty_repo: ScheduleRepository):
+    broker = FailingOnceBroker()
+    wheel: TimingWheel = TimingWheel(resolution_s=0.01, now=time.time())
+    first, second = n_schedules(2)
+    first.next_run = datetime.fromtimestamp(time.time() + 0.05, timezone.utc)
+    second.next_run = datetime.fromtimestamp(time.time() + 0.15, timezone.utc)
+    await store_schedule(empty_repo, first, second)
+    await schedule_jobs(empty_repo, broker, wheel=wheel)
+
+    releasing = asyncio.create_task(
+        keep_releasing(empty_repo, broker, wheel, asyncio.Event())
+    )
+    await asyncio.sleep(0.25)
+
+    assert not releasing.done()
+    releasing.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await releasing
+    # The first release failed, the second went ahead
+    assert (await broker.get()).payload == str(second.id)
+    assert len(wheel) == 0
+
+
+def test_dispatch_spread_is_independent_of_jitter(n_schedules):
+    schedules = n_schedules(20)
+    for s in schedules:
+        s.jitter_s = 10
+    due = [DueSchedule(s.id, s.due_at) for s in schedules]
+
+    jitter = [s.jitter.total_seconds() / 10 for s in schedules]
+    spread = [(release_time(d, 10) - d.next_run.timestamp()) / 10 for d in due]
+
+    # The same fraction of each window would make the two add up
+    assert all(0 <= f < 1 for f in spread)
+    assert all(abs(j - f) > 1e-6 for j, f in zip(jitter, spread))
+
+
+def test_lookahead_must_fit_in_the_claim_lease():
+    Scheduler(lookahead_s=2, dispatch_spread_s=5, claim_lease_s=10)
+    with pytest.raises(ValueError):
+        Scheduler(lookahead_s=5, dispatch_spread_s=5, claim_lease_s=10)
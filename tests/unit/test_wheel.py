@@ -0,0 +1,77 @@
+import random
+
+from job_scheduler.scheduler.wheel import TimingWheel
+
+
+def test_items_are_released_on_time():
+    rand = random.Random(0)
+    wheel: TimingWheel[int] = TimingWheel(resolution_s=0.01, now=0, slots=8, levels=2)
+    # Some items fall beyond the outermost level and wait in the overflow
+    due = {i: rand.uniform(0, 3) for i in range(500)}
+    for i, at in due.items():
+        wheel.add(i, at)
+
+    released = []
+    for step in range(1, 301):
+        now = step * 0.01
+        for i in wheel.advance(now):
+            assert now - 0.02 < due[i] <= now + 1e-9
+            released.append(i)
+
+    assert sorted(released) == list(range(500))
+    assert len(wheel) == 0
+
+
+def test_overdue_items_are_released_on_the_next_advance():
+    wheel: TimingWheel[str] = TimingWheel(resolution_s=0.1, now=100)
+    wheel.add("late", 50)
+
+    assert wheel.advance(100) == ["late"]
+
+
+def test_advance_catches_up_after_a_stall():
+    wheel: TimingWheel[str] = TimingWheel(resolution_s=0.1, now=0, slots=4, levels=2)
+    wheel.add("first", 0.5)
+    wheel.add("second", 2.5)
+    wheel.add("later", 60)
+
+    assert wheel.advance(10) == ["first", "second"]
+    assert wheel.advance(60) == ["later"]
+
+
+def test_clear():
+    wheel: TimingWheel[str] = TimingWheel(resolution_s=0.1, now=0)
+    wheel.add("soon", 1)
+    wheel.add("overdue", 0)
+    wheel.add("much later", 10_000)
+
+    assert sorted(wheel.clear()) == ["much later", "overdue", "soon"]
+    assert len(wheel) == 0
+    assert wheel.advance(20_000) == []
+
+
+def test_next_due():
+    rand = random.Random(1)
+    wheel: TimingWheel[int] = TimingWheel(resolution_s=0.01, now=0, slots=8, levels=2)
+    assert wheel.next_due() is None
+
+    due = {i: rand.uniform(0, 3) for i in range(100)}
+    for i, at in due.items():
+        wheel.add(i, at)
+
+    for step in range(1, 301):
+        for i in wheel.advance(step * 0.01):
+            due.pop(i)
+        if len(due) > 0:
+            # Items are due at the start of the first tick after their time
+            assert min(due.values()) <= wheel.next_due() < min(due.values()) + 0.01
+
+    assert wheel.next_due() is None
+
+
+def test_overdue_items_are_due_now():
+    wheel: TimingWheel[str] = TimingWheel(resolution_s=0.1, now=100)
+    wheel.add("later", 200)
+    wheel.add("late", 50)
+
+    assert wheel.next_due() == 100